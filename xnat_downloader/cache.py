@@ -0,0 +1,138 @@
+"""On-disk cache of the subject/session/scan listings xnat returns."""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    server TEXT NOT NULL,
+    project TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (server, project, key)
+);
+"""
+
+
+def default_cache_dir():
+    """~/.cache/xnat_downloader (or under $XDG_CACHE_HOME when it is set)"""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'xnat_downloader')
+
+
+class MetadataCache:
+    """
+    Listings from one project on one xnat server, each kept for ``ttl`` seconds
+
+    Attributes
+    ----------
+    path: string
+        location of the sqlite database holding the listings
+    server: string
+        the base URL of the xnat server
+    project: string
+        project ID on xnat
+    ttl: float
+        number of seconds a listing is reused before asking xnat again
+    """
+
+    def __init__(self, path, server, project, ttl):
+        self.path = path
+        self.server = server
+        self.project = project
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+
+    def get(self, key):
+        """Returns the cached value of key, None if it is missing or expired"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, fetched_at FROM listings WHERE server=? AND project=? AND key=?',
+                (self.server, self.project, key)).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        """Stores a json serializable value under key"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)',
+                (self.server, self.project, key, json.dumps(value), time.time()))
+
+    def fetch(self, key, func):
+        """Returns the cached value of key, calling func to refresh it when needed"""
+        value = self.get(key)
+        if value is None:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, prefix=''):
+        """Drops every listing of the project whose key starts with prefix"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'DELETE FROM listings WHERE server=? AND project=? AND substr(key, 1, ?)=?',
+                (self.server, self.project, len(prefix), prefix))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedAttributes:
+    """attrs of a pyxnat object that answers cached keys without a request"""
+
+    def __init__(self, obj, values):
+        self._obj = obj
+        self._values = values
+
+    def get(self, key):
+        if key in self._values:
+            return self._values[key]
+        return self._obj.attrs.get(key)
+
+
+class CachedObject:
+    """
+    A pyxnat object whose label, id, type and parent come from a cached
+    listing (pyxnat asks xnat every time one of these is read)
+
+    Everything else is passed through to the wrapped pyxnat object.
+    """
+
+    def __init__(self, obj, values, parent=None):
+        """
+        Parameters
+        ----------
+        obj: object
+            the pyxnat object (e.g. subject.experiment(label))
+        values: dict
+            the cached attributes ('ID', 'label', 'type', ...)
+        parent: object | None
+            the object returned by parent() (pyxnat's parent if None)
+        """
+        self._obj = obj
+        self._parent = parent
+        self.attrs = CachedAttributes(obj, values)
+
+    def __getattr__(self, name):
+        return getattr(self._obj, name)
+
+    def id(self):
+        return self.attrs.get('ID')
+
+    def label(self):
+        return self.attrs.get('label')
+
+    def parent(self):
+        if self._parent is not None:
+            return self._parent
+        return self._obj.parent()
@@ -1,10 +1,36 @@
 #!/usr/bin/env python3
 from pyxnat import Interface
+from xnat_downloader.cache import CachedObject, MetadataCache, default_cache_dir
+from xnat_downloader.concurrency import AdaptiveLimiter
+from xnat_downloader.conversions import ConversionCache, dcm2niix_version
+from xnat_downloader.hierarchy import fetch_hierarchy
+from xnat_downloader.incremental import changed_sessions, load_mark, save_mark
+from xnat_downloader.locks import ScanLocks
+from xnat_downloader.manifest import STATE_DIR, Manifest, merge_shard_manifests, state_path
+from xnat_downloader.packing import archive_index, archive_path, extract_scan, is_packed, \
+    is_stored, pack_scan
+from xnat_downloader.plan import load_plan, plan_hierarchy, session_file_sizes, write_plan
+from xnat_downloader.retry import RetryPolicy
+from xnat_downloader.scratch import ScratchSpace, default_scratch_dir
+from xnat_downloader.shard import assign_shards, parse_shard, shard_of, shard_suffix
+from xnat_downloader.staging import clean_staging, commit_staged, discard_staged, owned, \
+    staging_dir
+from xnat_downloader.store import ContentStore
+from xnat_downloader.transfer import TRANSFERS, PyxnatTransfer
+from xnat_downloader.transport import configure_transport
+from xnat_downloader.verify import list_remote_files, verify_scan
+from xnat_downloader.watchdog import TransferStalled, Watchdog
 import os
+import json
 import logging
 import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager, nullcontext
+from copy import copy
 from subprocess import call
-from time import sleep
+from threading import BoundedSemaphore, Lock
 
 SCAN_EXPR = """\
 ^(?P<rec_ex>PU:)?\
@@ -95,8 +121,152 @@ def parse_cmdline():
     parser.add_argument('--scan-non-fmt', action="store_true",
                         help="if subject and session use BIDS formatting, "
                              "but the scans do not")
+    parser.add_argument('--conversion-cache', action='store_true',
+                        help='remember the dicoms and dcm2niix settings every nifti '
+                             'was made from and only convert again when they change '
+                             '(or when outputs are missing)')
     parser.add_argument('--overwrite-nii', action='store_true',
                         help='overwrite the nifti file if it exists')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of scans to download in parallel')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='adjust the number of concurrent downloads to how '
+                             'fast xnat answers, up to --jobs')
+    parser.add_argument('--connect-timeout', type=float, default=60,
+                        help='seconds to wait when connecting to xnat '
+                             '(default: %(default)s)')
+    parser.add_argument('--read-timeout', type=float, default=None,
+                        help='seconds to wait for xnat to send data '
+                             '(default: no limit)')
+    parser.add_argument('--stall-floor', type=float, default=1024,
+                        help='bytes per second below which a download counts '
+                             'as stalled (default: %(default)s)')
+    parser.add_argument('--stall-window', type=float, default=600,
+                        help='seconds a download may receive data slower than '
+                             '--stall-floor before it is aborted and tried again '
+                             '(default: %(default)s, 0 to never abort)')
+    parser.add_argument('--stall-first-byte', type=float, default=None,
+                        help='seconds a download may wait for the first byte of a '
+                             'response before it is aborted and tried again '
+                             '(default: three times --stall-window)')
+    parser.add_argument('--max-attempts', type=int, default=5,
+                        help='number of times a request to xnat is tried before '
+                             'giving up on it (default: %(default)s)')
+    parser.add_argument('--retry-delay', type=float, default=2,
+                        help='seconds to wait after the first failed attempt, '
+                             'doubled after every further failure '
+                             '(default: %(default)s)')
+    parser.add_argument('--retry-budget', type=int, default=None,
+                        help='number of retries allowed for the whole run '
+                             'before giving up (default: no limit)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='convert scans in a separate pool of workers so '
+                             'downloads do not wait on dcm2niix')
+    parser.add_argument('--convert-jobs', type=int, default=os.cpu_count() or 1,
+                        help='number of dcm2niix processes to run at once '
+                             'with --pipeline (default: number of cores)')
+    parser.add_argument('--max-pending', type=int, default=None,
+                        help='number of downloaded scans allowed to wait for '
+                             'conversion with --pipeline '
+                             '(default: twice --convert-jobs)')
+    parser.add_argument('--batch-convert', action='store_true',
+                        help='convert the scans of a session with a single '
+                             'dcm2niibatch run once they are all downloaded '
+                             '(scans it fails on are converted with dcm2niix)')
+    parser.add_argument('--no-keep-dicoms', dest='keep_dicoms', action='store_false',
+                        help='download every scan into scratch space, convert it '
+                             'there and only keep the nifti and json files')
+    parser.add_argument('--scratch-dir', default=default_scratch_dir(),
+                        help='where scans are downloaded with --no-keep-dicoms and '
+                             'packed scans are extracted to be converted '
+                             '(default: /dev/shm if available, else the temp directory)')
+    parser.add_argument('--scratch-size', type=float, default=4,
+                        help='gigabytes of dicoms allowed in --scratch-dir at once, '
+                             'further downloads wait for room (default: 4)')
+    parser.add_argument('--pack-dicoms', action='store_true',
+                        help='store the dicoms of every scan as one zip archive '
+                             '(<id>-<type>.zip) instead of a directory of files')
+    parser.add_argument('--store', metavar='STORE',
+                        help='directory of dicoms shared by destinations: downloaded '
+                             'scans are added to it and hard linked into the '
+                             'destination, scans already in it are linked instead '
+                             'of downloaded')
+    parser.add_argument('--transfer', choices=sorted(TRANSFERS), default='pyxnat',
+                        help='how scans are downloaded: "pyxnat" saves the zip '
+                             'archive and extracts it afterwards, "resume" does '
+                             'the same but continues interrupted downloads, '
+                             '"stream" extracts the archive as it arrives, '
+                             '"files" downloads the files of every scan one by '
+                             'one, --file-jobs at a time, "auto" downloads '
+                             'large scans file by file and the rest as an '
+                             'archive, "archive" copies the files from the '
+                             'archive of xnat mounted at --archive-root (over '
+                             'http when they are not there)')
+    parser.add_argument('--file-jobs', type=int, default=4,
+                        help='files of a scan downloaded at the same time with '
+                             '--transfer files or auto (default: %(default)s)')
+    parser.add_argument('--archive-root', metavar='ARCHIVE_ROOT',
+                        help='where the archive of xnat is mounted (for --transfer archive)')
+    parser.add_argument('--archive-server-root', metavar='SERVER_ROOT',
+                        help='the path of the archive on the xnat server, when it '
+                             'is mounted elsewhere (default: --archive-root)')
+    parser.add_argument('--archive-link', action='store_true',
+                        help='hard link the files of the archive instead of '
+                             'copying them (for --transfer archive)')
+    parser.add_argument('--manifest', action='store_true',
+                        help='keep a database of finished downloads in the '
+                             'destination and use it (instead of looking for '
+                             'dicoms) to decide which scans to skip')
+    parser.add_argument('--verify', action='store_true',
+                        help='compare every scan with the file catalog on xnat '
+                             'and download missing or different files again')
+    parser.add_argument('--verify-only', action='store_true',
+                        help='only verify the scans already in the destination '
+                             '(nothing new is downloaded or converted)')
+    parser.add_argument('--cache-ttl', type=float, default=0,
+                        help='reuse subject/session/scan listings fetched from '
+                             'xnat less than this many seconds ago '
+                             '(default: 0, always ask xnat)')
+    parser.add_argument('--cache-dir', default=default_cache_dir(),
+                        help='directory of the listing cache '
+                             '(default: %(default)s)')
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='forget the cached listings of the project '
+                             'before running')
+    parser.add_argument('--bulk-metadata', action='store_true',
+                        help='list all sessions and scans of the project with '
+                             'a few search queries instead of asking for each '
+                             'subject and session')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only process sessions added or modified on xnat '
+                             'since the last successful --incremental run')
+    parser.add_argument('--bulk-session', action='store_true',
+                        help='download all selected scans of a session '
+                             'in a single archive')
+    parser.add_argument('--shard', type=parse_shard, metavar='K/N',
+                        help='only process the K-th of N disjoint parts of the '
+                             'scans (K from 0 to N-1), e.g. one per task of a '
+                             'cluster array job')
+    parser.add_argument('--merge-manifests', action='store_true',
+                        help='merge the manifests the shards of a cluster run '
+                             'wrote in the destination into its manifest.sqlite '
+                             '(used by runs without --shard), remove them and exit')
+    parser.add_argument('--lock', choices=['wait', 'skip'], default=None,
+                        help='take a lock file in the destination for every scan '
+                             'being downloaded or converted, and wait for or skip '
+                             'the scans other processes hold (for runs sharing a '
+                             'destination)')
+    parser.add_argument('--lock-lease', type=float, default=300,
+                        help='seconds after which the lock of a process that '
+                             'stopped (e.g. was killed) is taken over')
+    parser.add_argument('--write-plan', metavar='PLAN',
+                        help='write the scans the spec selects, where they go '
+                             'and their size to a json file instead of '
+                             'downloading them')
+    parser.add_argument('--plan', metavar='PLAN',
+                        help='download the scans of a plan written with '
+                             '--write-plan (no -i needed, xnat is not asked '
+                             'for subjects, sessions or scans)')
     # Required arguments
     required_args = parser.add_argument_group('Required arguments')
     required_args.add_argument('-i', '--input_json',
@@ -106,6 +276,173 @@ def parse_cmdline():
     return parser
 
 
+# what every conversion asks dcm2niix for: a gzipped nifti with a json sidecar
+DCM2NIIX_OPTIONS = ['-z', 'y', '-b', 'y']
+# the same options in the terms of a dcm2niibatch configuration
+DCM2NIIBATCH_OPTIONS = {'isGz': 'true', 'isCreateBIDS': 'true'}
+
+
+def conversion_settings():
+    """The dcm2niix version and options, changing either calls for new conversions"""
+    return ' '.join([dcm2niix_version()] + DCM2NIIX_OPTIONS)
+
+
+def find_dcm2niibatch():
+    """The path of the dcm2niibatch executable (None if it is not installed)"""
+    return shutil.which('dcm2niibatch')
+
+
+def run_dcm2niibatch(conversions):
+    """
+    Converts several directories of dicoms with a single dcm2niibatch run
+
+    Parameters
+    ----------
+    conversions: list
+        (dcm_dir, bids_dir, fname) of every scan, see run_dcm2niix
+
+    Returns
+    -------
+    returncode: int | None
+        the exit status of dcm2niibatch (not zero if any scan failed),
+        None if dcm2niibatch is not installed
+    """
+    executable = find_dcm2niibatch()
+    if executable is None:
+        return None
+    lines = ['Options:']
+    lines += ['  {}: {}'.format(key, value) for key, value in DCM2NIIBATCH_OPTIONS.items()]
+    lines.append('Files:')
+    for dcm_dir, bids_dir, fname in conversions:
+        # json strings are valid yaml and escape whatever is in the paths
+        lines += ['  - in_dir: {}'.format(json.dumps(dcm_dir)),
+                  '    out_dir: {}'.format(json.dumps(bids_dir)),
+                  '    filename: {}'.format(json.dumps(fname))]
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as config:
+        config.write('\n'.join(lines) + '\n')
+    try:
+        return call([executable, config.name])
+    finally:
+        os.remove(config.name)
+
+
+def run_dcm2niix(dcm_dir, bids_dir, fname):
+    """
+    Converts a directory of dicoms to a gzipped nifti with a json sidecar
+
+    Parameters
+    ----------
+    dcm_dir: string
+        directory containing the dicoms of a single scan
+    bids_dir: string
+        directory the nifti and json files are written to
+    fname: string
+        the name of the output files (without extension)
+    """
+    dcm2niix = ['dcm2niix', '-o', bids_dir, '-f', fname] + DCM2NIIX_OPTIONS + [dcm_dir]
+    return call(dcm2niix)
+
+
+class ConversionQueue:
+    """
+    Runs dcm2niix in its own pool of workers so downloads can continue
+    while earlier scans are being converted.
+
+    Every scan reserves a slot before it starts downloading and gives the
+    slot back once its conversion finishes, so at most ``max_pending``
+    scans are downloaded but not yet converted at any time.
+
+    Attributes
+    ----------
+    executor: ThreadPoolExecutor
+        Pool whose workers each drive one dcm2niix process
+    slots: BoundedSemaphore
+        Tracks the scans that are downloading or waiting to be converted
+    """
+
+    def __init__(self, workers, max_pending):
+        """
+        Parameters
+        ----------
+        workers: int
+            number of dcm2niix processes to run at the same time
+        max_pending: int
+            number of scans allowed between the start of a download
+            and the end of its conversion
+        """
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = BoundedSemaphore(max_pending)
+
+    def reserve(self):
+        """Blocks until another scan may be downloaded"""
+        self.slots.acquire()
+
+    def release(self):
+        """Gives back a reservation that did not lead to a conversion"""
+        self.slots.release()
+
+    def submit(self, func, *args):
+        """
+        Queues a conversion (func called with args), taking over the
+        caller's reservation
+
+        Returns
+        -------
+        future: Future
+            resolves to the return value of func
+        """
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def shutdown(self):
+        """Waits for the queued conversions to finish"""
+        self.executor.shutdown(wait=True)
+
+
+class ConversionBatch:
+    """
+    Collects the conversions of a group of scans (e.g. a session) so they
+    are run together once every scan of the group was downloaded
+
+    Attributes
+    ----------
+    size: int
+        number of scans in the group
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._pending = size
+        self._conversions = []
+        self._lock = Lock()
+
+    def add(self, func, *args):
+        """
+        Takes the place of a conversion (a converter of download_scan),
+        keeping its arguments for Subject.convert_batch
+        """
+        with self._lock:
+            self._conversions.append(args)
+
+    def done(self):
+        """
+        Marks a scan of the group as handled (whether or not it added a
+        conversion)
+
+        Returns
+        -------
+        conversions: list
+            the arguments of the conversions of the group once the last scan
+            is handled (empty before)
+        """
+        with self._lock:
+            self._pending -= 1
+            if self._pending:
+                return []
+            return list(self._conversions)
+
+
 class Subject:
     """
     Main way to interact with subject data.
@@ -132,9 +469,43 @@ class Subject:
         (e.g. central.select('project').subject('label').experiment('session').scans.get(''))
     scan_dict: dictionary
         Dictionary matching a scan type (e.g. PU:T1w) with the scan object (from pyxnat)
+    transfer: object
+        Downloads the dicoms of scans (see xnat_downloader.transfer)
+    manifest: Manifest | None
+        Record of the scans that finished downloading
+    verify: boolean
+        True if downloaded scans are checked against xnat's file catalog
+    cache: MetadataCache | None
+        Listings of sessions and scans reused from earlier runs
+    sessions: dictionary | None
+        Session labels matched with their scans when the whole project was
+        listed up front (None if sessions and scans are requested per subject)
+    retry: RetryPolicy
+        How failed requests to xnat are retried
+    limiter: AdaptiveLimiter | None
+        Limits the number of downloads running at once
+    watchdog: Watchdog | None
+        Aborts downloads that stopped making progress
+    locks: ScanLocks | None
+        Keeps other processes writing to the destination away from the
+        scans this one is working on
+    conversions: ConversionCache | None
+        Record of the conversions done in the destination
+    scratch: ScratchSpace | None
+        Where scans are downloaded to when their dicoms are not kept, and
+        packed scans are extracted to for their conversion
+    keep_dicoms: boolean
+        True if the dicoms of scans are kept under sourcedata
+    pack: boolean
+        True if the dicoms of downloaded scans are stored as one archive per scan
+    store: ContentStore | None
+        Dicoms shared with other destinations
     """
 
-    def __init__(self, proj_obj, label):
+    def __init__(self, proj_obj, label, transfer=None, manifest=None, verify=False,
+                 cache=None, sessions=None, retry=None, limiter=None, watchdog=None,
+                 locks=None, conversions=None, scratch=None, keep_dicoms=True, pack=False,
+                 store=None):
         """
         Parameters
         ----------
@@ -144,9 +515,73 @@ class Subject:
         label: string
             The label of the participant in the xnat server
             (can be different from the subject ID)
+        transfer: object | None
+            How the dicoms get from xnat to the disk
+            (one of the classes in xnat_downloader.transfer, pyxnat by default)
+        manifest: Manifest | None
+            Record of finished downloads used to decide what to skip
+            (see xnat_downloader.manifest)
+        verify: bool
+            Compare every downloaded scan with the file catalog on xnat
+            and download missing or different files again
+        cache: MetadataCache | None
+            Listings of sessions and scans reused from earlier runs
+            (see xnat_downloader.cache)
+        sessions: dict | None
+            The subject's sessions and their scans, already listed with
+            xnat_downloader.hierarchy.fetch_hierarchy
+        retry: RetryPolicy | None
+            How failed requests to xnat are retried
+            (see xnat_downloader.retry, shared by the whole run)
+        limiter: AdaptiveLimiter | None
+            Limits the number of downloads running at once
+            (see xnat_downloader.concurrency, shared by the whole run)
+        watchdog: Watchdog | None
+            Aborts downloads that stopped making progress, so they are
+            tried again (see xnat_downloader.watchdog)
+        locks: ScanLocks | None
+            Lock files shared with other processes writing to the same
+            destination (see xnat_downloader.locks)
+        conversions: ConversionCache | None
+            Decides which scans need converting instead of looking for
+            their nifti (see xnat_downloader.conversions)
+        scratch: ScratchSpace | None
+            Space for dicoms that are only needed until they are converted
+            (see xnat_downloader.scratch, a temporary directory if None)
+        keep_dicoms: bool
+            Keep the dicoms under sourcedata. Otherwise every scan is
+            downloaded into scratch, converted there and thrown away.
+        pack: bool
+            Replace the directory of every downloaded scan with an archive
+            (see xnat_downloader.packing)
+        store: ContentStore | None
+            Link the scans it holds instead of downloading them, and add
+            the scans that are downloaded (see xnat_downloader.store)
         """
+        self.store = store
+        self.scratch = scratch
+        self.keep_dicoms = keep_dicoms
+        self.pack = pack
+        self.conversions = conversions
+        self.locks = locks
+        self.limiter = limiter
+        self.watchdog = watchdog
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.cache = cache
+        self.sessions = sessions
+        # the project id, as it was selected
+        self.project = proj_obj._uri.rstrip('/').split('/')[-1]
         self.sub_obj = proj_obj.subject(label)
-        if not self.sub_obj.exists():
+        if sessions is not None:
+            # the subject was found by the project listing
+            self.sub_obj = CachedObject(self.sub_obj, {'label': label})
+            exists = True
+        elif cache is not None:
+            exists = cache.fetch('subjects/{}/exists'.format(label),
+                                 lambda: self.retry.call(self.sub_obj.exists))
+        else:
+            exists = self.retry.call(self.sub_obj.exists)
+        if not exists:
             print("ERROR: Subject does not exist")
             self.sub = False
         else:
@@ -159,6 +594,49 @@ class Subject:
         self.ses_objs = None
         self.scan_dict = None
         self.scan_objs = None
+        self.transfer = transfer if transfer is not None else PyxnatTransfer()
+        self.manifest = manifest
+        self.verify = verify
+
+    def _list_sessions(self):
+        """Returns the session objects of the subject (from the cache if possible)"""
+        if self.sessions is not None:
+            return [CachedObject(self.sub_obj.experiment(label), {'label': label})
+                    for label in self.sessions]
+        description = 'listing the sessions of {}'.format(self.label)
+        if self.cache is None:
+            return self.retry.call(lambda: list(self.sub_obj.experiments().get('')),
+                                   description=description)
+
+        def list_labels():
+            return [ses_obj.attrs.get('label')
+                    for ses_obj in self.sub_obj.experiments().get('')]
+
+        labels = self.cache.fetch('subjects/{}/sessions'.format(self.label),
+                                  lambda: self.retry.call(list_labels,
+                                                          description=description))
+        return [CachedObject(self.sub_obj.experiment(label), {'label': label})
+                for label in labels]
+
+    def _list_scans(self, ses_obj):
+        """Returns the scan objects of a session (from the cache if possible)"""
+        if self.sessions is not None:
+            return [CachedObject(ses_obj.scan(values['ID']), values, parent=ses_obj)
+                    for values in self.sessions.get(ses_obj.label(), [])]
+        description = 'listing the scans of {}'.format(ses_obj.label())
+        if self.cache is None:
+            return self.retry.call(lambda: list(ses_obj.scans().get('')),
+                                   description=description)
+
+        def list_scans():
+            return [{'ID': scan_obj.id(), 'type': scan_obj.attrs.get('type')}
+                    for scan_obj in ses_obj.scans().get('')]
+
+        key = 'subjects/{}/sessions/{}/scans'.format(self.label, ses_obj.label())
+        values = self.cache.fetch(key, lambda: self.retry.call(list_scans,
+                                                               description=description))
+        return [CachedObject(ses_obj.scan(scan['ID']), scan, parent=ses_obj)
+                for scan in values]
 
     def get_sessions(self, labels=None, bids=True):
         """
@@ -214,7 +692,7 @@ class Subject:
             print('ERROR: no sessions can be found because subject does not exist')
             return 1
 
-        self.ses_objs = list(self.sub_obj.experiments().get(''))
+        self.ses_objs = self._list_sessions()
         if not self.ses_objs:
             print('WARNING: No sessions were found')
             self.ses = False
@@ -261,16 +739,685 @@ class Subject:
             print('ERROR: Session {ses} does not exist'.format(ses=ses_label))
             return 1
 
-        self.scan_objs = list(self.ses_dict[ses_label].scans().get(''))
+        self.scan_objs = self._list_scans(self.ses_dict[ses_label])
         self.scan_dict = {}
         for scan_obj in self.scan_objs:
             key = scan_obj.attrs.get('type')
             if scan_labels is None or key in scan_labels:
                 self.scan_dict[key] = scan_obj
 
+    def _download_dicoms(self, scan_par, scan_id, scan_fmt, dcm_outdir):
+        """
+        Downloads and extracts the dicoms of a single scan
+
+        Parameters
+        ----------
+        scan_par: object
+            pyxnat session object the scan belongs to
+        scan_id: string
+            the number id given to a scan on xnat (e.g. 1, 2, 400),
+            or several comma separated ids
+        scan_fmt: string
+            scan type with non-word characters replaced (e.g. PU_task_rest_bold)
+        dcm_outdir: string
+            directory the session folder of dicoms is extracted into
+
+        The dicoms are extracted into a staging directory under dcm_outdir
+        and each scan directory is renamed into place once the download is
+        complete, so an interrupted download never looks finished.
+        """
+        stage = staging_dir(dcm_outdir, scan_par.label() + '-' + scan_fmt)
+        # other runs on the destination leave the staging directory alone
+        with owned(stage):
+            os.makedirs(stage, exist_ok=True)
+            try:
+                self.retry.call(self._transfer, scan_par, scan_id, scan_fmt, stage,
+                                description='download of {}'.format(scan_fmt))
+            except BaseException:
+                discard_staged(stage)
+                raise
+            commit_staged(stage, dcm_outdir)
+
+    def _transfer(self, scan_par, scan_id, scan_fmt, dcm_outdir):
+        """A single download attempt (see _download_dicoms)"""
+        slot = self.limiter.slot() if self.limiter is not None else nullcontext()
+        watch = self.watchdog.watch() if self.watchdog is not None else nullcontext()
+        try:
+            with slot as limiter_slot, watch:
+                self.transfer.download(scan_par, scan_id, scan_fmt, dcm_outdir)
+                if limiter_slot is not None:
+                    # the limiter judges xnat by the throughput of the download
+                    limiter_slot.nbytes = sum(
+                        os.path.getsize(os.path.join(root, name))
+                        for scan_dir in self._scan_dirs(scan_par, scan_id, dcm_outdir)
+                        for root, _, files in os.walk(scan_dir)
+                        for name in files)
+        except TransferStalled:
+            # whatever arrived before the abort is incomplete
+            zip_path = os.path.join(dcm_outdir, scan_fmt + '.zip')
+            if os.path.exists(zip_path):
+                os.remove(zip_path)
+            for scan_dir in self._scan_dirs(scan_par, scan_id, dcm_outdir):
+                shutil.rmtree(scan_dir, ignore_errors=True)
+            raise
+
+    def _scan_dirs(self, scan_par, scan_id, dcm_outdir):
+        """The directories the scans (comma separated ids) are extracted into"""
+        from glob import glob
+        return [scan_dir
+                for id_ in scan_id.split(',')
+                for scan_dir in glob(os.path.join(dcm_outdir, scan_par.label(),
+                                                  'scans', id_ + '-*'))]
+
+    def _dicom_dir(self, scan, dcm_outdir):
+        """
+        Returns the directory the dicoms of a scan are extracted into
+        (<session_label>/scans/<scan_id>-<scan_fmt> under dcm_outdir)
+        """
+        scan_obj = self.scan_dict[scan]
+        # PU:task-rest_bold -> PU_task_rest_bold
+        scan_fmt = re.sub(r'[^\w]', '_', scan)
+        return os.path.join(dcm_outdir,
+                            scan_obj.parent().label(),
+                            'scans',
+                            scan_obj.id() + '-' + scan_fmt)
+
+    def sourcedata_dir(self, dest, by_subject=False):
+        """
+        Returns the directory sessions of dicoms are stored under
+
+        Parameters
+        ----------
+        dest: string
+            the destination of the BIDS dataset
+        by_subject: bool
+            sessions are grouped by subject (the layout download_scan_unformatted uses)
+        """
+        if by_subject:
+            return os.path.join(dest, 'sourcedata', self.label)
+        return os.path.join(dest, 'sourcedata')
+
+    def verify_scan(self, scan, dcm_outdir, refetch=True):
+        """
+        Compares the files of a downloaded scan with the file catalog on xnat
+
+        Parameters
+        ----------
+        scan: string
+            the scan type (key of scan_dict)
+        dcm_outdir: string
+            directory the session folder of dicoms was extracted into
+        refetch: bool
+            download missing or different files again
+
+        Returns
+        -------
+        result: dict
+            see xnat_downloader.verify.verify_scan
+        """
+        scan_obj = self.scan_dict[scan]
+        result = self.retry.call(verify_scan, scan_obj._intf, scan_obj._uri,
+                                 self._dicom_dir(scan, dcm_outdir), refetch,
+                                 description='verification of {}'.format(scan))
+        print('verified {scan}: {total} file(s), {missing} missing, {mismatched} different, '
+              '{refetched} downloaded again'.format(
+                  scan=scan, total=result['total'], missing=len(result['missing']),
+                  mismatched=len(result['mismatched']),
+                  refetched=len(result['refetched'])))
+        if self.manifest is not None and refetch:
+            # the scan on disk now matches xnat
+            if result['refetched'] or not self._find_dicoms(scan, dcm_outdir):
+                self._record_download(scan, dcm_outdir)
+        return result
+
+    def _find_dicoms(self, scan, dcm_outdir):
+        """
+        Checks whether the dicoms of a scan were already downloaded
+
+        With a manifest, only scans recorded as finished count as downloaded.
+        Otherwise the scan's directory (or its archive) is taken as proof,
+        since downloads only move it into place once they are complete.
+
+        Returns
+        -------
+        found: string | None
+            where the dicoms were found, None if the scan needs downloading
+        """
+        dcm_dir = self._dicom_dir(scan, dcm_outdir)
+        if self.manifest is not None:
+            scan_obj = self.scan_dict[scan]
+            if self.manifest.is_complete(self.label, scan_obj.parent().label(), scan_obj.id()):
+                return dcm_dir
+            return None
+
+        if is_stored(dcm_dir):
+            return dcm_dir
+        return None
+
+    def _record_download(self, scan, dcm_outdir):
+        """Adds a finished download to the manifest (if there is one)"""
+        if self.manifest is None or not self.keep_dicoms:
+            # dicoms in scratch are gone by the next run
+            return
+        scan_obj = self.scan_dict[scan]
+        self.manifest.record_download(self.label, scan_obj.parent().label(), scan_obj.id(),
+                                      scan, self._dicom_dir(scan, dcm_outdir))
+
+    def _lock(self, scan, step, wait=None):
+        """
+        Holds the lock of a step ('download' or 'convert') of a scan for the
+        body of a with block, which gets False if another process holds it
+        and it is not waited for (see xnat_downloader.locks.ScanLocks.hold)
+        """
+        if self.locks is None:
+            return nullcontext(True)
+        scan_obj = self.scan_dict[scan]
+        return self.locks.hold('/'.join([str(self.label), scan_obj.parent().label(),
+                                         scan_obj.id(), step]), wait)
+
+    def _fetch_scan(self, scan, dcm_outdir):
+        """
+        Downloads the dicoms of a scan unless they are already there
+
+        Returns
+        -------
+        fetched: bool
+            False if another process is downloading the scan (and locks
+            are not waited for)
+        """
+        scan_obj = self.scan_dict[scan]
+        with self._lock(scan, 'download') as held:
+            if not held:
+                print('{scan} is being downloaded by another process, skipping'.format(
+                    scan=scan))
+                return False
+            # looked for after taking the lock, another process may just
+            # have finished the scan
+            found = self._find_dicoms(scan, dcm_outdir)
+            if found:
+                msg = """
+                      dicoms were already found in the output directory: {}
+                      """.format(found)
+                print(msg)
+            downloaded = False
+            if not found and not self._restore(scan, dcm_outdir):
+                self._download_dicoms(scan_obj.parent(), scan_obj.id(),
+                                      re.sub(r'[^\w]', '_', scan), dcm_outdir)
+                downloaded = True
+            if not found:
+                self._record_download(scan, dcm_outdir)
+            if self.verify:
+                self.verify_scan(scan, dcm_outdir)
+            dcm_dir = self._dicom_dir(scan, dcm_outdir)
+            if downloaded and self.store is not None:
+                # after verifying, so only files that match xnat are shared
+                self.store.add(self._store_key(scan), dcm_dir)
+            if self.pack and os.path.isdir(dcm_dir):
+                pack_scan(dcm_dir)
+        return True
+
+    def _needs_conversion(self, dcm_dir, bids_dir, fname):
+        """
+        Checks whether a scan has to be converted (again)
+
+        Without a conversion cache, only the nifti named after fname is
+        looked for (dcm2niix may name its outputs differently, e.g. the
+        echoes of a multi-echo scan). dcm_dir is None when the dicoms are
+        not downloaded yet, the recorded conversion is then trusted.
+        """
+        if self.conversions is None:
+            return not os.path.exists(os.path.join(bids_dir, fname + '.nii.gz'))
+        digest = None
+        if dcm_dir is not None:
+            digest = self.conversions.input_digest(dcm_dir)
+        return self.conversions.missing(bids_dir, fname, digest,
+                                        conversion_settings()) != []
+
+    def _estimate_size(self, scan):
+        """The bytes the files of a scan take on xnat (None if unknown)"""
+        scan_obj = self.scan_dict[scan]
+        try:
+            remote_files = self.retry.call(list_remote_files, scan_obj._intf, scan_obj._uri,
+                                           description='listing the files of {}'.format(scan))
+        except Exception as err:
+            logging.warning('could not estimate the size of %s (%s)', scan, err)
+            return None
+        sizes = [remote['size'] for remote in remote_files]
+        if not sizes or None in sizes:
+            return None
+        return sum(sizes)
+
+    def _scratch_area(self, nbytes=None):
+        """A directory for dicoms that are thrown away at the end of a with block"""
+        if self.scratch is None:
+            return tempfile.TemporaryDirectory(prefix='xnat_downloader-')
+        return self.scratch.area(nbytes)
+
+    @staticmethod
+    def _packed_size(dcm_dir):
+        """The bytes a packed scan takes once extracted (0 if it is not packed)"""
+        if not is_packed(dcm_dir):
+            return 0
+        return sum(size for size, _ in archive_index(archive_path(dcm_dir)).values())
+
+    @contextmanager
+    def _unpacked(self, dcm_dir):
+        """
+        The directory of the dicoms of a scan for the body of a with block,
+        extracted into scratch space if the scan is packed
+        """
+        if not is_packed(dcm_dir):
+            yield dcm_dir
+            return
+        with self._scratch_area(self._packed_size(dcm_dir)) as area:
+            yield extract_scan(archive_path(dcm_dir), area)
+
+    def _convert_in_scratch(self, scan, bids_dir, fname, overwrite_nii=False):
+        """
+        Downloads a scan into scratch space, converts it there and throws
+        the dicoms away (only the outputs are written to bids_dir)
+        """
+        if not overwrite_nii and not self._needs_conversion(None, bids_dir, fname):
+            print('It appears the nifti file already exists for {scan}'.format(scan=scan))
+            return 0
+        scan_obj = self.scan_dict[scan]
+        nbytes = self._estimate_size(scan)
+        if nbytes is not None:
+            # the archive and the files extracted from it are both there for a while
+            nbytes *= 2
+        with self._lock(scan, 'download') as held:
+            if not held:
+                print('{scan} is being downloaded by another process, skipping'.format(
+                    scan=scan))
+                return 0
+            with self._scratch_area(nbytes) as area:
+                if not self._restore(scan, area):
+                    self._download_dicoms(scan_obj.parent(), scan_obj.id(),
+                                          re.sub(r'[^\w]', '_', scan), area)
+                if self.verify:
+                    self.verify_scan(scan, area)
+                os.makedirs(bids_dir, exist_ok=True)
+                self._convert(scan, self._dicom_dir(scan, area), bids_dir, fname, overwrite_nii)
+        return 0
+
+    def _store_key(self, scan):
+        """The key of a scan in the store (see ContentStore.scan_key)"""
+        scan_obj = self.scan_dict[scan]
+        return ContentStore.scan_key(getattr(scan_obj._intf, '_server', None), self.project,
+                                     self.label, scan_obj.parent().label(), scan_obj.id())
+
+    def _restore(self, scan, dcm_outdir):
+        """
+        Links the dicoms of a scan from the store (if it holds them)
+
+        Returns
+        -------
+        restored: bool
+            False if the scan has to be downloaded
+        """
+        if self.store is None:
+            return False
+        scan_obj = self.scan_dict[scan]
+        stage = staging_dir(dcm_outdir, scan_obj.parent().label() + '-' + scan_obj.id() + '-store')
+        dcm_dir = self._dicom_dir(scan, dcm_outdir)
+        with owned(stage):
+            try:
+                restored = self.store.restore(self._store_key(scan),
+                                              os.path.join(stage, os.path.relpath(dcm_dir,
+                                                                                  dcm_outdir)))
+            except BaseException:
+                discard_staged(stage)
+                raise
+            if not restored:
+                discard_staged(stage)
+                return False
+            commit_staged(stage, dcm_outdir)
+        print('{scan} was linked from the store'.format(scan=scan))
+        return True
+
+    def _convert(self, scan, dcm_dir, bids_dir, fname, force=False):
+        """
+        Runs dcm2niix and records the files it wrote in the manifest
+
+        With a conversion cache, the scan is checked again first (it may have
+        been converted since it was queued) and force converts it anyway.
+        """
+        with self._lock(scan, 'convert') as held:
+            if not held:
+                print('{scan} is being converted by another process, skipping'.format(
+                    scan=scan))
+                return None
+            job = self._prepare_conversion(scan, dcm_dir, bids_dir, fname, force)
+            if job is None:
+                return None
+            with self._unpacked(dcm_dir) as src_dir:
+                returncode = run_dcm2niix(src_dir, job['out_dir'], fname)
+            self._finish_conversion(job, returncode)
+        return returncode
+
+    def convert_batch(self, conversions):
+        """
+        Converts several scans with a single dcm2niibatch run, converting
+        the scans it failed on (or all of them when dcm2niibatch is not
+        installed) one by one with dcm2niix
+
+        Packed scans are extracted into one scratch area for the whole run.
+        When they do not fit in scratch together, every scan is extracted
+        and converted with dcm2niix on its own instead.
+
+        Parameters
+        ----------
+        conversions: list
+            the arguments of _convert for every scan (see ConversionBatch)
+        """
+        # always taken in the same order, so processes waiting on each
+        # other's locks cannot deadlock
+        conversions = sorted(conversions, key=lambda args: self.scan_dict[args[0]].id())
+        jobs = []
+        with ExitStack() as stack:
+            try:
+                for scan, dcm_dir, bids_dir, fname, force in conversions:
+                    if not stack.enter_context(self._lock(scan, 'convert')):
+                        print('{scan} is being converted by another process, skipping'.format(
+                            scan=scan))
+                        continue
+                    # every scan gets a directory of its own, which tells
+                    # which of the scans dcm2niibatch converted
+                    job = self._prepare_conversion(scan, dcm_dir, bids_dir, fname, force,
+                                                   scratch=True)
+                    if job is not None:
+                        jobs.append(job)
+                if not jobs:
+                    return None
+                nbytes = sum(self._packed_size(job['dcm_dir']) for job in jobs)
+                if self.scratch is not None and nbytes > self.scratch.capacity:
+                    # only this batch could make room for the rest of it
+                    logging.info('the packed scans of %s take %d bytes, more than scratch '
+                                 'holds, converting them one by one', self.label, nbytes)
+                    for job in jobs:
+                        with self._unpacked(job['dcm_dir']) as src_dir:
+                            self._finish_conversion(
+                                job, run_dcm2niix(src_dir, job['out_dir'], job['fname']))
+                    return None
+                area = stack.enter_context(self._scratch_area(nbytes)) if nbytes else None
+                for index, job in enumerate(jobs):
+                    job['src_dir'] = job['dcm_dir']
+                    if is_packed(job['dcm_dir']):
+                        job['src_dir'] = extract_scan(archive_path(job['dcm_dir']),
+                                                      os.path.join(area, str(index)))
+                returncode = run_dcm2niibatch(
+                    [(job['src_dir'], job['out_dir'], job['fname']) for job in jobs])
+                for job in jobs:
+                    if returncode is not None and os.listdir(job['out_dir']):
+                        self._finish_conversion(job, 0)
+                        continue
+                    if returncode is not None:
+                        logging.warning('dcm2niibatch did not convert %s, running dcm2niix',
+                                        job['scan'])
+                    self._finish_conversion(
+                        job, run_dcm2niix(job['src_dir'], job['out_dir'], job['fname']))
+            finally:
+                for job in jobs:
+                    if job['out_dir'] != job['bids_dir']:
+                        shutil.rmtree(job['out_dir'], ignore_errors=True)
+        return returncode
+
+    def _prepare_conversion(self, scan, dcm_dir, bids_dir, fname, force=False, scratch=False):
+        """
+        Decides how a scan is converted
+
+        With a conversion cache (or scratch), dcm2niix writes into a scratch
+        directory next to the destination and _finish_conversion moves what
+        is needed into bids_dir: everything for a new conversion, only the
+        missing files when the cache says the rest is still up to date.
+
+        Returns
+        -------
+        job: dict | None
+            what _finish_conversion needs, with the directory dcm2niix
+            writes to ('out_dir'), None if the scan needs no conversion
+        """
+        job = {'scan': scan, 'dcm_dir': dcm_dir, 'bids_dir': bids_dir, 'fname': fname,
+               'out_dir': bids_dir, 'missing': None}
+        if self.conversions is not None:
+            job['settings'] = conversion_settings()
+            job['digest'] = self.conversions.input_digest(dcm_dir)
+            if not force:
+                job['missing'] = self.conversions.missing(bids_dir, fname, job['digest'],
+                                                          job['settings'])
+            if job['missing'] == []:
+                print('{scan} is already converted'.format(scan=scan))
+                return None
+            if job['missing']:
+                print('{n} output(s) of {scan} are missing, converting again to restore '
+                      'them'.format(n=len(job['missing']), scan=scan))
+            scratch_root = os.path.join(self.conversions.root, STATE_DIR, 'converting')
+            scratch = True
+        else:
+            scratch_root = bids_dir
+        if scratch:
+            # next to the destination, so the outputs are moved with a rename
+            os.makedirs(scratch_root, exist_ok=True)
+            job['out_dir'] = tempfile.mkdtemp(prefix='.' + fname + '-', dir=scratch_root)
+        return job
+
+    def _finish_conversion(self, job, returncode):
+        """
+        Puts the outputs of a conversion in place and records them
+
+        Returns
+        -------
+        outputs: list | None
+            the paths of the files of the conversion (None if it failed)
+        """
+        from glob import glob
+        bids_dir, fname = job['bids_dir'], job['fname']
+        if job['out_dir'] == bids_dir:
+            outputs = glob(os.path.join(bids_dir, fname + '*'))
+        else:
+            try:
+                produced = sorted(os.listdir(job['out_dir']))
+                if returncode != 0 or not produced:
+                    return None
+                os.makedirs(bids_dir, exist_ok=True)
+                previous = None
+                if self.conversions is not None and job['missing'] is None:
+                    previous = self.conversions.get(bids_dir, fname)
+                if previous is not None:
+                    # outputs of the earlier conversion this one did not make again
+                    for name, _ in previous['outputs']:
+                        path = os.path.join(bids_dir, name)
+                        if name not in produced and os.path.exists(path):
+                            os.remove(path)
+                for name in produced:
+                    if job['missing'] is None or name in job['missing']:
+                        os.replace(os.path.join(job['out_dir'], name),
+                                   os.path.join(bids_dir, name))
+                if self.conversions is not None:
+                    self.conversions.record(bids_dir, fname, job['digest'], job['settings'],
+                                            produced)
+            finally:
+                shutil.rmtree(job['out_dir'], ignore_errors=True)
+            outputs = [os.path.join(bids_dir, name) for name in produced]
+        if self.manifest is not None:
+            scan_obj = self.scan_dict[job['scan']]
+            self.manifest.record_conversion(self.label, scan_obj.parent().label(),
+                                            scan_obj.id(), outputs)
+        return outputs
+
+    @staticmethod
+    def _bids_fname(sub_name, ses_name, scan_pattern_dict):
+        """Names the bids files of a scan (without extension)"""
+        fname = '_'.join([sub_name, ses_name])
+
+        bids_keys_order = ['task', 'acq', 'ce', 'rec', 'rec_ex', 'dir', 'run', 'echo']
+
+        for key in bids_keys_order:
+            label = scan_pattern_dict[key]
+            if label is not None:
+                if key == 'rec_ex':
+                    key = 'rec'
+                    label = 'pu'
+                fname = '_'.join([fname, key + '-' + label])
+
+        # add the label (e.g. _bold)
+        if scan_pattern_dict['label'] is None:
+            label = scan_pattern_dict['modality']
+        else:
+            label = scan_pattern_dict['label']
+
+        return '_'.join([fname, label])
+
+    def bids_target_unformatted(self, scan, scan_repl_dict, bids_num_len,
+                                sub_repl_dict=None, sub_label_prefix=None):
+        """
+        Where download_scan_unformatted writes the nifti of a scan
+
+        Parameters are those of download_scan_unformatted.
+
+        Returns
+        -------
+        target: tuple | None
+            the bids directory (relative to the destination) and the name of
+            the bids files, None if the scan is not converted
+        """
+        ses_dir = self.scan_dict[scan].parent().label()
+        bids_scan = scan_repl_dict[scan]
+        if sub_repl_dict:
+            sub_name = 'sub-' + sub_repl_dict[self.sub_obj.attrs.get('label')]
+        else:
+            sub_name = 'sub-' + self.sub_obj.attrs.get('label').zfill(bids_num_len)
+
+        if self.ses_name_dict:
+            ses_name = 'ses-' + self.ses_name_dict[ses_dir]
+        else:
+            # To capture cases where the session is named 20180508_2
+            ses_name = 'ses-' + ses_dir.replace('_', 's')
+
+        scan_pattern = re.compile(SCAN_EXPR)
+
+        scan_pattern_dict = re.search(scan_pattern, bids_scan).groupdict()
+        # check if the modality is empty
+        if scan_pattern_dict['modality'] is None:
+            print('{scan} is not in BIDS, not converting'.format(scan=scan))
+            return None
+
+        # adding additional information to scan label (such as GE120)
+        if sub_label_prefix is not None:
+            sub_label = sub_name.split('-')[1]
+            sub_name = 'sub-' + sub_label_prefix + sub_label
+
+        bids_dir = os.path.join(sub_name, ses_name, scan_pattern_dict['modality'])
+        return bids_dir, self._bids_fname(sub_name, ses_name, scan_pattern_dict)
+
+    def bids_target(self, scan, sub_label_prefix=None, scan_repl_dict=None):
+        """
+        Where download_scan writes the nifti of a scan
+
+        Parameters are those of download_scan.
+
+        Returns
+        -------
+        target: tuple | None
+            the bids directory (relative to the destination) and the name of
+            the bids files, None if the scan is not converted
+        """
+        ses_dir = self.scan_dict[scan].parent().label()
+        # check what the bids scan name "should" be
+        if scan_repl_dict:
+            bids_scan = scan_repl_dict[scan]
+        else:
+            bids_scan = scan
+
+        sub_ses_pattern = re.compile(r'(sub-[A-Za-z0-9]+)_?(ses-[A-Za-z0-9]+)?')
+        sub_name, ses_name = re.search(sub_ses_pattern, ses_dir).groups()
+
+        scan_pattern = re.compile(SCAN_EXPR)
+
+        # WARNING they will only be in the correct order if I am using
+        # python3.6+
+        scan_pattern_dict = re.search(scan_pattern, bids_scan).groupdict()
+        if scan_pattern_dict['modality'] is None:
+            print('{scan} is not in BIDS, not converting'.format(scan=scan))
+            return None
+
+        # adding additional information to scan label (such as GE120)
+        if sub_label_prefix is not None:
+            sub_label = sub_name.split('-')[1]
+            sub_name = 'sub-' + sub_label_prefix + sub_label
+
+        # catch the weird case were subjects are not completely deleted from the xnat database,
+        # warning: poor fix
+        if (
+                sub_name is None or
+                ses_name is None or
+                scan_pattern_dict['modality'] is None
+        ):
+            print('assuming {subject} does not exist on xnat, continuing'.format(subject=sub_name))
+            return None
+
+        bids_dir = os.path.join(sub_name, ses_name, scan_pattern_dict['modality'])
+        return bids_dir, self._bids_fname(sub_name, ses_name, scan_pattern_dict)
+
+    def download_session(self, dest, scans=None, by_subject=False):
+        """
+        Downloads the dicoms of several scans from the current session
+        (the one get_scans was last called with) as a single archive
+
+        The archive is extracted into the same
+        <session_label>/scans/<scan_label>/resources/DICOM/files layout
+        used by download_scan and download_scan_unformatted, so those
+        methods find the dicoms and only convert them.
+
+        Parameters
+        ----------
+        dest: string
+            Directory where the zip file will be saved.
+        scans: list | None
+            the scans to download (all scans in scan_dict if None)
+        by_subject: bool
+            store the session under sourcedata/<subject label>
+            (the layout download_scan_unformatted uses)
+        """
+        if scans is None:
+            scans = list(self.scan_dict.keys())
+
+        dcm_outdir = self.sourcedata_dir(dest, by_subject)
+
+        missing = [scan for scan in scans
+                   if scan in self.scan_dict.keys() and
+                   not self._find_dicoms(scan, dcm_outdir)]
+        if not missing:
+            return 0
+
+        with ExitStack() as stack:
+            # scans other processes hold are left to download_scan, which
+            # waits for them or skips them
+            missing = [scan for scan in missing
+                       if stack.enter_context(self._lock(scan, 'download', wait=False)) and
+                       not self._find_dicoms(scan, dcm_outdir)]
+            if not missing:
+                return 0
+            os.makedirs(dcm_outdir, exist_ok=True)
+            restored = [scan for scan in missing if self._restore(scan, dcm_outdir)]
+            downloaded = [scan for scan in missing if scan not in restored]
+            if downloaded:
+                scan_par = self.scan_dict[downloaded[0]].parent()
+                # xnat builds one archive for comma separated scan ids
+                scan_ids = ','.join(self.scan_dict[scan].id() for scan in downloaded)
+                self._download_dicoms(scan_par, scan_ids, scan_par.label() + '_scans',
+                                      dcm_outdir)
+            for scan in missing:
+                self._record_download(scan, dcm_outdir)
+                if scan in downloaded and self.store is not None:
+                    self.store.add(self._store_key(scan),
+                                   self._dicom_dir(scan, dcm_outdir))
+                if self.pack:
+                    pack_scan(self._dicom_dir(scan, dcm_outdir))
+
     def download_scan_unformatted(self, scan, dest, scan_repl_dict, bids_num_len,
                                   sub_repl_dict=None, sub_label_prefix=None,
-                                  overwrite_nii=False):
+                                  overwrite_nii=False, converter=None):
         """
         Downloads a particular scan session
 
@@ -294,8 +1441,10 @@ class Subject:
             dictionary to change the subject label based on its representation on xnat
         overwrite_nii: bool
             overwrite the output nifti file if it already exists
+        converter: callable | None
+            called with the conversion function and its arguments instead of
+            running dcm2niix directly (e.g. to hand the conversion to another worker)
         """
-        from glob import glob
         if scan not in self.scan_dict.keys():
             print('{scan} is not available for download'.format(scan=scan))
             return 0
@@ -304,129 +1453,60 @@ class Subject:
         # the session label (e.g. 20180613)
         # ^soon to be sub-01_ses-01
         ses_dir = self.scan_dict[scan].parent().label()
-        scan_par = self.scan_dict[scan].parent()
         # the number id given to a scan (1, 2, 3, 400, 500)
         scan_id = self.scan_dict[scan].id()
         if scan not in scan_repl_dict.keys():
             print('{scan} not a part of dictionary, skipping'.format(scan=scan))
             return 0
 
-        bids_scan = scan_repl_dict[scan]
         # PU:task-rest_bold -> PU_task_rest_bold
         scan_fmt = re.sub(r'[^\w]', '_', scan)
         scan_dir = scan_id + '-' + scan_fmt
 
+        if not self.keep_dicoms:
+            target = self.bids_target_unformatted(scan, scan_repl_dict, bids_num_len,
+                                                  sub_repl_dict, sub_label_prefix)
+            if target is None:
+                return 0
+            return self._convert_in_scratch(scan, os.path.join(dest, target[0]), target[1],
+                                            overwrite_nii)
+
         # Add subject ID folder to path of DICOM download so that sessions are organized by subject -jjs 5/1/2019
         if getattr(self, "label", None) is None:
             dcm_outdir = os.path.join(dest, 'sourcedata')
         else:
             dcm_outdir = os.path.join(dest, 'sourcedata', self.label)
 
-        if not os.path.isdir(dcm_outdir):
-            os.makedirs(dcm_outdir)
-
-        potential_files = glob(os.path.join(dcm_outdir,
-                                            ses_dir,
-                                            'scans',
-                                            scan_dir,
-                                            'resources/DICOM/files/*.dcm'))
-        if potential_files:
-            msg = """
-                  dicoms were already found in the output directory: {}
-                  """.format(potential_files[0])
-            print(msg)
-        else:
-            # attempt to download dicoms (with a max of 5 tries)
-            max_retries = 5
-            for rtry in range(max_retries):
-                # track whether download succeeded
-                err = False
-                try:
-                    scan_par.scans().download(dest_dir=dcm_outdir,
-                                              type=scan_id,
-                                              name=scan_fmt,
-                                              extract=True,
-                                              removeZip=True)
-                except TypeError:
-                    print('download attempt {n} failed'.format(n=rtry + 1))
-                    err = True
-                    sleep(5)
-                finally:
-                    # break out of for loop if download succeeded
-                    if not err:
-                        break
-                    elif rtry == (max_retries - 1):
-                        raise TypeError("Could not download dicom")
+        os.makedirs(dcm_outdir, exist_ok=True)
+
+        if not self._fetch_scan(scan, dcm_outdir):
+            return 0
 
         # getting information about the directories
         dcm_dir = os.path.join(dcm_outdir,
                                ses_dir,
                                'scans',
                                scan_dir)
-        if sub_repl_dict:
-            sub_name = 'sub-' + sub_repl_dict[self.sub_obj.attrs.get('label')]
-        else:
-            sub_name = 'sub-' + self.sub_obj.attrs.get('label').zfill(bids_num_len)
-
-        if self.ses_name_dict:
-            ses_name = 'ses-' + self.ses_name_dict[ses_dir]
-        else:
-            # To capture cases where the session is named 20180508_2
-            ses_name = 'ses-' + ses_dir.replace('_', 's')
-
-        scan_pattern = re.compile(SCAN_EXPR)
-
-        scan_pattern_dict = re.search(scan_pattern, bids_scan).groupdict()
-        # check if the modality is empty
-        if scan_pattern_dict['modality'] is None:
-            print('{scan} is not in BIDS, not converting'.format(scan=scan))
+        target = self.bids_target_unformatted(scan, scan_repl_dict, bids_num_len,
+                                              sub_repl_dict, sub_label_prefix)
+        if target is None:
             return 0
+        bids_dir = os.path.join(dest, target[0])
+        fname = target[1]
 
-        # adding additional information to scan label (such as GE120)
-        if sub_label_prefix is not None:
-            sub_label = sub_name.split('-')[1]
-            sub_name = 'sub-' + sub_label_prefix + sub_label
-
-        # build up the bids directory
-        bids_dir = os.path.join(dest, sub_name, ses_name, scan_pattern_dict['modality'])
-
-        if not os.path.isdir(bids_dir):
-            os.makedirs(bids_dir)
-
-        # name the bids file
-        fname = '_'.join([sub_name, ses_name])
-
-        bids_keys_order = ['task', 'acq', 'ce', 'rec', 'rec_ex', 'dir', 'run', 'echo']
-
-        for key in bids_keys_order:
-            label = scan_pattern_dict[key]
-            if label is not None:
-                if key == 'rec_ex':
-                    key = 'rec'
-                    label = 'pu'
-                fname = '_'.join([fname, key + '-' + label])
-
-        # add the label (e.g. _bold)
-        if scan_pattern_dict['label'] is None:
-            label = scan_pattern_dict['modality']
-        else:
-            label = scan_pattern_dict['label']
-
-        fname = '_'.join([fname, label])
+        os.makedirs(bids_dir, exist_ok=True)
 
         print('the dcm dir is {dcm_dir}'.format(dcm_dir=dcm_dir))
-        dcm2niix = 'dcm2niix -o {bids_dir} -f {fname} -z y -b y {dcm_dir}'.format(
-            bids_dir=bids_dir,
-            fname=fname,
-            dcm_dir=dcm_dir)
-        bids_outfile = os.path.join(bids_dir, fname + '.nii.gz')
-        if not os.path.exists(bids_outfile) or overwrite_nii:
-            call(dcm2niix, shell=True)
+        if overwrite_nii or self._needs_conversion(dcm_dir, bids_dir, fname):
+            if converter is None:
+                self._convert(scan, dcm_dir, bids_dir, fname, overwrite_nii)
+            else:
+                converter(self._convert, scan, dcm_dir, bids_dir, fname, overwrite_nii)
         else:
             print('It appears the nifti file already exists for {scan}'.format(scan=scan))
 
     def download_scan(self, scan, dest, sub_label_prefix=None, scan_repl_dict=None,
-                      overwrite_nii=False):
+                      overwrite_nii=False, converter=None):
         """
         Downloads a particular scan session
 
@@ -448,8 +1528,10 @@ class Subject:
             (e.g. "PU: anat-T1w" -> "anat-T1w_rec-pu")
         overwrite_nii: bool
             overwrite the output nifti file if it already exists
+        converter: callable | None
+            called with the conversion function and its arguments instead of
+            running dcm2niix directly (e.g. to hand the conversion to another worker)
         """
-        from glob import glob
         if scan not in self.scan_dict.keys():
             print('{scan} is not available for download'.format(scan=scan))
             return 1
@@ -458,7 +1540,6 @@ class Subject:
         # the session label (e.g. 20180613)
         # ^soon to be sub-01_ses-01
         ses_dir = self.scan_dict[scan].parent().label()
-        scan_par = self.scan_dict[scan].parent()
         # the number id given to a scan (1, 2, 3, 400, 500)
         scan_id = self.scan_dict[scan].id()
 
@@ -466,51 +1547,22 @@ class Subject:
             if scan not in scan_repl_dict.keys():
                 print('{scan} not a part of dictionary, skipping'.format(scan=scan))
                 return 0
-        # check what the bids scan name "should" be
-        if scan_repl_dict:
-            bids_scan = scan_repl_dict[scan]
-        else:
-            bids_scan = scan
-
         # PU:task-rest_bold -> PU_task_rest_bold
         scan_fmt = re.sub(r'[^\w]', '_', scan)
         scan_dir = scan_id + '-' + scan_fmt
 
+        if not self.keep_dicoms:
+            target = self.bids_target(scan, sub_label_prefix, scan_repl_dict)
+            if target is None or dest is None:
+                return 0
+            return self._convert_in_scratch(scan, os.path.join(dest, target[0]), target[1],
+                                            overwrite_nii)
+
         dcm_outdir = os.path.join(dest, 'sourcedata')
-        if not os.path.isdir(dcm_outdir):
-            os.makedirs(dcm_outdir)
-
-        potential_files = glob(os.path.join(dcm_outdir,
-                                            ses_dir,
-                                            'scans',
-                                            scan_dir,
-                                            'resources/DICOM/files/*.dcm'))
-        if potential_files:
-            msg = """
-                  dicoms were already found in the output directory: {}
-                  """.format(potential_files[0])
-            print(msg)
-        else:
-            max_retries = 5
-            for rtry in range(max_retries):
-                # track whether download succeeded
-                err = False
-                try:
-                    scan_par.scans().download(dest_dir=dcm_outdir,
-                                              type=scan_id,
-                                              name=scan_fmt,
-                                              extract=True,
-                                              removeZip=True)
-                except TypeError:
-                    print('download attempt {n} failed'.format(n=rtry + 1))
-                    err = True
-                    sleep(5)
-                finally:
-                    # break out of for loop if download succeeded
-                    if not err:
-                        break
-                    elif rtry == (max_retries - 1):
-                        raise TypeError("Could not download dicom")
+        os.makedirs(dcm_outdir, exist_ok=True)
+
+        if not self._fetch_scan(scan, dcm_outdir):
+            return 0
 
         # getting information about the directories
         dcm_dir = os.path.join(dcm_outdir,
@@ -518,70 +1570,44 @@ class Subject:
                                'scans',
                                scan_dir)
 
-        sub_ses_pattern = re.compile(r'(sub-[A-Za-z0-9]+)_?(ses-[A-Za-z0-9]+)?')
-        sub_name, ses_name = re.search(sub_ses_pattern, ses_dir).groups()
-
-        scan_pattern = re.compile(SCAN_EXPR)
-
-        # WARNING they will only be in the correct order if I am using
-        # python3.6+
-        scan_pattern_dict = re.search(scan_pattern, bids_scan).groupdict()
-        if scan_pattern_dict['modality'] is None:
-            print('{scan} is not in BIDS, not converting'.format(scan=scan))
-            return 0
-
-        # adding additional information to scan label (such as GE120)
-        if sub_label_prefix is not None:
-            sub_label = sub_name.split('-')[1]
-            sub_name = 'sub-' + sub_label_prefix + sub_label
-
-        # catch the weird case were subjects are not completely deleted from the xnat database,
-        # warning: poor fix
-        if (
-                dest is None or
-                sub_name is None or
-                ses_name is None or
-                scan_pattern_dict['modality'] is None
-        ):
-            print('assuming {subject} does not exist on xnat, continuing'.format(subject=sub_name))
+        target = self.bids_target(scan, sub_label_prefix, scan_repl_dict)
+        if target is None or dest is None:
             return 0
+        bids_dir = os.path.join(dest, target[0])
+        fname = target[1]
 
-        # build up the bids directory
-        bids_dir = os.path.join(dest, sub_name, ses_name, scan_pattern_dict['modality'])
-
-        if not os.path.isdir(bids_dir):
-            os.makedirs(bids_dir)
+        os.makedirs(bids_dir, exist_ok=True)
 
-        # name the bids file
-        fname = '_'.join([sub_name, ses_name])
-
-        bids_keys_order = ['task', 'acq', 'ce', 'rec', 'rec_ex', 'dir', 'run', 'echo']
+        if overwrite_nii or self._needs_conversion(dcm_dir, bids_dir, fname):
+            if converter is None:
+                self._convert(scan, dcm_dir, bids_dir, fname, overwrite_nii)
+            else:
+                converter(self._convert, scan, dcm_dir, bids_dir, fname, overwrite_nii)
+        else:
+            print('It appears the nifti file already exists for {scan}'.format(scan=scan))
 
-        for key in bids_keys_order:
-            label = scan_pattern_dict[key]
-            if label is not None:
-                if key == 'rec_ex':
-                    key = 'rec'
-                    label = 'pu'
-                fname = '_'.join([fname, key + '-' + label])
 
-        # add the label (e.g. _bold)
-        if scan_pattern_dict['label'] is None:
-            label = scan_pattern_dict['modality']
-        else:
-            label = scan_pattern_dict['label']
+def report_results(results):
+    """
+    Summarize the outcome of every scan processed during the run
 
-        fname = '_'.join([fname, label])
+    Parameters
+    ----------
+    results: list
+        (subject, session, scan, error) tuples, where error is None
+        if the scan was processed without raising an exception
 
-        dcm2niix = 'dcm2niix -o {bids_dir} -f {fname} -z y -b y {dcm_dir}'.format(
-            bids_dir=bids_dir,
-            fname=fname,
-            dcm_dir=dcm_dir)
-        bids_outfile = os.path.join(bids_dir, fname + '.nii.gz')
-        if not os.path.exists(bids_outfile) or overwrite_nii:
-            call(dcm2niix, shell=True)
-        else:
-            print('It appears the nifti file already exists for {scan}'.format(scan=scan))
+    Returns
+    -------
+    failures: list
+        the entries of results that have an error
+    """
+    failures = [result for result in results if result[3] is not None]
+    print('{n} scan(s) processed, {f} failed'.format(n=len(results), f=len(failures)))
+    for subject, session, scan, err in failures:
+        print('FAILED: {sub} {ses} {scan}: {err}'.format(
+            sub=subject, ses=session, scan=scan, err=err))
+    return failures
 
 
 def main():
@@ -589,12 +1615,38 @@ def main():
     Does the main work of calling the functions and class(es) defined to download
     subject dicoms and transfer them to niftis
     """
-    # Start a log file
-    logging.basicConfig(filename='xnat_downloader.log', level=logging.DEBUG)
     # Parse the command line options
-    opts = parse_cmdline().parse_args()
-    # Parse the json spec file
-    input_dict = parse_json(opts.input_json)
+    parser = parse_cmdline()
+    opts = parser.parse_args()
+    if not opts.keep_dicoms and (opts.bulk_session or opts.verify_only):
+        parser.error('--no-keep-dicoms cannot be used with --bulk-session or --verify-only')
+    if opts.merge_manifests and opts.shard is not None:
+        parser.error('--merge-manifests cannot be used with --shard')
+    transfer_options = {}
+    if opts.transfer in ('files', 'auto'):
+        transfer_options = {'workers': max(opts.file_jobs, 1)}
+    if opts.transfer == 'archive':
+        if not opts.archive_root:
+            parser.error('--transfer archive needs --archive-root')
+        if opts.archive_link and opts.store:
+            # the store would make the files of the archive read-only
+            parser.error('--archive-link cannot be used with --store')
+        transfer_options = {'archive_root': opts.archive_root,
+                            'server_root': opts.archive_server_root,
+                            'link': opts.archive_link}
+    # every shard of a cluster run keeps its own log, manifest and mark
+    suffix = shard_suffix(opts.shard)
+    # Start a log file
+    logging.basicConfig(filename='xnat_downloader{}.log'.format(suffix), level=logging.DEBUG)
+    plan = None
+    if opts.plan:
+        # the plan carries the spec it was made from
+        plan = load_plan(opts.plan)
+        input_dict = plan['spec']
+        opts.scan_non_fmt = plan['options']['scan_non_fmt']
+    else:
+        # Parse the json spec file
+        input_dict = parse_json(opts.input_json)
     # assign variables from the json_file
     project = input_dict['project']
     subjects = input_dict.get('subjects', None)
@@ -607,6 +1659,14 @@ def main():
     sub_repl_dict = input_dict.get('sub_dict', None)
     sub_label_prefix = input_dict.get('sub_label_prefix', None)
 
+    if opts.merge_manifests:
+        merged = merge_shard_manifests(dest, project)
+        for path in merged:
+            logging.info('merged %s into the manifest', path)
+        print('merged {n} shard manifest(s) into {path}'.format(
+            n=len(merged), path=state_path(dest, 'manifest.sqlite')))
+        return None
+
     if session_labels == "None":
         session_labels = None
 
@@ -623,51 +1683,359 @@ def main():
             print('Server not specified')
             return 1
 
+    # keep a connection open for every download thread (for each of their
+    # files with --transfer files/auto) and the main thread
+    configure_transport(central, max(opts.jobs, 1) * transfer_options.get('workers', 1) + 1,
+                        opts.connect_timeout, opts.read_timeout)
+
+    # one policy for the run, so its retry budget covers every request
+    retry = RetryPolicy(opts.max_attempts, opts.retry_delay, budget=opts.retry_budget)
+
     # check if you have access to any projects
-    if not central.select.projects().get():
+    if not retry.call(central.select.projects().get, description='listing projects'):
         msg = "You have no access to any projects in the server, " \
               "please check your url, username, and password."
         raise RuntimeError(msg)
 
     logging.info('###################################')
     proj_obj = central.select.project(project)
-    if subjects is None:
+
+    cache = None
+    if opts.cache_ttl > 0 or opts.clear_cache:
+        cache = MetadataCache(os.path.join(opts.cache_dir, 'metadata.sqlite'),
+                              server, project, opts.cache_ttl)
+        if opts.clear_cache:
+            cache.invalidate()
+
+    def list_subjects():
         sub_objs = proj_obj.subjects()
         # list the subjects by their label (e.g. sub-myname)
         # instead of the RPACS_1223 ID given to them
         sub_objs._id_header = 'label'
-        subjects = sub_objs.get()
+        return retry.call(lambda: list(sub_objs.get()), description='listing subjects')
+
+    def list_hierarchy():
+        return retry.call(fetch_hierarchy, central, project, description='listing the project')
+
+    changed = None
+    if opts.incremental and plan is None:
+        mark_file = state_path(dest, 'incremental{}.json'.format(suffix))
+        changed, newest = retry.call(changed_sessions, central, project,
+                                     load_mark(mark_file, project),
+                                     description='listing changed sessions')
+        if subjects is None:
+            subjects = list(changed)
+        subjects = [subject for subject in subjects if str(subject) in changed]
+        print('{n} subject(s) have new or modified sessions'.format(n=len(subjects)))
+        if cache is not None and changed:
+            # cached listings may predate the changes (e.g. miss a new session)
+            cache.invalidate('hierarchy')
+            for subject in changed:
+                cache.invalidate('subjects/{}/'.format(subject))
+
+    hierarchy = None
+    planned = None
+    if plan is not None:
+        hierarchy = plan_hierarchy(plan)
+        subjects = list(hierarchy)
+        planned = {(entry['subject'], entry['session'], entry['scan'])
+                   for entry in plan['entries']}
+        if opts.shard is not None:
+            # every node reads the same plan, so sizes can balance the shards
+            shards = assign_shards([(entry['subject'], entry['session'], entry['scan'],
+                                     entry['estimated_bytes']) for entry in plan['entries']],
+                                   opts.shard[1])
+            planned = {unit for unit in planned if shards[unit] == opts.shard[0]}
+    elif opts.bulk_metadata:
+        if cache is not None:
+            hierarchy = cache.fetch('hierarchy', list_hierarchy)
+        else:
+            hierarchy = list_hierarchy()
 
-    # get all subjects
-    subject_dict = {}
-    for subject in subjects:
-        subject_dict[subject] = Subject(proj_obj, subject)
-        sub_class = subject_dict[subject]
-        # get the session objects
+    if subjects is None and hierarchy is not None:
+        subjects = list(hierarchy)
+    elif subjects is None:
+        if cache is not None:
+            subjects = cache.fetch('subjects', list_subjects)
+        else:
+            subjects = list_subjects()
+
+    conversion_queue = None
+    if opts.pipeline:
+        max_pending = opts.max_pending or 2 * opts.convert_jobs
+        conversion_queue = ConversionQueue(max(opts.convert_jobs, 1), max(max_pending, 1))
+
+    # downloads interrupted by an earlier run never made it out of staging
+    for stage in clean_staging(dest):
+        logging.info('removed unfinished download %s', stage)
+
+    watchdog = None
+    if opts.stall_window > 0:
+        watchdog = Watchdog(opts.stall_floor, opts.stall_window, opts.stall_first_byte)
+        watchdog.install(central._http)
+
+    limiter = None
+    if opts.adaptive:
+        limiter = AdaptiveLimiter(max(opts.jobs, 1))
+
+    locks = None
+    if opts.lock:
+        # shared by every run on the destination, whatever their shard
+        locks = ScanLocks(state_path(dest, 'locks'), wait=opts.lock == 'wait',
+                          lease=opts.lock_lease)
+
+    conversions = None
+    if opts.conversion_cache:
+        conversions = ConversionCache(
+            dest, state_path(dest, 'conversions{}.sqlite'.format(suffix)))
+
+    # for --no-keep-dicoms and for converting packed scans
+    scratch = ScratchSpace(opts.scratch_dir, int(opts.scratch_size * 1024 ** 3))
+
+    store = None
+    if opts.store:
+        store = ContentStore(opts.store)
+
+    manifest = None
+    if opts.manifest:
+        # a shard also finds the scans of earlier runs merged into manifest.sqlite
+        manifest = Manifest(state_path(dest, 'manifest{}.sqlite'.format(suffix)), project,
+                            shared=state_path(dest, 'manifest.sqlite') if suffix else None)
+
+    def download_one(sub_class, scan, converter=None):
+        # download the scan
         if scan_repl_dict and opts.scan_non_fmt:
-            sub_class.get_sessions(session_labels)
+            return sub_class.download_scan(scan, dest, sub_label_prefix,
+                                           scan_repl_dict, overwrite_nii=opts.overwrite_nii,
+                                           converter=converter)
         elif scan_repl_dict:
-            sub_class.get_sessions(session_labels, bids=False)
+            return sub_class.download_scan_unformatted(scan, dest, scan_repl_dict,
+                                                       bids_num_len, sub_repl_dict,
+                                                       sub_label_prefix,
+                                                       overwrite_nii=opts.overwrite_nii,
+                                                       converter=converter)
         else:
-            sub_class.get_sessions(session_labels)
-        # for every session
-        if sub_class.ses:
-            for session in sub_class.ses_dict.keys():
-                sub_class.get_scans(session, scan_labels)
-                # for each available scan
-                for scan in sub_class.scan_dict.keys():
-                    # download the scan
-                    if scan_repl_dict and opts.scan_non_fmt:
-                        sub_class.download_scan(scan, dest, sub_label_prefix,
-                                                scan_repl_dict, overwrite_nii=opts.overwrite_nii)
-                    elif scan_repl_dict:
-                        sub_class.download_scan_unformatted(scan, dest, scan_repl_dict,
-                                                            bids_num_len, sub_repl_dict,
-                                                            sub_label_prefix,
-                                                            overwrite_nii=opts.overwrite_nii)
-                    else:
-                        sub_class.download_scan(scan, dest, sub_label_prefix,
-                                                overwrite_nii=opts.overwrite_nii)
+            return sub_class.download_scan(scan, dest, sub_label_prefix,
+                                           overwrite_nii=opts.overwrite_nii,
+                                           converter=converter)
+
+    # download_scan_unformatted groups the sessions by subject
+    by_subject = bool(scan_repl_dict) and not opts.scan_non_fmt
+
+    def download_session(sub_class):
+        scans = list(sub_class.scan_dict.keys())
+        if scan_repl_dict:
+            scans = [scan for scan in scans if scan in scan_repl_dict]
+        sub_class.download_session(dest, scans, by_subject=by_subject)
+
+    def plan_entries(sub_class):
+        """describes the scans of the current session for --write-plan"""
+        dcm_outdir = sub_class.sourcedata_dir(dest, by_subject)
+        scans = [scan for scan in sub_class.scan_dict
+                 if not scan_repl_dict or scan in scan_repl_dict]
+        sizes = {}
+        if scans:
+            scan_uri = sub_class.scan_dict[scans[0]]._uri
+            try:
+                sizes = retry.call(session_file_sizes, central, scan_uri.rsplit('/scans/', 1)[0],
+                                   description='listing the files of a session')
+            except Exception as err:
+                logging.warning('could not estimate the size of %s (%s)', scan_uri, err)
+        entries = []
+        for scan in scans:
+            scan_obj = sub_class.scan_dict[scan]
+            if scan_repl_dict and not opts.scan_non_fmt:
+                target = sub_class.bids_target_unformatted(scan, scan_repl_dict, bids_num_len,
+                                                           sub_repl_dict, sub_label_prefix)
+            else:
+                target = sub_class.bids_target(scan, sub_label_prefix, scan_repl_dict)
+            bids_path = None
+            if target is not None:
+                bids_path = os.path.join(target[0], target[1] + '.nii.gz')
+            entries.append({
+                'subject': str(sub_class.label),
+                'session': scan_obj.parent().label(),
+                'scan': scan,
+                'scan_id': scan_obj.id(),
+                'uri': scan_obj._uri,
+                'dicom_dir': os.path.relpath(sub_class._dicom_dir(scan, dcm_outdir), dest),
+                'bids_path': bids_path,
+                'estimated_bytes': sizes.get(scan_obj.id()),
+                'downloaded': bool(sub_class._find_dicoms(scan, dcm_outdir)),
+                'converted': bids_path is not None and
+                os.path.exists(os.path.join(dest, bids_path)),
+            })
+        return entries
+
+    def verify(sub_class, scan, fetch=None, batch=None):
+        """checks a scan that is already in the destination"""
+        if scan_repl_dict and scan not in scan_repl_dict:
+            return []
+        dcm_outdir = sub_class.sourcedata_dir(dest, by_subject)
+        if not is_stored(sub_class._dicom_dir(scan, dcm_outdir)):
+            print('{scan} has not been downloaded, not verifying'.format(scan=scan))
+            return []
+        sub_class.verify_scan(scan, dcm_outdir)
+        return []
+
+    def download(sub_class, scan, fetch=None, batch=None):
+        """returns the conversions that were queued for the scan"""
+        if fetch is not None:
+            # the session archive was submitted before this scan, so it is
+            # already running (or done) by the time a worker gets here
+            err = fetch.exception()
+            if err is not None:
+                # download_scan fetches the scan by itself when it finds no dicoms
+                logging.warning('session download failed (%s), '
+                                'downloading %s on its own', err, scan)
+
+        if batch is not None:
+            return download_batched(sub_class, scan, batch)
+
+        if conversion_queue is None:
+            download_one(sub_class, scan)
+            return []
+
+        conversions = []
+
+        def queue_conversion(*args):
+            conversions.append(conversion_queue.submit(*args))
+
+        conversion_queue.reserve()
+        try:
+            download_one(sub_class, scan, queue_conversion)
+        finally:
+            if not conversions:
+                conversion_queue.release()
+        return conversions
+
+    def download_batched(sub_class, scan, batch):
+        """downloads a scan, and converts its session if it was the last scan of it"""
+        failure = None
+        try:
+            download_one(sub_class, scan, batch.add)
+        except Exception as err:
+            # the other scans of the session are still converted
+            failure = err
+        conversions = batch.done()
+        queued = []
+        if conversions and conversion_queue is None:
+            sub_class.convert_batch(conversions)
+        elif conversions:
+            conversion_queue.reserve()
+            queued.append(conversion_queue.submit(sub_class.convert_batch, conversions))
+        if failure is not None:
+            raise failure
+        return queued
+
+    # get all subjects
+    subject_dict = {}
+    futures = {}
+    plan_rows = []
+    plan_sessions = {}
+    with ThreadPoolExecutor(max_workers=max(opts.jobs, 1)) as executor:
+        for subject in subjects:
+            sessions = None
+            if hierarchy is not None:
+                # subjects missing from the listing fall back to their own requests
+                sessions = hierarchy.get(subject)
+            subject_dict[subject] = Subject(proj_obj, subject,
+                                            TRANSFERS[opts.transfer](**transfer_options),
+                                            manifest, verify=opts.verify, cache=cache,
+                                            sessions=sessions, retry=retry,
+                                            limiter=limiter, watchdog=watchdog,
+                                            locks=locks, conversions=conversions,
+                                            scratch=scratch, keep_dicoms=opts.keep_dicoms,
+                                            pack=opts.pack_dicoms, store=store)
+            sub_class = subject_dict[subject]
+            # get the session objects
+            if scan_repl_dict and opts.scan_non_fmt:
+                sub_class.get_sessions(session_labels)
+            elif scan_repl_dict:
+                sub_class.get_sessions(session_labels, bids=False)
+            else:
+                sub_class.get_sessions(session_labels)
+            # for every session
+            if sub_class.ses:
+                plan_sessions[str(subject)] = [ses_obj.attrs.get('label')
+                                               for ses_obj in sub_class.ses_objs]
+                for session in sub_class.ses_dict.keys():
+                    ses_label = sub_class.ses_dict[session].attrs.get('label')
+                    if changed is not None and ses_label not in changed[str(subject)]:
+                        continue
+                    sub_class.get_scans(session, scan_labels)
+                    # get_scans overwrites scan_dict, so queued downloads
+                    # hold on to a copy made for this session
+                    ses_class = copy(sub_class)
+                    if planned is not None:
+                        ses_class.scan_dict = {
+                            scan: scan_obj for scan, scan_obj in ses_class.scan_dict.items()
+                            if (str(subject), ses_label, scan) in planned}
+                    elif opts.shard is not None:
+                        ses_class.scan_dict = {
+                            scan: scan_obj for scan, scan_obj in ses_class.scan_dict.items()
+                            if shard_of(subject, ses_label, scan,
+                                        opts.shard[1]) == opts.shard[0]}
+                    if opts.write_plan:
+                        plan_rows.extend(plan_entries(ses_class))
+                        continue
+                    fetch = None
+                    if opts.bulk_session and not opts.verify_only:
+                        fetch = executor.submit(download_session, ses_class)
+                    batch = None
+                    if opts.batch_convert and not opts.verify_only:
+                        batch = ConversionBatch(len(ses_class.scan_dict))
+                    # for each available scan
+                    for scan in ses_class.scan_dict.keys():
+                        future = executor.submit(verify if opts.verify_only else download,
+                                                 ses_class, scan, fetch, batch)
+                        futures[future] = (subject, session, scan)
+
+        results = []
+        for future in as_completed(futures):
+            subject, session, scan = futures[future]
+            try:
+                for conversion in future.result():
+                    conversion.result()
+            except Exception as err:
+                logging.exception('%s %s %s failed', subject, session, scan)
+                results.append((subject, session, scan, err))
+            else:
+                results.append((subject, session, scan, None))
+
+    if conversion_queue is not None:
+        conversion_queue.shutdown()
+    if manifest is not None:
+        manifest.close()
+    if conversions is not None:
+        conversions.close()
+    if cache is not None:
+        cache.close()
+    if limiter is not None:
+        summary = limiter.report()
+        print('concurrent downloads: {final} at the end, between {min} and {max} '
+              '({mean:.1f} on average)'.format(**summary))
+        logging.info('concurrent downloads over time: %s', limiter.history)
+    if watchdog is not None:
+        watchdog.close()
+        for host, count in sorted(watchdog.stalls.items()):
+            print('{n} stalled download(s) from {host} were aborted'.format(n=count, host=host))
+            logging.warning('%d stalled download(s) from %s were aborted', count, host)
+
+    if opts.write_plan:
+        totals = write_plan(opts.write_plan, input_dict,
+                            {'scan_non_fmt': opts.scan_non_fmt},
+                            plan_rows, plan_sessions)['totals']
+        print('plan written to {path}: {scans} scan(s), {downloads} to download '
+              '({bytes} bytes), {conversions} to convert'.format(path=opts.write_plan, **totals))
+        return None
+
+    if report_results(results):
+        return 1
+
+    if changed is not None and newest is not None:
+        # only advance once every changed session made it
+        save_mark(mark_file, project, newest)
 
 
 if __name__ == "__main__":
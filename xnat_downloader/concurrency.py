@@ -0,0 +1,204 @@
+"""Adjusting the number of concurrent downloads to what xnat can handle."""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from xnat_downloader.retry import is_retryable
+
+
+class Slot:
+    """
+    A download running under an AdaptiveLimiter
+
+    Attributes
+    ----------
+    start: float
+        when the download started (limiter clock)
+    nbytes: int | None
+        size of what was downloaded, set by the caller once it is known
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.nbytes = None
+
+
+class AdaptiveLimiter:
+    """
+    Limits the number of downloads running at once, adjusting the limit
+    with additive increase / multiplicative decrease (AIMD)
+
+    The limit starts low and grows with every download that finishes,
+    quickly at first (one more slot per download) and by about one slot
+    per round of downloads once xnat pushed back. It is cut by ``decrease``
+    when a download fails with an error that signals an overloaded server
+    (see xnat_downloader.retry.is_retryable) or when the throughput of a
+    download falls below ``slowdown`` times the best recent throughput,
+    since more parallel requests are then only making each of them slower.
+
+    Attributes
+    ----------
+    ceiling: int
+        the limit never exceeds this (the number of download threads)
+    floor: int
+        the limit never goes below this
+    limit: float
+        the current number of downloads allowed at once
+    history: list
+        (seconds since the start, limit) every time the whole number of
+        allowed downloads changed
+    """
+
+    def __init__(self, ceiling, initial=1, floor=1, decrease=0.5, slowdown=0.5,
+                 smoothing=0.3, clock=time.monotonic):
+        """
+        Parameters
+        ----------
+        ceiling: int
+            most downloads allowed at once
+        initial: int
+            downloads allowed at once before anything was measured
+        floor: int
+            fewest downloads allowed at once
+        decrease: float
+            factor the limit is multiplied by when xnat struggles
+        slowdown: float
+            fraction of the best throughput below which xnat is struggling
+        smoothing: float
+            weight of the newest download in the average throughput
+        clock: callable
+            returns the current time in seconds
+        """
+        self.ceiling = max(ceiling, 1)
+        self.floor = max(min(floor, self.ceiling), 1)
+        self.limit = float(min(max(initial, self.floor), self.ceiling))
+        self.decrease = decrease
+        self.slowdown = slowdown
+        self.smoothing = smoothing
+        self._clock = clock
+        self._started = clock()
+        # grow by a slot per download until the first sign of trouble
+        self._threshold = self.ceiling
+        self._last_decrease = None
+        self._rate = None
+        self._best_rate = None
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self.history = [(0.0, int(self.limit))]
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def acquire(self):
+        """Blocks until another download may start and returns its Slot"""
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+            return Slot(self._clock())
+
+    def release(self, slot, failed=False):
+        """
+        Ends a download and adjusts the limit to how it went
+
+        Parameters
+        ----------
+        slot: Slot
+            returned by acquire
+        failed: bool
+            the download failed because xnat is overloaded or unreachable
+        """
+        with self._condition:
+            self._in_flight -= 1
+            elapsed = self._clock() - slot.start
+            if failed:
+                self._decrease(slot)
+            elif slot.nbytes and elapsed > 0 and self._slower(slot.nbytes / elapsed):
+                self._decrease(slot)
+            else:
+                self._increase()
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """
+        Runs the body of a with block as one download
+
+        Errors are passed on; the ones that point at an overloaded server
+        lower the limit, the others leave it as it was.
+        """
+        slot = self.acquire()
+        try:
+            yield slot
+        except Exception as err:
+            if is_retryable(err):
+                self.release(slot, failed=True)
+            else:
+                with self._condition:
+                    self._in_flight -= 1
+                    self._condition.notify_all()
+            raise
+        else:
+            self.release(slot)
+
+    def _slower(self, rate):
+        """Adds a throughput measurement, True if it is well below the best"""
+        if self._rate is None:
+            self._rate = rate
+        else:
+            self._rate = self.smoothing * rate + (1 - self.smoothing) * self._rate
+        # let the best throughput fade, so a server that got slower for good
+        # does not keep the limit at the floor
+        if self._best_rate is None:
+            self._best_rate = self._rate
+        else:
+            self._best_rate = max(self._rate, 0.99 * self._best_rate)
+        return self._rate < self.slowdown * self._best_rate
+
+    def _increase(self):
+        if self.limit < self._threshold:
+            limit = self.limit + 1
+        else:
+            limit = self.limit + 1 / self.limit
+        self._set_limit(min(limit, self.ceiling))
+
+    def _decrease(self, slot):
+        # downloads that started before the last decrease saw the same
+        # trouble, so they do not cut the limit again
+        if self._last_decrease is not None and slot.start < self._last_decrease:
+            return
+        self._last_decrease = self._clock()
+        limit = max(self.limit * self.decrease, self.floor)
+        self._threshold = max(limit, self.floor)
+        # the throughput measured with more downloads no longer applies
+        self._rate = None
+        self._set_limit(limit)
+
+    def _set_limit(self, limit):
+        changed = int(limit) != int(self.limit)
+        self.limit = limit
+        if changed:
+            self.history.append((self._clock() - self._started, int(limit)))
+            logging.info('concurrent downloads: %d', int(limit))
+
+    def report(self):
+        """
+        Summarizes the limit over the run
+
+        Returns
+        -------
+        summary: dict
+            'final', 'min' and 'max' number of downloads allowed at once, and
+            the 'mean' limit weighted by how long it was in place
+        """
+        with self._condition:
+            history = list(self.history)
+            now = self._clock() - self._started
+        limits = [limit for _, limit in history]
+        weighted = 0.0
+        for (start, limit), (end, _) in zip(history, history[1:] + [(now, None)]):
+            weighted += limit * (end - start)
+        mean = weighted / now if now > 0 else limits[-1]
+        return {'final': limits[-1], 'min': min(limits), 'max': max(limits), 'mean': mean}
@@ -0,0 +1,184 @@
+"""Remembering what dcm2niix made from which dicoms, to only convert again when needed."""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import threading
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from xnat_downloader.manifest import file_md5
+from xnat_downloader.packing import archive_index, archive_path, is_packed
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversions (
+    bids_dir TEXT NOT NULL,
+    fname TEXT NOT NULL,
+    input_digest TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    outputs TEXT NOT NULL,
+    converted_at TEXT,
+    PRIMARY KEY (bids_dir, fname)
+);
+CREATE TABLE IF NOT EXISTS digests (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    md5 TEXT NOT NULL
+);
+"""
+
+
+@lru_cache(maxsize=None)
+def dcm2niix_version():
+    """The version dcm2niix reports (e.g. v1.0.20230411), 'unknown' if it does not run"""
+    try:
+        result = subprocess.run(['dcm2niix', '--version'], stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, universal_newlines=True)
+    except OSError:
+        return 'unknown'
+    match = re.search(r'v\d+\.\d+\.\d+\w*', result.stdout)
+    return match.group(0) if match else 'unknown'
+
+
+class ConversionCache:
+    """
+    sqlite database of the conversions done in a destination, keyed by the
+    bids files they produced
+
+    Each conversion is stored with a digest of the dicoms it read and the
+    dcm2niix settings (version and options) it ran with, and lists every
+    file it wrote, including the ones dcm2niix names itself (e.g. the
+    _e1/_e2 files of a multi-echo scan). A scan is converted again when
+    its dicoms or the settings changed; when only some outputs went missing
+    they can be put back from a fresh conversion without touching the rest.
+
+    Attributes
+    ----------
+    root: string
+        the destination the bids directories are relative to
+    path: string
+        location of the sqlite database
+    """
+
+    def __init__(self, root, path):
+        self.root = root
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+
+    def _key(self, bids_dir, fname):
+        return os.path.relpath(bids_dir, self.root), fname
+
+    def input_digest(self, dcm_dir):
+        """
+        Digest of the names and contents of the files in dcm_dir
+
+        The md5 of each file in the destination is kept with its size and
+        modification time, so files that did not change since the last run
+        are not read again. A packed scan gets the same digest as its
+        directory had, from the md5s in the index of its archive.
+        """
+        if is_packed(dcm_dir):
+            index = archive_index(archive_path(dcm_dir))
+            if all(md5 is not None for _, md5 in index.values()):
+                digest = hashlib.sha256()
+                for name in sorted(index):
+                    digest.update('{} {}\n'.format(index[name][1], name).encode())
+                return digest.hexdigest()
+            # an archive without md5s (not written by pack_scan)
+            return hashlib.sha256(self._file_md5(archive_path(dcm_dir)).encode()).hexdigest()
+        names = sorted(os.path.relpath(os.path.join(root, filename), dcm_dir)
+                       for root, _, filenames in os.walk(dcm_dir)
+                       for filename in filenames)
+        digest = hashlib.sha256()
+        for name in names:
+            digest.update('{} {}\n'.format(self._file_md5(os.path.join(dcm_dir, name)),
+                                           name).encode())
+        return digest.hexdigest()
+
+    def _file_md5(self, path):
+        path = os.path.abspath(path)
+        if os.path.relpath(path, os.path.abspath(self.root)).startswith(os.pardir):
+            # e.g. in scratch, where the next run will not find it
+            return file_md5(path)
+        stat = os.stat(path)
+        with self._lock:
+            row = self._conn.execute('SELECT size, mtime_ns, md5 FROM digests WHERE path=?',
+                                     (path,)).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            return row[2]
+        md5 = file_md5(path)
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)',
+                               (path, stat.st_size, stat.st_mtime_ns, md5))
+        return md5
+
+    def get(self, bids_dir, fname):
+        """The recorded conversion to bids_dir/fname as a dictionary (None if missing)"""
+        with self._lock:
+            cursor = self._conn.execute(
+                'SELECT * FROM conversions WHERE bids_dir=? AND fname=?',
+                self._key(bids_dir, fname))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            record = dict(zip([col[0] for col in cursor.description], row))
+        record['outputs'] = json.loads(record['outputs'])
+        return record
+
+    def missing(self, bids_dir, fname, input_digest, settings):
+        """
+        Checks a conversion against the cache
+
+        Parameters
+        ----------
+        input_digest: string | None
+            see input_digest, None to trust the recorded conversion without
+            looking at the dicoms (e.g. when they are not kept)
+        settings: string
+            the dcm2niix version and options
+
+        Returns
+        -------
+        missing: list | None
+            the names of the recorded outputs that are gone or changed size
+            (empty if the conversion is complete), None if the scan was
+            never converted from these dicoms with these settings
+        """
+        record = self.get(bids_dir, fname)
+        if record is None or record['settings'] != settings or \
+                input_digest not in (None, record['input_digest']):
+            return None
+        missing = []
+        for name, size in record['outputs']:
+            path = os.path.join(bids_dir, name)
+            if not os.path.isfile(path) or os.path.getsize(path) != size:
+                missing.append(name)
+        return missing
+
+    def record(self, bids_dir, fname, input_digest, settings, outputs):
+        """
+        Stores a conversion
+
+        Parameters
+        ----------
+        outputs: list
+            the names of the files the conversion wrote in bids_dir
+        """
+        sizes = [(name, os.path.getsize(os.path.join(bids_dir, name)))
+                 for name in sorted(outputs)]
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO conversions VALUES (?, ?, ?, ?, ?, ?)',
+                self._key(bids_dir, fname) + (input_digest, settings, json.dumps(sizes),
+                                              datetime.now(timezone.utc).isoformat()))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,50 @@
+"""Listing a whole project's subjects, sessions and scans in bulk."""
+
+SESSION_TYPE = 'xnat:subjectAssessorData'
+IMAGE_SESSION_TYPE = 'xnat:imageSessionData'
+SCAN_TYPE = 'xnat:imageScanData'
+
+
+def fetch_hierarchy(intf, project):
+    """
+    Lists every subject, session and scan of a project with two search
+    queries (instead of one request per subject and per session)
+
+    Parameters
+    ----------
+    intf: object
+        the pyxnat Interface
+    project: string
+        project ID on xnat
+
+    Returns
+    -------
+    hierarchy: dict
+        {subject label: {session label: [scan, ...]}} where each scan is a
+        dictionary with the scan 'ID', its 'type' and the number of
+        'frames' xnat recorded (None if unknown)
+    """
+    hierarchy = {}
+    # every experiment, so sessions without scans still count when
+    # session_labels are matched to sessions in date order
+    sessions = intf.array.experiments(project_id=project,
+                                      experiment_type=SESSION_TYPE,
+                                      columns=['label', 'subject_label'])
+    for row in sessions:
+        hierarchy.setdefault(row['subject_label'], {}).setdefault(row['label'], [])
+
+    scan_type = SCAN_TYPE.lower()
+    scans = intf.array.scans(project_id=project,
+                             experiment_type=IMAGE_SESSION_TYPE,
+                             scan_type=SCAN_TYPE,
+                             columns=['label', 'subject_label',
+                                      SCAN_TYPE + '/type', SCAN_TYPE + '/frames'])
+    for row in scans:
+        frames = row.get(scan_type + '/frames')
+        session = hierarchy.setdefault(row['subject_label'], {})
+        session.setdefault(row['label'], []).append({
+            'ID': row[scan_type + '/id'],
+            'type': row[scan_type + '/type'],
+            'frames': int(frames) if frames not in (None, '') else None,
+        })
+    return hierarchy
@@ -0,0 +1,117 @@
+"""Finding the sessions that changed on xnat since the last run."""
+import json
+import os
+from datetime import datetime, timedelta
+
+from xnat_downloader.hierarchy import SESSION_TYPE
+
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+# the experiment columns that tell when a session was added or last modified
+DATE_COLUMNS = ('insert_date', 'last_modified')
+COLUMNS = ('label', 'subject_label') + DATE_COLUMNS
+
+
+def parse_date(value):
+    """Reads a date as xnat reports it (None if it is empty or unreadable)"""
+    if not value:
+        return None
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def load_mark(path, project):
+    """Returns the newest session date seen for a project (None on the first run)"""
+    if not os.path.exists(path):
+        return None
+    with open(path) as mark_file:
+        marks = json.load(mark_file)
+    mark = marks.get(project)
+    return datetime.fromisoformat(mark) if mark else None
+
+
+def save_mark(path, project, mark):
+    """Stores the newest session date of a project (replacing the file atomically)"""
+    marks = {}
+    if os.path.exists(path):
+        with open(path) as mark_file:
+            marks = json.load(mark_file)
+    marks[project] = mark.isoformat()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as mark_file:
+        json.dump(marks, mark_file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _experiments_since(intf, project, since):
+    """
+    Lists the experiments of a project inserted or modified since the day
+    of a date, leaving the filtering to xnat
+
+    xnat compares dates by the day, so the rows may start a little before
+    since (each date column is filtered on its own, as either may be empty).
+    """
+    # a range, as xnat filters date columns with first-last
+    days = '{:%m/%d/%Y}-{:%m/%d/%Y}'.format(since, datetime.now() + timedelta(days=1))
+    rows = {}
+    for column in DATE_COLUMNS:
+        # the listing intf.array.experiments requests, with a filter
+        response = intf.get('/data/experiments?xsiType={type}&project={project}&format=json'
+                            '&columns=ID,{columns}&{column}={days}'.format(
+                                type=SESSION_TYPE, project=project, columns=','.join(COLUMNS),
+                                column=column, days=days))
+        try:
+            response.raise_for_status()
+            for row in response.json()['ResultSet']['Result']:
+                rows[(row['subject_label'], row['label'])] = row
+        finally:
+            response.close()
+    return list(rows.values())
+
+
+def changed_sessions(intf, project, since=None):
+    """
+    Lists the sessions added or modified after a given date
+
+    The first run lists all of the project's experiments with their dates
+    in a single request; later runs only ask xnat for the experiments
+    dated on or after the day of the mark (see _experiments_since), so
+    neither depends on the number of subjects.
+
+    Parameters
+    ----------
+    intf: object
+        the pyxnat Interface
+    project: string
+        project ID on xnat
+    since: datetime | None
+        the mark of the previous run (every session is changed if None)
+
+    Returns
+    -------
+    changed: dict
+        subject labels matched with the set of their changed session labels
+    newest: datetime | None
+        the latest date of any changed session (the next mark)
+    """
+    if since is None:
+        rows = intf.array.experiments(project_id=project, experiment_type=SESSION_TYPE,
+                                      columns=list(COLUMNS))
+    else:
+        rows = _experiments_since(intf, project, since)
+    changed = {}
+    newest = since
+    for row in rows:
+        dates = [date for date in (parse_date(row.get(column)) for column in DATE_COLUMNS)
+                 if date is not None]
+        date = max(dates) if dates else None
+        if date is not None and (newest is None or date > newest):
+            newest = date
+        # sessions xnat lists without dates are always processed
+        if since is None or date is None or date > since:
+            changed.setdefault(row['subject_label'], set()).add(row['label'])
+    return changed, newest
@@ -0,0 +1,193 @@
+"""Keeping processes that share a destination from working on the same scan."""
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+class LeaseLock:
+    """
+    A lock file that is safe on NFS and expires when its holder dies
+
+    The lock is taken by hard linking a file unique to the holder to the
+    lock's path; link is atomic on NFS (unlike O_EXCL on old clients) and
+    the link count of the unique file tells whether it worked even when
+    the server's reply got lost. While held, a thread refreshes the
+    lock's modification time every third of the lease. A lock that was
+    not refreshed for a whole lease is stale and taken over, so a crashed
+    process blocks a scan for at most one lease.
+
+    Attributes
+    ----------
+    path: string
+        the lock file
+    lease: float
+        seconds after which a lock that was not refreshed is stale (keep it
+        well above the clock difference between the machines)
+    """
+
+    def __init__(self, path, lease=300, poll=1.0):
+        self.path = path
+        self.lease = lease
+        self.poll = poll
+        self._token = None
+        self._released = threading.Event()
+        self._heartbeat = None
+
+    @staticmethod
+    def _read(path):
+        """The holder written in a lock file (empty if it cannot be read)"""
+        try:
+            with open(path) as lock_file:
+                return json.load(lock_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _owner(self):
+        owner = self._read(self.path)
+        if 'host' not in owner:
+            return 'another process'
+        return '{host}:{pid}'.format(**owner)
+
+    def acquire(self, wait=True):
+        """
+        Takes the lock
+
+        Parameters
+        ----------
+        wait: bool
+            wait for the holder to release the lock (or for it to go
+            stale) instead of giving up at once
+
+        Returns
+        -------
+        acquired: bool
+            False if the lock is held by someone else and wait is False
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        token = uuid.uuid4().hex
+        unique = '{}.{}'.format(self.path, token)
+        with open(unique, 'w') as unique_file:
+            json.dump({'host': socket.gethostname(), 'pid': os.getpid(),
+                       'acquired': time.time(), 'token': token}, unique_file)
+        try:
+            while True:
+                try:
+                    os.link(unique, self.path)
+                except OSError:
+                    pass
+                if os.stat(unique).st_nlink == 2:
+                    self._token = token
+                    break
+                if self._break_stale():
+                    continue
+                if not wait:
+                    return False
+                time.sleep(self.poll)
+        finally:
+            os.remove(unique)
+        self._released.clear()
+        self._heartbeat = threading.Thread(target=self._refresh, daemon=True,
+                                           name='lease-' + os.path.basename(self.path))
+        self._heartbeat.start()
+        return True
+
+    def _break_stale(self):
+        """Removes the lock if its holder stopped refreshing it (True if it is gone)"""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return True
+        if time.time() - mtime < self.lease:
+            return False
+        token = self._read(self.path).get('token')
+        # renaming is atomic, so only one of the processes waiting breaks it
+        stale = '{}.stale.{}'.format(self.path, uuid.uuid4().hex)
+        try:
+            os.rename(self.path, stale)
+        except FileNotFoundError:
+            return True
+        if self._read(stale).get('token') != token:
+            # someone broke and took the lock since it was looked at: give it back
+            try:
+                os.link(stale, self.path)
+            except OSError:
+                pass
+        else:
+            logging.warning('took over %s, its holder stopped refreshing it', self.path)
+        os.remove(stale)
+        return True
+
+    def _refresh(self):
+        while not self._released.wait(self.lease / 3):
+            try:
+                if self._read(self.path).get('token') != self._token:
+                    raise FileNotFoundError(self.path)
+                os.utime(self.path)
+            except FileNotFoundError:
+                logging.warning('lost %s to another process', self.path)
+                return
+
+    def release(self):
+        """Gives the lock up"""
+        self._released.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        if self._token is not None and self._read(self.path).get('token') == self._token:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+        self._token = None
+
+
+class ScanLocks:
+    """
+    One LeaseLock per scan in a directory shared by every process working
+    on a destination
+
+    Attributes
+    ----------
+    root: string
+        directory of the lock files
+    wait: bool
+        wait for scans other processes hold (instead of skipping them)
+    lease: float
+        see LeaseLock
+    """
+
+    def __init__(self, root, wait=True, lease=300, poll=1.0):
+        self.root = root
+        self.wait = wait
+        self.lease = lease
+        self.poll = poll
+
+    def path(self, key):
+        """The lock file of a key such as subject/session/scan id"""
+        return os.path.join(self.root, re.sub(r'[^\w.-]', '_', key) + '.lock')
+
+    @contextmanager
+    def hold(self, key, wait=None):
+        """
+        Holds the lock of key for the body of a with block
+
+        Yields
+        ------
+        held: bool
+            False if another process holds the key and not waiting for it
+        """
+        lock = LeaseLock(self.path(key), self.lease, self.poll)
+        if not lock.acquire(self.wait if wait is None else wait):
+            logging.info('%s is held by %s', key, lock._owner())
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            lock.release()
@@ -0,0 +1,286 @@
+"""Durable record of the scans that have been downloaded and converted."""
+import hashlib
+import json
+import os
+from glob import glob
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+from xnat_downloader.packing import archive_index, archive_path, is_packed
+
+# bookkeeping kept next to the BIDS dataset (hidden so BIDS tools skip it)
+STATE_DIR = '.xnat_downloader'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    project TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    session TEXT NOT NULL,
+    scan_id TEXT NOT NULL,
+    scan_type TEXT,
+    dcm_dir TEXT,
+    file_count INTEGER,
+    byte_count INTEGER,
+    checksum TEXT,
+    outputs TEXT,
+    downloaded_at TEXT,
+    converted_at TEXT,
+    PRIMARY KEY (project, subject, session, scan_id)
+);
+CREATE TABLE IF NOT EXISTS files (
+    project TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    session TEXT NOT NULL,
+    scan_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER,
+    md5 TEXT,
+    PRIMARY KEY (project, subject, session, scan_id, name)
+);
+"""
+
+
+def state_path(dest, *parts):
+    """Returns a path inside the bookkeeping directory of a destination"""
+    return os.path.join(dest, STATE_DIR, *parts)
+
+
+def file_md5(path, chunk_size=1024 * 1024):
+    """md5 hex digest of a file (the digest xnat keeps in its catalogs)"""
+    digest = hashlib.md5()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan_files(dcm_dir):
+    """
+    Lists the files of a downloaded scan
+
+    Returns
+    -------
+    files: list
+        (name relative to dcm_dir, size in bytes, md5) tuples sorted by name
+        (taken from the index of the archive of a packed scan)
+    """
+    if is_packed(dcm_dir):
+        return sorted((name, size, md5)
+                      for name, (size, md5) in archive_index(archive_path(dcm_dir)).items())
+    files = []
+    for root, _, filenames in os.walk(dcm_dir):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            files.append((os.path.relpath(path, dcm_dir),
+                          os.path.getsize(path),
+                          file_md5(path)))
+    return sorted(files)
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class Manifest:
+    """
+    sqlite database recording every scan that finished downloading
+
+    A scan is only written once all of its files are on disk, so a scan
+    without a row was interrupted (or never started) and is downloaded again.
+
+    Attributes
+    ----------
+    path: string
+        location of the sqlite database
+    project: string
+        the xnat project the recorded scans belong to
+    shared: string | None
+        location of a manifest that is only read, for the scans this one
+        has no record of
+    """
+
+    def __init__(self, path, project, shared=None):
+        """
+        Parameters
+        ----------
+        path: string
+            location of the sqlite database (created if it does not exist)
+        project: string
+            project ID on xnat
+        shared: string | None
+            location of a manifest to look scans up in as well, e.g. the
+            manifest.sqlite the shard manifests of earlier cluster runs
+            were merged into, for the manifest of a shard
+        """
+        self.path = path
+        self.project = project
+        self.shared = shared
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        # one connection shared by the download threads, guarded by _lock
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+        self._shared = None
+        if shared is not None and os.path.exists(shared):
+            self._shared = sqlite3.connect(
+                'file:{}?mode=ro'.format(quote(os.path.abspath(shared))), uri=True, timeout=60,
+                check_same_thread=False)
+
+    def _connections(self):
+        """The connections to look a scan up in, this manifest's first"""
+        return [self._conn] if self._shared is None else [self._conn, self._shared]
+
+    def get(self, subject, session, scan_id):
+        """Returns the recorded row of a scan as a dictionary (None if missing)"""
+        with self._lock:
+            for conn in self._connections():
+                cursor = conn.execute(
+                    'SELECT * FROM scans '
+                    'WHERE project=? AND subject=? AND session=? AND scan_id=?',
+                    (self.project, subject, session, scan_id))
+                row = cursor.fetchone()
+                if row is not None:
+                    break
+            else:
+                return None
+            record = dict(zip([col[0] for col in cursor.description], row))
+        record['outputs'] = json.loads(record['outputs']) if record['outputs'] else []
+        return record
+
+    def is_complete(self, subject, session, scan_id):
+        """True if every file of the scan was recorded as downloaded"""
+        return self.get(subject, session, scan_id) is not None
+
+    def files(self, subject, session, scan_id):
+        """Returns the (name, size, md5) of each recorded file of a scan"""
+        with self._lock:
+            for conn in self._connections():
+                files = conn.execute(
+                    'SELECT name, size, md5 FROM files '
+                    'WHERE project=? AND subject=? AND session=? AND scan_id=? ORDER BY name',
+                    (self.project, subject, session, scan_id)).fetchall()
+                if files:
+                    break
+            return files
+
+    def _adopt(self, key):
+        """Copies the records of a scan only the shared manifest has into this one"""
+        where = 'WHERE project=? AND subject=? AND session=? AND scan_id=?'
+        if self._shared is None or self._conn.execute(
+                'SELECT 1 FROM scans ' + where, key).fetchone() is not None:
+            return
+        for table in ('files', 'scans'):
+            rows = self._shared.execute('SELECT * FROM {} {}'.format(table, where),
+                                        key).fetchall()
+            if rows:
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO {} VALUES ({})'.format(
+                        table, ', '.join('?' * len(rows[0]))), rows)
+
+    def record_download(self, subject, session, scan_id, scan_type, dcm_dir, files=None):
+        """
+        Records a finished download, replacing any earlier record of the scan
+
+        Parameters
+        ----------
+        subject: string
+            subject label on xnat
+        session: string
+            session label on xnat
+        scan_id: string
+            the number id given to the scan on xnat
+        scan_type: string
+            the scan type on xnat (e.g. anat-T1w)
+        dcm_dir: string
+            the directory holding the scan's files
+        files: list | None
+            (name, size, md5) of the files, read from dcm_dir if None
+        """
+        if files is None:
+            files = scan_files(dcm_dir)
+        checksum = hashlib.md5(
+            ''.join('{} {}\n'.format(md5, name) for name, _, md5 in files).encode()
+        ).hexdigest()
+        key = (self.project, subject, session, scan_id)
+        with self._lock, self._conn:
+            self._conn.execute(
+                'DELETE FROM files WHERE project=? AND subject=? AND session=? AND scan_id=?',
+                key)
+            self._conn.executemany(
+                'INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [key + tuple(entry) for entry in files])
+            self._conn.execute(
+                'INSERT OR REPLACE INTO scans VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                key + (scan_type, dcm_dir, len(files), sum(size for _, size, _ in files),
+                       checksum, None, _now(), None))
+
+    def record_conversion(self, subject, session, scan_id, outputs):
+        """Stores the files dcm2niix produced for a recorded scan"""
+        with self._lock, self._conn:
+            # kept with the scan's other records in this manifest
+            self._adopt((self.project, subject, session, scan_id))
+            self._conn.execute(
+                'UPDATE scans SET outputs=?, converted_at=? '
+                'WHERE project=? AND subject=? AND session=? AND scan_id=?',
+                (json.dumps(sorted(outputs)), _now(), self.project, subject, session, scan_id))
+
+    def forget(self, subject, session, scan_id):
+        """Removes a scan so the next run downloads it again"""
+        key = (self.project, subject, session, scan_id)
+        with self._lock, self._conn:
+            for table in ('files', 'scans'):
+                self._conn.execute(
+                    'DELETE FROM {} WHERE project=? AND subject=? AND session=? AND scan_id=?'
+                    .format(table), key)
+
+    def merge(self, path):
+        """
+        Copies every record of another manifest (e.g. one written by a
+        shard of a cluster run) into this one, replacing records of the
+        same scans
+        """
+        with self._lock:
+            self._conn.execute('ATTACH DATABASE ? AS other', (path,))
+            try:
+                with self._conn:
+                    for table in ('scans', 'files'):
+                        self._conn.execute(
+                            'INSERT OR REPLACE INTO {table} SELECT * FROM other.{table}'
+                            .format(table=table))
+            finally:
+                self._conn.execute('DETACH DATABASE other')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+            if self._shared is not None:
+                self._shared.close()
+
+
+def merge_shard_manifests(dest, project):
+    """
+    Merges the manifests the shards of a cluster run wrote in a destination
+    (manifest.shard-K-of-N.sqlite) into its manifest.sqlite, the one runs
+    without --shard use, and removes them
+
+    Returns
+    -------
+    merged: list
+        paths of the shard manifests that were merged
+    """
+    merged = sorted(glob(state_path(dest, 'manifest.shard-*-of-*.sqlite')))
+    if not merged:
+        return merged
+    manifest = Manifest(state_path(dest, 'manifest.sqlite'), project)
+    try:
+        for path in merged:
+            manifest.merge(path)
+    finally:
+        manifest.close()
+    # only once every record is in manifest.sqlite
+    for path in merged:
+        os.remove(path)
+    return merged
@@ -0,0 +1,119 @@
+"""Storing the dicoms of a scan as a single archive instead of thousands of files."""
+import hashlib
+import os
+import shutil
+import zipfile
+
+ARCHIVE_SUFFIX = '.zip'
+
+
+def archive_path(dcm_dir):
+    """The archive a scan directory is packed into (<id>-<type>.zip next to it)"""
+    return dcm_dir.rstrip(os.sep) + ARCHIVE_SUFFIX
+
+
+def _packing_dir(dcm_dir):
+    """Where a scan directory is moved while its archive is put in place"""
+    return dcm_dir.rstrip(os.sep) + '.packing'
+
+
+def _recover(dcm_dir):
+    """
+    Cleans up after a pack_scan that was interrupted: the moved directory
+    is removed once the archive is in place, and moved back otherwise
+    """
+    packing = _packing_dir(dcm_dir)
+    if not os.path.isdir(packing):
+        return
+    if os.path.isfile(archive_path(dcm_dir)):
+        shutil.rmtree(packing, ignore_errors=True)
+    elif not os.path.exists(dcm_dir):
+        os.rename(packing, dcm_dir)
+
+
+def is_packed(dcm_dir):
+    """True if the scan is stored as an archive (whether or not a directory is left next to it)"""
+    _recover(dcm_dir)
+    return os.path.isfile(archive_path(dcm_dir))
+
+
+def is_stored(dcm_dir):
+    """True if the scan is on disk, as a directory or packed"""
+    _recover(dcm_dir)
+    return os.path.isdir(dcm_dir) or os.path.isfile(archive_path(dcm_dir))
+
+
+def pack_scan(dcm_dir, compression=zipfile.ZIP_DEFLATED):
+    """
+    Replaces a scan directory by a zip archive of its files
+
+    The md5 of every file is kept in the comment of its entry, so the
+    central directory of the archive lists the name, size and md5 of the
+    files without reading them (see archive_index).
+
+    The directory is moved aside before the archive is put in place and
+    removed afterwards, so an interrupted run leaves either the directory
+    or the archive whole (see is_packed).
+
+    Returns
+    -------
+    archive: string
+        path of the archive
+    """
+    archive = archive_path(dcm_dir)
+    names = sorted(os.path.relpath(os.path.join(root, filename), dcm_dir)
+                   for root, _, filenames in os.walk(dcm_dir)
+                   for filename in filenames)
+    tmp_archive = archive + '.tmp'
+    with zipfile.ZipFile(tmp_archive, 'w', compression) as zf:
+        for name in names:
+            path = os.path.join(dcm_dir, name)
+            info = zipfile.ZipInfo.from_file(path, name)
+            info.compress_type = compression
+            digest = hashlib.md5()
+            with open(path, 'rb') as src, zf.open(info, 'w') as dst:
+                for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                    digest.update(chunk)
+                    dst.write(chunk)
+            # written to the central directory when the archive is closed
+            info.comment = digest.hexdigest().encode()
+    packing = _packing_dir(dcm_dir)
+    os.rename(dcm_dir, packing)
+    os.replace(tmp_archive, archive)
+    shutil.rmtree(packing)
+    return archive
+
+
+def archive_index(archive):
+    """
+    Lists the files of a packed scan from the central directory of its archive
+
+    Returns
+    -------
+    index: dict
+        paths relative to the scan directory matched with (size, md5)
+        (md5 is None for archives not written by pack_scan)
+    """
+    with zipfile.ZipFile(archive) as zf:
+        return {info.filename: (info.file_size, info.comment.decode() or None)
+                for info in zf.infolist() if not info.is_dir()}
+
+
+def extract_scan(archive, dest):
+    """Extracts a packed scan into dest (which then holds what the scan directory held)"""
+    with zipfile.ZipFile(archive) as zf:
+        zf.extractall(dest)
+    return dest
+
+
+def unpack_scan(dcm_dir):
+    """Turns a packed scan back into a directory (e.g. to repair it)"""
+    archive = archive_path(dcm_dir)
+    tmp_dir = dcm_dir.rstrip(os.sep) + '.unpacking'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    extract_scan(archive, tmp_dir)
+    # a directory left next to the archive is replaced by its contents
+    shutil.rmtree(dcm_dir, ignore_errors=True)
+    os.rename(tmp_dir, dcm_dir)
+    os.remove(archive)
+    return dcm_dir
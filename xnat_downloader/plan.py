@@ -0,0 +1,116 @@
+"""Writing down what a run would do, and reading it back to do exactly that."""
+import json
+import os
+import re
+from datetime import datetime
+
+from xnat_downloader.verify import list_remote_files
+
+PLAN_VERSION = 1
+
+
+def session_file_sizes(intf, session_uri):
+    """
+    Adds up the size of the files of every scan in a session, with a
+    single request for the whole session
+
+    Parameters
+    ----------
+    intf: object
+        the pyxnat Interface
+    session_uri: string
+        REST path of the session (e.g. /data/experiments/XNAT_E001)
+
+    Returns
+    -------
+    sizes: dict
+        scan ids matched with the number of bytes of their files
+        (scans xnat did not report a size for are left out)
+    """
+    sizes = {}
+    for remote in list_remote_files(intf, session_uri + '/scans/ALL'):
+        match = re.search(r'/scans/([^/]+)/', remote['uri'])
+        if match is None or remote['size'] is None:
+            continue
+        sizes[match.group(1)] = sizes.get(match.group(1), 0) + remote['size']
+    return sizes
+
+
+def plan_totals(entries):
+    """Counts the scans, bytes and conversions of the entries still to do"""
+    return {
+        'scans': len(entries),
+        'downloads': sum(not entry['downloaded'] for entry in entries),
+        'bytes': sum(entry['estimated_bytes'] or 0 for entry in entries
+                     if not entry['downloaded']),
+        'conversions': sum(entry['bids_path'] is not None and not entry['converted']
+                           for entry in entries),
+    }
+
+
+def write_plan(path, spec, options, entries, sessions):
+    """
+    Saves a plan as json
+
+    Parameters
+    ----------
+    path: string
+        where the plan is written
+    spec: dict
+        the json spec the plan was made from
+    options: dict
+        the command line options that change what the plan means
+        (e.g. scan_non_fmt)
+    entries: list
+        one dictionary per scan with its 'subject', 'session', 'scan' (type),
+        'scan_id', 'uri', 'dicom_dir' and 'bids_path' (relative to the
+        destination, None if the scan is not converted), 'estimated_bytes'
+        (None if unknown) and its local state: whether it was already
+        'downloaded' and 'converted'
+    sessions: dict
+        subject labels matched with the labels of all of their sessions
+        (session_labels are given to sessions by their order, so every
+        session counts, including the ones without planned scans)
+    """
+    plan = {
+        'version': PLAN_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'spec': spec,
+        'options': options,
+        'totals': plan_totals(entries),
+        'sessions': sessions,
+        'entries': entries,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as plan_file:
+        json.dump(plan, plan_file, indent=2)
+    os.replace(tmp_path, path)
+    return plan
+
+
+def load_plan(path):
+    """Reads a plan written by write_plan"""
+    with open(path) as plan_file:
+        plan = json.load(plan_file)
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError('{} is not a plan this version can execute '
+                         '(version {})'.format(path, plan.get('version')))
+    return plan
+
+
+def plan_hierarchy(plan):
+    """
+    The sessions and scans of a plan in the form of
+    xnat_downloader.hierarchy.fetch_hierarchy, in the order of the plan
+    """
+    hierarchy = {}
+    for entry in plan['entries']:
+        hierarchy.setdefault(entry['subject'], {})
+    for subject, sessions in hierarchy.items():
+        for label in plan['sessions'].get(subject, []):
+            sessions[label] = []
+    for entry in plan['entries']:
+        scans = hierarchy.setdefault(entry['subject'], {}).setdefault(entry['session'], [])
+        scans.append({'ID': entry['scan_id'], 'type': entry['scan']})
+    return hierarchy
@@ -0,0 +1,147 @@
+"""Retrying requests to xnat that failed for reasons that may go away."""
+import logging
+import random
+import re
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from zipfile import BadZipFile
+
+import requests
+
+# statuses a busy or restarting server (or its load balancer) answers with
+RETRYABLE_STATUS = frozenset([408, 425, 429, 500, 502, 503, 504])
+
+
+class RetryBudgetExhausted(RuntimeError):
+    """Raised instead of retrying once a run has used up its retries"""
+
+
+def response_status(err):
+    """Returns the HTTP status behind an error (None if there is none)"""
+    response = getattr(err, 'response', None)
+    if response is not None and getattr(response, 'status_code', None) is not None:
+        return response.status_code
+    # pyxnat reports failed requests as DatabaseError('... status code: 503 ...')
+    match = re.search(r'status code: (\d{3})', str(err))
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def is_retryable(err):
+    """
+    True for errors worth trying again: dropped or refused connections,
+    timeouts, truncated archives and the HTTP statuses of an overloaded server
+    """
+    status = response_status(err)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return isinstance(err, (requests.ConnectionError, requests.Timeout,
+                            requests.exceptions.ChunkedEncodingError,
+                            ConnectionError, socket.timeout, TimeoutError,
+                            BadZipFile, EOFError))
+
+
+def retry_after(err):
+    """Seconds the server asked us to wait in a Retry-After header (or None)"""
+    response = getattr(err, 'response', None)
+    value = getattr(response, 'headers', {}).get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+class RetryPolicy:
+    """
+    Retries failed calls with exponential backoff and jitter
+
+    One policy is shared by every request of a run, so the run as a whole
+    gives up once ``budget`` retries were spent (a dead server stops the run
+    instead of every scan waiting out all of its attempts).
+
+    Attributes
+    ----------
+    max_attempts: int
+        number of times a call is tried before its error is raised
+    base_delay: float
+        seconds waited after the first failure (doubled after each failure)
+    max_delay: float
+        upper limit of the backoff (a Retry-After header can exceed it)
+    budget: int | None
+        number of retries allowed for the whole run (None for no limit)
+    retries: int
+        number of retries made so far
+    """
+
+    def __init__(self, max_attempts=5, base_delay=2, max_delay=300, budget=None,
+                 sleep=None, rng=random.random):
+        self.max_attempts = max(max_attempts, 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.retries = 0
+        self._sleep = sleep if sleep is not None else time.sleep
+        self._rng = rng
+        self._lock = threading.Lock()
+
+    def delay(self, attempt, err=None):
+        """
+        Seconds to wait before the next attempt
+
+        Half of the exponential backoff is fixed and the other half random,
+        so workers that failed together do not retry together.
+        """
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        delay = backoff / 2 + self._rng() * backoff / 2
+        requested = retry_after(err) if err is not None else None
+        if requested is not None:
+            delay = max(delay, requested)
+        return delay
+
+    def _take_retry(self):
+        with self._lock:
+            if self.budget is not None and self.retries >= self.budget:
+                return False
+            self.retries += 1
+            return True
+
+    def call(self, func, *args, description=None, **kwargs):
+        """
+        Calls func(*args, **kwargs), retrying it when it fails with a
+        retryable error
+
+        Parameters
+        ----------
+        func: callable
+            what to call
+        description: string | None
+            what is being attempted (for the log)
+        """
+        description = description or getattr(func, '__name__', 'request')
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as err:
+                if not is_retryable(err) or attempt == self.max_attempts:
+                    raise
+                if not self._take_retry():
+                    raise RetryBudgetExhausted(
+                        'retry budget of {} used up, giving up on {}'.format(
+                            self.budget, description)) from err
+                delay = self.delay(attempt, err)
+                msg = '{desc} attempt {n} failed ({err}), retrying in {delay:.1f} s'.format(
+                    desc=description, n=attempt, err=err, delay=delay)
+                print(msg)
+                logging.warning(msg)
+                self._sleep(delay)
@@ -0,0 +1,83 @@
+"""Size-capped scratch space for dicoms that are only kept until they are converted."""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+
+def default_scratch_dir():
+    """/dev/shm when the machine has it (dicoms then stay in memory), else the temp directory"""
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+class ScratchSpace:
+    """
+    Directories for scans that are downloaded, converted and thrown away,
+    holding at most ``capacity`` bytes at once
+
+    A scan reserves its size before it is downloaded and waits while the
+    scans already in scratch leave no room for it. A scan of unknown size
+    reserves the whole capacity, and a scan larger than the whole capacity
+    waits until scratch is empty, so it never waits forever.
+
+    Attributes
+    ----------
+    root: string
+        directory the scratch directories are made in
+    capacity: int
+        bytes allowed in scratch at once
+    used: int
+        bytes reserved by the scans in scratch
+    """
+
+    def __init__(self, root, capacity):
+        self.root = root
+        self.capacity = capacity
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def _fits(self, nbytes):
+        return self.used == 0 or self.used + nbytes <= self.capacity
+
+    def reserve(self, nbytes=None):
+        """Blocks until there is room for nbytes (None if unknown, taking the whole capacity)"""
+        nbytes = self.capacity if nbytes is None else nbytes
+        with self._condition:
+            if not self._fits(nbytes):
+                logging.info('scratch is full (%d of %d bytes), waiting', self.used,
+                             self.capacity)
+            while not self._fits(nbytes):
+                self._condition.wait()
+            self.used += nbytes
+
+    def release(self, nbytes=None):
+        """Gives back what reserve took"""
+        with self._condition:
+            self.used -= self.capacity if nbytes is None else nbytes
+            self._condition.notify_all()
+
+    @contextmanager
+    def area(self, nbytes=None):
+        """
+        A directory of its own for the body of a with block, removed with
+        everything in it at the end
+
+        Parameters
+        ----------
+        nbytes: int | None
+            what will be put in the directory (None if unknown)
+        """
+        self.reserve(nbytes)
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            path = tempfile.mkdtemp(prefix='xnat_downloader-', dir=self.root)
+            try:
+                yield path
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+        finally:
+            self.release(nbytes)
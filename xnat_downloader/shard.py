@@ -0,0 +1,72 @@
+"""Splitting the scans of a run between the nodes of a cluster."""
+import argparse
+import hashlib
+
+
+def parse_shard(value):
+    """
+    Reads a K/N shard argument (K counts from 0, as SLURM array task ids do)
+
+    Returns
+    -------
+    shard: tuple
+        (index, count)
+    """
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected K/N, got {!r}'.format(value))
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError('K must be between 0 and N-1 in K/N, '
+                                         'got {!r}'.format(value))
+    return index, count
+
+
+def shard_suffix(shard):
+    """What is added to the names of the files a shard writes ('' without shard)"""
+    if shard is None:
+        return ''
+    return '.shard-{}-of-{}'.format(*shard)
+
+
+def unit_hash(subject, session, scan):
+    """A hash of a scan that is the same on every machine and in every run"""
+    key = '/'.join((str(subject), session, scan)).encode('utf-8')
+    return int(hashlib.sha1(key).hexdigest()[:16], 16)
+
+
+def shard_of(subject, session, scan, count):
+    """The shard a scan belongs to when their sizes are unknown"""
+    return unit_hash(subject, session, scan) % count
+
+
+def assign_shards(units, count):
+    """
+    Spreads scans over shards, balancing the bytes each shard downloads
+
+    Scans are handed out from the largest to the smallest, each to the
+    shard with the fewest bytes so far. This depends on the whole list of
+    scans, so it is only used when every node sees the same list (a plan);
+    when a size is missing every scan falls back to shard_of.
+
+    Parameters
+    ----------
+    units: list
+        (subject, session, scan, bytes) tuples, bytes None when unknown
+    count: int
+        number of shards
+
+    Returns
+    -------
+    shards: dict
+        (subject, session, scan) matched with its shard
+    """
+    if any(nbytes is None for *_, nbytes in units):
+        return {unit[:3]: shard_of(*unit[:3], count) for unit in units}
+    loads = [0] * count
+    shards = {}
+    for *key, nbytes in sorted(units, key=lambda unit: (-unit[3], unit_hash(*unit[:3]))):
+        index = min(range(count), key=lambda shard: (loads[shard], shard))
+        loads[index] += nbytes
+        shards[tuple(key)] = index
+    return shards
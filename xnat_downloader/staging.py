@@ -0,0 +1,115 @@
+"""Downloading scans next to their destination and moving them in at once."""
+import os
+import shutil
+from contextlib import contextmanager
+from glob import glob
+
+from xnat_downloader.locks import LeaseLock
+
+STAGING_DIR = '.staging'
+# files a later attempt can continue from (see transfer.fetch_file)
+RESUMABLE_SUFFIXES = ('.part', '.part.json')
+# seconds after which the staging directory of a process that stopped is cleaned up
+LEASE = 300
+LOCK_SUFFIX = '.lock'
+
+
+def staging_dir(dcm_outdir, name):
+    """
+    The directory a download named name is extracted into before it is
+    moved under dcm_outdir (on the same filesystem, so the move is a rename)
+    """
+    return os.path.join(dcm_outdir, STAGING_DIR, name)
+
+
+@contextmanager
+def owned(stage):
+    """
+    Holds the lease of a staging directory for the body of a with block,
+    so clean_staging leaves it alone while the download in it runs (a
+    process downloading into the same directory waits for it)
+    """
+    lock = LeaseLock(stage + LOCK_SUFFIX, LEASE)
+    lock.acquire()
+    try:
+        yield stage
+    finally:
+        lock.release()
+
+
+def commit_staged(stage, dcm_outdir):
+    """
+    Moves every scan extracted into a staging directory to its place
+    under dcm_outdir and removes the staging directory
+
+    Each scan directory is renamed into place, so a scan directory under
+    dcm_outdir is always complete. An existing directory of the same scan
+    (left by a version that extracted in place) is replaced.
+
+    Returns
+    -------
+    scan_dirs: list
+        the directories the scans were moved to
+    """
+    scan_dirs = []
+    for staged in sorted(glob(os.path.join(stage, '*', 'scans', '*'))):
+        target = os.path.join(dcm_outdir, os.path.relpath(staged, stage))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        os.rename(staged, target)
+        scan_dirs.append(target)
+    shutil.rmtree(stage)
+    return scan_dirs
+
+
+def discard_staged(stage):
+    """
+    Removes what a failed download extracted, keeping the partial
+    archives a later attempt can resume
+    """
+    if not os.path.isdir(stage):
+        return
+    for name in os.listdir(stage):
+        path = os.path.join(stage, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif not name.endswith(RESUMABLE_SUFFIXES):
+            os.remove(path)
+    if not os.listdir(stage):
+        os.rmdir(stage)
+
+
+def clean_staging(dest):
+    """
+    Discards the staging directories runs that were interrupted left
+    under the sourcedata of dest
+
+    Only directories whose lease (see owned) is free or expired are
+    discarded, so the downloads of other runs sharing the destination
+    (e.g. the other shards of a cluster run) are left alone.
+
+    Returns
+    -------
+    stale: list
+        the staging directories that were cleaned up
+    """
+    stale = []
+    sourcedata = os.path.join(dest, 'sourcedata')
+    # sessions are stored directly under sourcedata or grouped by subject
+    for root in glob(os.path.join(sourcedata, STAGING_DIR)) + \
+            glob(os.path.join(sourcedata, '*', STAGING_DIR)):
+        for stage in glob(os.path.join(root, '*')):
+            if not os.path.isdir(stage):
+                continue
+            lock = LeaseLock(stage + LOCK_SUFFIX, LEASE)
+            if not lock.acquire(wait=False):
+                continue
+            try:
+                discard_staged(stage)
+            finally:
+                lock.release()
+            stale.append(stage)
+        if not os.listdir(root):
+            os.rmdir(root)
+    return stale
@@ -0,0 +1,140 @@
+"""A store of dicoms shared by destinations, keyed by the md5 of every file."""
+import hashlib
+import json
+import os
+import shutil
+import stat
+import uuid
+
+from xnat_downloader.manifest import file_md5
+
+
+def _link(src, dst):
+    """Hard links src to dst, copying it when they are on different filesystems"""
+    tmp = '{}.{}.tmp'.format(dst, uuid.uuid4().hex)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _publish(src, obj):
+    """
+    Makes a read-only link (or copy) of src at obj, unless obj exists
+
+    obj is only ever created whole and never replaced, so concurrent adds
+    of the same file all end up linked to the one that got there first.
+    """
+    tmp = '{}.{}.tmp'.format(obj, uuid.uuid4().hex)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    try:
+        os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.link(tmp, obj)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp)
+
+
+class ContentStore:
+    """
+    Dicoms downloaded for any destination, stored once under their md5 and
+    hard linked into the sourcedata of every destination that needs them
+
+    Every scan added to the store is described by an index (the path,
+    size and md5 of its files) keyed by the server, project, subject and
+    session labels and id of the scan, so a scan another destination already downloaded is linked
+    without asking xnat for it. Files of the store are made read-only,
+    since a change to one of the links would change all of them.
+
+    Attributes
+    ----------
+    root: string
+        directory of the store (objects/ holds the files, scans/ the indexes)
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    @staticmethod
+    def scan_key(server, project, subject, session, scan_id):
+        """
+        The key of a scan, from identifiers that do not depend on how it was
+        listed (its REST path has the session label or the xnat id in it)
+        """
+        return '/'.join([server or '', project, subject, session, scan_id])
+
+    def _object_path(self, md5):
+        return os.path.join(self.root, 'objects', md5[:2], md5[2:])
+
+    def _index_path(self, key):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.root, 'scans', digest[:2], digest + '.json')
+
+    def files(self, key):
+        """The (path, size, md5) of the files of a stored scan (None if it is not stored)"""
+        try:
+            with open(self._index_path(key)) as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            return None
+        return [tuple(entry) for entry in index['files']]
+
+    def add(self, key, dcm_dir):
+        """
+        Adds the files of a downloaded scan to the store
+
+        A file already in the store replaces the downloaded copy with a link,
+        so identical files take the space of one.
+
+        Parameters
+        ----------
+        key: string
+            see scan_key
+        dcm_dir: string
+            directory of the scan (<session>/scans/<id>-<type>)
+        """
+        files = []
+        for root, _, filenames in os.walk(dcm_dir):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                md5 = file_md5(path)
+                obj = self._object_path(md5)
+                if not os.path.exists(obj):
+                    os.makedirs(os.path.dirname(obj), exist_ok=True)
+                    _publish(path, obj)
+                if not os.path.samefile(obj, path):
+                    _link(obj, path)
+                files.append((os.path.relpath(path, dcm_dir), os.path.getsize(path), md5))
+        index_path = self._index_path(key)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(index_path, uuid.uuid4().hex)
+        with open(tmp_path, 'w') as index_file:
+            json.dump({'key': key, 'files': sorted(files)}, index_file)
+        os.replace(tmp_path, index_path)
+
+    def restore(self, key, dcm_dir):
+        """
+        Links the files of a stored scan into dcm_dir
+
+        Returns
+        -------
+        restored: bool
+            False if the scan is not in the store (or lost files)
+        """
+        files = self.files(key)
+        if files is None:
+            return False
+        for name, size, md5 in files:
+            obj = self._object_path(md5)
+            if not os.path.isfile(obj) or os.path.getsize(obj) != size:
+                return False
+        for name, _, md5 in files:
+            path = os.path.join(dcm_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _link(self._object_path(md5), path)
+        return True
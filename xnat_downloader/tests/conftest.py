@@ -14,8 +14,7 @@ def mock_xnat_environment(monkeypatch: pytest.MonkeyPatch) -> None:
 
     monkeypatch.setattr(run, "Interface", MockInterface)
 
-    def fake_dcm2niix(command: str, shell: bool = True) -> int:
-        parts = command.split()
+    def fake_dcm2niix(parts: list) -> int:
         out_dir = Path(parts[parts.index("-o") + 1])
         fname = parts[parts.index("-f") + 1]
         out_dir.mkdir(parents=True, exist_ok=True)
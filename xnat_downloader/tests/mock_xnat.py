@@ -2,11 +2,22 @@
 
 from __future__ import annotations
 
+import hashlib
+import io
 import json
 import os
+import re
+import zipfile
+from datetime import datetime
 from pathlib import Path
 from typing import Dict, Iterable, List, Optional
 
+import requests
+
+
+MOCK_DICOM = b"mock dicom data"
+# where the mock server keeps its archive (see MockScan.archive_path)
+MOCK_ARCHIVE = "/data/xnat/archive"
 
 MOCK_DATA: Dict[str, Dict] = {
     "projects": {
@@ -17,6 +28,7 @@ MOCK_DATA: Dict[str, Dict] = {
                     "sessions": [
                         {
                             "original_label": "sub-001_ses-01",
+                            "insert_date": "2018-06-13 10:00:00.0",
                             "scans": [
                                 {
                                     "id": "1",
@@ -37,6 +49,7 @@ MOCK_DATA: Dict[str, Dict] = {
                     "sessions": [
                         {
                             "original_label": "20180101",
+                            "insert_date": "2018-01-01 09:00:00.0",
                             "scans": [
                                 {
                                     "id": "1",
@@ -47,6 +60,7 @@ MOCK_DATA: Dict[str, Dict] = {
                         },
                         {
                             "original_label": "20180202",
+                            "insert_date": "2018-02-02 09:00:00.0",
                             "scans": [
                                 {
                                     "id": "2",
@@ -57,6 +71,7 @@ MOCK_DATA: Dict[str, Dict] = {
                         },
                         {
                             "original_label": "20180303",
+                            "insert_date": "2018-03-03 09:00:00.0",
                             "scans": [
                                 {
                                     "id": "3",
@@ -73,6 +88,65 @@ MOCK_DATA: Dict[str, Dict] = {
 }
 
 
+class MockResponse:
+    """Minimal stand-in for :class:`requests.Response`."""
+
+    def __init__(self, content: bytes, status_code: int = 200,
+                 headers: Optional[Dict[str, str]] = None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.ok = status_code < 400
+
+    def iter_content(self, chunk_size: int = 1) -> Iterable[bytes]:
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self) -> None:
+        if not self.ok:
+            raise MockHTTPError(f"HTTP {self.status_code}", response=self)
+
+    def close(self) -> None:
+        pass
+
+
+class MockHTTPError(Exception):
+    def __init__(self, message: str, response: MockResponse):
+        super().__init__(message)
+        self.response = response
+
+
+def zip_scans(session: "MockSession", scan_ids: Iterable[str]) -> bytes:
+    """Build the archive XNAT returns for ``.../scans/<ids>/files?format=zip``."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for scan_id in scan_ids:
+            scan = session._scans_by_id[scan_id]
+            for filename in scan.dicom_files:
+                archive.writestr(f"{scan.path()}/{filename}", scan.content(filename))
+    return buffer.getvalue()
+
+
+def mount_archive(root: str) -> str:
+    """Write the archive of the mock server under root, as if it were mounted there."""
+    intf = MockInterface(server="https://xnat.invalid")
+    for project_id, project_data in MOCK_DATA["projects"].items():
+        project = intf.select.project(project_id)
+        for label in project_data["subjects"]:
+            subject = project.subject(label)
+            for session_data in subject._data.get("sessions", []):
+                for scan in MockSession(subject, session_data)._scans:
+                    for filename in scan.dicom_files:
+                        path = Path(root) / os.path.relpath(scan.archive_path(filename),
+                                                            MOCK_ARCHIVE)
+                        path.parent.mkdir(parents=True, exist_ok=True)
+                        path.write_bytes(scan.content(filename))
+    return root
+
+
 class MockInterface:
     """Replacement for :class:`pyxnat.Interface` used in the unit tests."""
 
@@ -88,12 +162,128 @@ class MockInterface:
             raise ValueError("Server URL must be provided for the mock interface.")
 
         self._data = MOCK_DATA
-        self.select = MockSelect(self._data)
+        # real session so transport settings can be mounted and inspected
+        self._http = requests.Session()
+        self.select = MockSelect(self._data, self)
+        self.array = MockArray(self)
+        self.requests: List[str] = []
+        # Range headers the server was sent, and whether it honours them
+        self.ranges: List[str] = []
+        self.accept_ranges = True
+
+    def get(self, uri: str, **kwargs) -> MockResponse:
+        """Serve the REST paths the downloader requests directly."""
+        self.requests.append(uri)
+        response = self._serve(uri)
+        if response.status_code == 200:
+            response.headers["ETag"] = '"{}"'.format(hashlib.md5(response.content).hexdigest())
+            headers = kwargs.get("headers") or {}
+            if "Range" in headers:
+                self.ranges.append(headers["Range"])
+                response = self._range(response, headers)
+        response.url = "https://xnat.invalid" + uri
+        # like requests.Session, which pyxnat sends every request through
+        for hook in self._http.hooks.get("response", []):
+            response = hook(response) or response
+        return response
+
+    def _range(self, response: MockResponse, headers: Dict[str, str]) -> MockResponse:
+        if not self.accept_ranges or headers.get("If-Range", response.headers["ETag"]) \
+                != response.headers["ETag"]:
+            return response
+        start = int(re.match(r"bytes=(\d+)-", headers["Range"]).group(1))
+        size = len(response.content)
+        if start >= size:
+            return MockResponse(b"", status_code=416)
+        return MockResponse(response.content[start:], status_code=206, headers={
+            "Content-Range": f"bytes {start}-{size - 1}/{size}",
+            "ETag": response.headers["ETag"],
+        })
+
+    def _serve(self, uri: str) -> MockResponse:
+        path, _, query = uri.partition("?")
+        if path == "/data/experiments":
+            return self._experiments(dict(param.partition("=")[::2]
+                                          for param in query.split("&") if param))
+        match = re.match(
+            r"^/data/projects/([^/]+)/subjects/([^/]+)/experiments/([^/]+)/scans/([^/]+)"
+            r"(/files|/resources/[^/]+/files/(.+))$",
+            path,
+        )
+        if match is None:
+            return MockResponse(b"not found", status_code=404)
+        project, subject, session_label, scan_ids, _, filename = match.groups()
+        session = self.select.project(project).subject(subject).session(session_label)
+        if filename is not None:
+            scan = session._scans_by_id[scan_ids]
+            if filename not in scan.dicom_files:
+                return MockResponse(b"not found", status_code=404)
+            return MockResponse(scan.content(filename))
+        params = dict(param.partition("=")[::2] for param in query.split("&") if param)
+        if params.get("format") == "json":
+            scans = (session._scans_by_id.values() if scan_ids == "ALL"
+                     else [session._scans_by_id[scan_ids]])
+            absolute = params.get("locator") == "absolutePath"
+            return MockResponse(json.dumps(
+                {"ResultSet": {"Result": [entry for scan in scans
+                                          for entry in scan.catalog(absolute)]}}
+            ).encode())
+        return MockResponse(zip_scans(session, scan_ids.split(",")))
+
+    def _experiments(self, params: Dict[str, str]) -> MockResponse:
+        """The experiment listing, with date columns filtered by first-last day ranges."""
+        rows = self.array.experiments(params["project"])
+        for column in ("insert_date", "last_modified"):
+            if column not in params:
+                continue
+            first, last = (datetime.strptime(day, "%m/%d/%Y").date()
+                           for day in params[column].split("-"))
+            rows = [row for row in rows if row[column]
+                    and first <= datetime.strptime(row[column][:10], "%Y-%m-%d").date() <= last]
+        return MockResponse(json.dumps({"ResultSet": {"Result": rows}}).encode())
+
+
+class MockArray:
+    """The search queries of :class:`pyxnat.core.array.ArrayData`."""
+
+    def __init__(self, intf: MockInterface):
+        self._intf = intf
+
+    def _sessions(self, project_id: str):
+        project = self._intf.select.project(project_id)
+        for label, subject_data in project.data["subjects"].items():
+            subject = project.subject(label)
+            for session_data in subject_data.get("sessions", []):
+                yield label, MockSession(subject, session_data)
+
+    def experiments(self, project_id: str, experiment_type: str = "xnat:subjectAssessorData",
+                    columns: Optional[List[str]] = None) -> List[Dict[str, str]]:
+        return [
+            {"id": session.label(), "project": project_id,
+             "label": session.label(), "subject_label": subject_label,
+             "insert_date": session.data.get("insert_date", ""),
+             "last_modified": session.data.get("last_modified", "")}
+            for subject_label, session in self._sessions(project_id)
+        ]
+
+    def scans(self, project_id: str, experiment_type: str = "xnat:imageSessionData",
+              scan_type: str = "xnat:imageScanData",
+              columns: Optional[List[str]] = None) -> List[Dict[str, str]]:
+        prefix = scan_type.lower()
+        return [
+            {"id": session.label(), "project": project_id,
+             "label": session.label(), "subject_label": subject_label,
+             f"{prefix}/id": scan.id(), f"{prefix}/type": scan.scan_type,
+             f"{prefix}/frames": str(len(scan.dicom_files))}
+            for subject_label, session in self._sessions(project_id)
+            for scan in session._scans
+        ]
 
 
 class MockSelect:
-    def __init__(self, data: Dict[str, Dict]):
+    def __init__(self, data: Dict[str, Dict], intf: MockInterface):
         self._data = data
+        self._intf = intf
 
     def projects(self) -> "MockProjects":
         return MockProjects(self._data["projects"])
@@ -102,7 +292,7 @@ class MockSelect:
         project_data = self._data["projects"].get(project_label)
         if project_data is None:
             raise KeyError(f"Unknown project: {project_label}")
-        return MockProject(project_label, project_data)
+        return MockProject(project_label, project_data, self._intf)
 
 
 class MockProjects:
@@ -114,16 +304,18 @@ class MockProjects:
 
 
 class MockProject:
-    def __init__(self, project_id: str, project_data: Dict):
+    def __init__(self, project_id: str, project_data: Dict, intf: MockInterface):
         self.project_id = project_id
         self.data = project_data
+        self._intf = intf
+        self._uri = f"/data/projects/{project_id}"
 
     def subjects(self) -> "MockSubjects":
         return MockSubjects(self.data["subjects"])
 
     def subject(self, label: str) -> "MockSubject":
         subject_data = self.data["subjects"].get(label)
-        return MockSubject(label, subject_data)
+        return MockSubject(label, subject_data, self)
 
 
 class MockSubjects:
@@ -136,9 +328,12 @@ class MockSubjects:
 
 
 class MockSubject:
-    def __init__(self, label: str, subject_data: Optional[Dict]):
+    def __init__(self, label: str, subject_data: Optional[Dict], project: MockProject):
         self._label = label
         self._data = subject_data
+        self.project = project
+        self._intf = project._intf
+        self._uri = f"{project._uri}/subjects/{label}"
         self.attrs = {"label": subject_data["label"]} if subject_data else {}
 
     def exists(self) -> bool:
@@ -148,6 +343,15 @@ class MockSubject:
         sessions = self._data.get("sessions", []) if self._data else []
         return MockExperiments(self, sessions)
 
+    def experiment(self, label: str) -> "MockSession":
+        return self.session(label)
+
+    def session(self, label: str) -> "MockSession":
+        for session_data in self._data.get("sessions", []) if self._data else []:
+            if session_data["original_label"] == label:
+                return MockSession(self, session_data)
+        raise KeyError(f"Unknown session: {label}")
+
 
 class MockExperiments:
     def __init__(self, subject: MockSubject, sessions: Iterable[Dict]):
@@ -163,8 +367,10 @@ class MockExperiments:
 class MockSession:
     def __init__(self, subject: MockSubject, session_data: Dict):
         self.subject = subject
+        self.data = session_data
         self.original_label = session_data["original_label"]
         self.attrs = {"label": self.original_label}
+        self._uri = f"{subject._uri}/experiments/{self.original_label}"
         self._scans = [
             MockScan(self, scan_data["id"], scan_data["type"], scan_data["dicom_files"])
             for scan_data in session_data.get("scans", [])
@@ -177,10 +383,15 @@ class MockSession:
     def scans(self) -> "MockScansCollection":
         return MockScansCollection(self)
 
+    def scan(self, scan_id: str) -> "MockScan":
+        return self._scans_by_id[scan_id]
+
 
 class MockScansCollection:
     def __init__(self, session: MockSession):
         self.session = session
+        self._intf = session.subject._intf
+        self._cbase = f"{session._uri}/scans"
 
     def get(self, _selector: str = "") -> List["MockScan"]:
         return list(self.session._scans)
@@ -193,19 +404,13 @@ class MockScansCollection:
         extract: bool = True,
         removeZip: bool = True,
     ) -> None:
-        scan = self.session._scans_by_id[str(type)]
-        base = (
-            Path(dest_dir)
-            / self.session.label()
-            / "scans"
-            / f"{type}-{name}"
-            / "resources"
-            / "DICOM"
-            / "files"
-        )
-        base.mkdir(parents=True, exist_ok=True)
-        for filename in scan.dicom_files:
-            (base / filename).write_text("mock dicom data", encoding="utf-8")
+        # like XNAT, several comma separated scan ids share one archive
+        for scan_id in str(type).split(","):
+            scan = self.session._scans_by_id[scan_id]
+            base = Path(dest_dir) / scan.path()
+            base.mkdir(parents=True, exist_ok=True)
+            for filename in scan.dicom_files:
+                (base / filename).write_bytes(scan.content(filename))
 
 
 class MockScan:
@@ -215,6 +420,8 @@ class MockScan:
         self.scan_type = scan_type
         self.dicom_files = dicom_files
         self.attrs = {"type": scan_type}
+        self._intf = session.subject._intf
+        self._uri = f"{session._uri}/scans/{self._id}"
 
     def id(self) -> str:
         return self._id
@@ -222,3 +429,33 @@ class MockScan:
     def parent(self) -> MockSession:
         return self._session
 
+    def content(self, filename: str) -> bytes:
+        return MOCK_DICOM
+
+    def catalog(self, absolute: bool = False) -> List[Dict[str, str]]:
+        """The file listing XNAT returns for ``.../scans/<id>/files?format=json``
+        (with ``&locator=absolutePath`` when absolute is set)."""
+        entries = []
+        for filename in self.dicom_files:
+            entry = {
+                "Name": filename,
+                "Size": str(len(self.content(filename))),
+                "URI": f"{self._uri}/resources/DICOM/files/{filename}",
+                "collection": "DICOM",
+                "digest": hashlib.md5(self.content(filename)).hexdigest(),
+            }
+            if absolute:
+                entry["absolutePath"] = self.archive_path(filename)
+            entries.append(entry)
+        return entries
+
+    def archive_path(self, filename: str) -> str:
+        """Where XNAT keeps a dicom of the scan in its archive."""
+        project = self._session.subject.project.project_id
+        return (f"{MOCK_ARCHIVE}/{project}/arc001/{self._session.label()}"
+                f"/SCANS/{self._id}/DICOM/{filename}")
+
+    def path(self) -> str:
+        """Where XNAT places the scan's dicoms inside a download archive."""
+        scan_fmt = re.sub(r"[^\w]", "_", self.scan_type)
+        return f"{self._session.label()}/scans/{self._id}-{scan_fmt}/resources/DICOM/files"
@@ -0,0 +1,27 @@
+"""Testing the cache of xnat listings"""
+from ..cache import MetadataCache
+
+
+def test_metadata_cache(tmp_path, monkeypatch):
+    from .. import cache as cache_module
+
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, 'time', lambda: now[0])
+    db = str(tmp_path / 'metadata.sqlite')
+    cache = MetadataCache(db, 'https://xnat.invalid', 'proj', ttl=60)
+    cache.set('subjects', ['01', '02'])
+    cache.set('subjects/01/sessions', ['ses-01'])
+
+    # other projects and servers have their own listings
+    assert MetadataCache(db, 'https://xnat.invalid', 'other', ttl=60).get('subjects') is None
+    assert MetadataCache(db, 'https://other.invalid', 'proj', ttl=60).get('subjects') is None
+
+    now[0] += 30
+    assert cache.fetch('subjects', lambda: ['unexpected']) == ['01', '02']
+    now[0] += 31
+    assert cache.get('subjects') is None
+    assert cache.fetch('subjects', lambda: ['01', '02', '03']) == ['01', '02', '03']
+
+    cache.invalidate('subjects/')
+    assert cache.get('subjects/01/sessions') is None
+    assert cache.get('subjects') == ['01', '02', '03']
@@ -3,6 +3,9 @@ import fnmatch
 import os
 import shutil
 
+import pytest
+import requests
+
 from ..cli.run import main
 
 def test_cli_bids(monkeypatch):
@@ -75,3 +78,965 @@ def test_cli_nonbids(monkeypatch):
 
     # clean up
     shutil.rmtree('/tmp/nonbids')
+
+
+def _write_spec(tmp_path, spec_file, **overrides):
+    """Copy a test spec into tmp_path, pointing its destination there."""
+    import json
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    with open(os.path.join(data_dir, spec_file)) as spec_input:
+        spec = json.load(spec_input)
+    spec['destination'] = str(tmp_path / 'out')
+    spec.update(overrides)
+    spec_path = tmp_path / spec_file
+    spec_path.write_text(json.dumps(spec))
+    return str(spec_path), spec['destination']
+
+
+def _list_outputs(out_dir):
+    output_files = set()
+    for root, dirnames, filenames in os.walk(out_dir):
+        for filename in fnmatch.filter(filenames, "*.*"):
+            output_files.add(os.path.relpath(os.path.join(root, filename), out_dir))
+    return output_files
+
+
+def test_cli_jobs(monkeypatch, tmp_path):
+    import sys
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+    with open(os.path.join(data_dir, "nonbids.txt"), "r") as gt:
+        ground_truth_nonbids_files = {line.rstrip() for line in gt}
+
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred, "-j", "3"])
+
+    assert main() is None
+    assert _list_outputs(out_dir) == ground_truth_nonbids_files
+
+
+def test_cli_adaptive_jobs(monkeypatch, tmp_path, capsys):
+    import sys
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+    with open(os.path.join(data_dir, "nonbids.txt"), "r") as gt:
+        ground_truth_nonbids_files = {line.rstrip() for line in gt}
+
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "-j", "4", "--adaptive"])
+
+    assert main() is None
+    assert _list_outputs(out_dir) == ground_truth_nonbids_files
+    assert 'concurrent downloads:' in capsys.readouterr().out
+
+
+def test_cli_jobs_failure_does_not_stop_run(monkeypatch, tmp_path):
+    import sys
+    from . import mock_xnat
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+
+    original_download = mock_xnat.MockScansCollection.download
+
+    def flaky_download(self, dest_dir, type, name, **kwargs):
+        if type == "2":
+            raise RuntimeError("connection reset")
+        return original_download(self, dest_dir, type, name, **kwargs)
+
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "download", flaky_download)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred, "-j", "2"])
+
+    assert main() == 1
+    outputs = _list_outputs(out_dir)
+    assert "sub-SEH021/ses-pre/anat/sub-SEH021_ses-pre_T1w.nii.gz" in outputs
+    assert "sub-SEH021/ses-checkup/func/sub-SEH021_ses-checkup_task-rest_bold.nii.gz" in outputs
+    assert not any('dwi' in output for output in outputs)
+
+
+def test_cli_retries_transient_errors(monkeypatch, tmp_path):
+    import sys
+    from . import mock_xnat
+    from .. import retry
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+    with open(os.path.join(data_dir, "nonbids.txt"), "r") as gt:
+        ground_truth_nonbids_files = {line.rstrip() for line in gt}
+
+    original_download = mock_xnat.MockScansCollection.download
+    failures = []
+
+    def flaky_download(self, dest_dir, type, name, **kwargs):
+        if type == "2" and len(failures) < 2:
+            failures.append(type)
+            raise TypeError("write() argument must be str, not ConnectionError")
+        return original_download(self, dest_dir, type, name, **kwargs)
+
+    sleeps = []
+    monkeypatch.setattr(retry.time, "sleep", sleeps.append)
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "download", flaky_download)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "--retry-delay", "0.5"])
+
+    assert main() is None
+    assert _list_outputs(out_dir) == ground_truth_nonbids_files
+    assert len(sleeps) == 2 and 0.25 <= sleeps[0] <= 0.5 and 0.5 <= sleeps[1] <= 1
+
+
+def test_cli_pipeline(monkeypatch, tmp_path):
+    import sys
+    import threading
+    from . import mock_xnat
+    from ..cli import run
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+    with open(os.path.join(data_dir, "nonbids.txt"), "r") as gt:
+        ground_truth_nonbids_files = {line.rstrip() for line in gt}
+
+    # count the scans that are downloaded but not yet converted
+    lock = threading.Lock()
+    pending = {'now': 0, 'max': 0}
+    original_download = mock_xnat.MockScansCollection.download
+    original_call = run.call
+
+    def counting_download(self, *args, **kwargs):
+        with lock:
+            pending['now'] += 1
+            pending['max'] = max(pending['max'], pending['now'])
+        return original_download(self, *args, **kwargs)
+
+    def counting_call(command):
+        result = original_call(command)
+        with lock:
+            pending['now'] -= 1
+        return result
+
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "download", counting_download)
+    monkeypatch.setattr(run, "call", counting_call)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred, "-j", "3",
+                                      "--pipeline", "--convert-jobs", "2",
+                                      "--max-pending", "1"])
+
+    assert main() is None
+    assert _list_outputs(out_dir) == ground_truth_nonbids_files
+    assert pending['max'] == 1
+
+
+def test_cli_bulk_session(monkeypatch, tmp_path):
+    import sys
+    from . import mock_xnat
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'bids_test.json')
+    with open(os.path.join(data_dir, "bids.txt"), "r") as gt:
+        ground_truth_bids_files = {line.rstrip() for line in gt}
+
+    requested = []
+    original_download = mock_xnat.MockScansCollection.download
+
+    def recording_download(self, dest_dir, type, name, **kwargs):
+        requested.append(type)
+        return original_download(self, dest_dir, type, name, **kwargs)
+
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "download", recording_download)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "-j", "2", "--bulk-session"])
+
+    assert main() is None
+    assert _list_outputs(out_dir) == ground_truth_bids_files
+    assert requested == ["1,2"]
+
+
+@pytest.mark.parametrize('transfer', ['stream', 'resume', 'files'])
+def test_cli_stream_transfer(monkeypatch, tmp_path, transfer):
+    import sys
+    from . import mock_xnat
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+    with open(os.path.join(data_dir, "nonbids.txt"), "r") as gt:
+        ground_truth_nonbids_files = {line.rstrip() for line in gt}
+
+    def no_pyxnat_download(self, *args, **kwargs):
+        raise AssertionError("the zip archive should not be saved by pyxnat")
+
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "download", no_pyxnat_download)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "--transfer", transfer])
+
+    assert main() is None
+    assert _list_outputs(out_dir) == ground_truth_nonbids_files
+
+
+def test_cli_archive_transfer(monkeypatch, tmp_path):
+    import sys
+    from . import mock_xnat
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+    with open(os.path.join(data_dir, "nonbids.txt"), "r") as gt:
+        ground_truth_nonbids_files = {line.rstrip() for line in gt}
+    archive = mock_xnat.mount_archive(str(tmp_path / 'archive'))
+
+    def no_pyxnat_download(self, *args, **kwargs):
+        raise AssertionError("the dicoms should be copied from the archive")
+
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "download", no_pyxnat_download)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "--transfer", "archive", "--archive-root", archive,
+                                      "--archive-server-root", mock_xnat.MOCK_ARCHIVE])
+
+    assert main() is None
+    assert _list_outputs(out_dir) == ground_truth_nonbids_files
+
+
+# a response stalls after a few bytes, or sends its headers and no byte at all
+@pytest.mark.parametrize('sent', [10, 0])
+def test_cli_stalled_download_is_retried(monkeypatch, tmp_path, capsys, sent):
+    import sys
+    import threading
+    from . import mock_xnat
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+    with open(os.path.join(data_dir, "nonbids.txt"), "r") as gt:
+        ground_truth_nonbids_files = {line.rstrip() for line in gt}
+
+    class StallingResponse(mock_xnat.MockResponse):
+        """sends the first bytes, then nothing until it is closed"""
+
+        def __init__(self, content):
+            super().__init__(content)
+            self.closed = threading.Event()
+
+        def iter_content(self, chunk_size=1):
+            if sent:
+                yield self.content[:sent]
+            self.closed.wait(30)
+            raise requests.ConnectionError("connection closed")
+
+        def close(self):
+            self.closed.set()
+
+    original_serve = mock_xnat.MockInterface._serve
+    stalled = []
+
+    def stalling_serve(self, uri):
+        response = original_serve(self, uri)
+        if uri.endswith("/scans/2/files?format=zip") and not stalled:
+            stalled.append(uri)
+            return StallingResponse(response.content)
+        return response
+
+    monkeypatch.setattr(mock_xnat.MockInterface, "_serve", stalling_serve)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "--transfer", "stream", "--retry-delay", "0",
+                                      "--stall-window", "0.2", "--stall-floor", "1000"])
+
+    assert main() is None
+    assert stalled
+    assert _list_outputs(out_dir) == ground_truth_nonbids_files
+    assert '1 stalled download(s) from xnat.invalid' in capsys.readouterr().out
+
+
+def test_cli_manifest(monkeypatch, tmp_path):
+    import sys
+    from . import mock_xnat
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'bids_test.json')
+    with open(os.path.join(data_dir, "bids.txt"), "r") as gt:
+        ground_truth_bids_files = {line.rstrip() for line in gt}
+
+    requested = []
+    original_download = mock_xnat.MockScansCollection.download
+
+    def recording_download(self, dest_dir, type, name, **kwargs):
+        requested.append(type)
+        return original_download(self, dest_dir, type, name, **kwargs)
+
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "download", recording_download)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred, "--manifest"])
+
+    # a dicom left behind by an interrupted run is not proof of a finished download
+    leftover = os.path.join(out_dir, 'sourcedata', 'sub-001_ses-01', 'scans', '1-anat_T1w',
+                            'resources', 'DICOM', 'files', 'partial.dcm')
+    os.makedirs(os.path.dirname(leftover))
+    open(leftover, 'w').close()
+
+    assert main() is None
+    assert sorted(requested) == ["1", "2"]
+    outputs = _list_outputs(out_dir)
+    assert os.path.join('.xnat_downloader', 'manifest.sqlite') in outputs
+    # the downloaded scan replaced the partial one
+    assert not os.path.exists(leftover)
+    assert outputs - {os.path.join('.xnat_downloader', 'manifest.sqlite')} == \
+        ground_truth_bids_files
+
+    # the rerun finds both scans in the manifest
+    requested.clear()
+    assert main() is None
+    assert requested == []
+
+
+def test_cli_staging(monkeypatch, tmp_path):
+    import sys
+    from . import mock_xnat
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+    with open(os.path.join(data_dir, "nonbids.txt"), "r") as gt:
+        ground_truth_nonbids_files = {line.rstrip() for line in gt}
+
+    # an earlier run was killed in the middle of a download
+    stage = os.path.join(out_dir, 'sourcedata', '21', '.staging', '20180202-DTI')
+    os.makedirs(os.path.join(stage, '20180202', 'scans', '2-DTI'))
+    open(os.path.join(stage, '20180202', 'scans', '2-DTI', 'half.dcm'), 'w').close()
+
+    original_download = mock_xnat.MockScansCollection.download
+
+    def failing_download(self, dest_dir, type, name, **kwargs):
+        original_download(self, dest_dir, type, name, **kwargs)
+        if type == "3":
+            raise ValueError("archive is not complete")
+
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "download", failing_download)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred])
+
+    assert main() == 1
+    sourcedata = os.path.join(out_dir, 'sourcedata', '21')
+    # the failed scan was not moved into place and nothing is left in staging
+    assert sorted(os.listdir(sourcedata)) == ['.staging', '20180101', '20180202']
+    assert os.listdir(os.path.join(sourcedata, '.staging')) == []
+    assert not os.path.exists(os.path.join(sourcedata, '20180303'))
+
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "download", original_download)
+    assert main() is None
+    assert _list_outputs(out_dir) == ground_truth_nonbids_files
+
+
+def test_cli_verify_only(monkeypatch, tmp_path):
+    import sys
+    from ..cli import run
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'bids_test.json')
+    with open(os.path.join(data_dir, "bids.txt"), "r") as gt:
+        ground_truth_bids_files = {line.rstrip() for line in gt}
+
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred])
+    assert main() is None
+
+    # an interrupted extraction: one file cut short and one never written
+    t1w, rest = sorted(path for path in ground_truth_bids_files if path.endswith('.dcm'))
+    with open(os.path.join(out_dir, t1w), 'wb') as dcm:
+        dcm.write(b'mock')
+    os.remove(os.path.join(out_dir, rest))
+
+    def no_conversion(command):
+        raise AssertionError("verifying should not convert")
+
+    monkeypatch.setattr(run, "call", no_conversion)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "--verify-only", "-j", "2"])
+    assert main() is None
+    assert _list_outputs(out_dir) == ground_truth_bids_files
+    with open(os.path.join(out_dir, t1w), 'rb') as dcm:
+        assert dcm.read() == b"mock dicom data"
+
+
+def test_cli_metadata_cache(monkeypatch, tmp_path):
+    import sys
+    from . import mock_xnat
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+    with open(os.path.join(data_dir, "nonbids.txt"), "r") as gt:
+        ground_truth_nonbids_files = {line.rstrip() for line in gt}
+    args = ["xnat_downloader", "-i", spec, "-c", cred,
+            "--cache-ttl", "3600", "--cache-dir", str(tmp_path / 'cache')]
+
+    monkeypatch.setattr(sys, 'argv', args)
+    assert main() is None
+    assert _list_outputs(out_dir) == ground_truth_nonbids_files
+
+    def no_listing(self, *args, **kwargs):
+        raise AssertionError("listing should come from the cache")
+
+    monkeypatch.setattr(mock_xnat.MockSubject, "exists", no_listing)
+    monkeypatch.setattr(mock_xnat.MockExperiments, "get", no_listing)
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "get", no_listing)
+    assert main() is None
+
+    # clearing the cache asks xnat again
+    monkeypatch.setattr(sys, 'argv', args + ["--clear-cache"])
+    with pytest.raises(AssertionError):
+        main()
+
+
+@pytest.mark.parametrize('spec_file,ground_truth', [
+    ('bids_test.json', 'bids.txt'),
+    ('non_bids_test.json', 'nonbids.txt'),
+])
+def test_cli_bulk_metadata(monkeypatch, tmp_path, spec_file, ground_truth):
+    import sys
+    from . import mock_xnat
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, spec_file)
+    with open(os.path.join(data_dir, ground_truth), "r") as gt:
+        ground_truth_files = {line.rstrip() for line in gt}
+
+    listed = []
+    original_scans = mock_xnat.MockArray.scans
+
+    def recording_scans(self, *args, **kwargs):
+        listed.append(kwargs.get('project_id'))
+        return original_scans(self, *args, **kwargs)
+
+    def no_listing(self, *args, **kwargs):
+        raise AssertionError("scans should come from the project listing")
+
+    # only the search queries may list scans
+    monkeypatch.setattr(mock_xnat.MockArray, "scans", recording_scans)
+    monkeypatch.setattr(mock_xnat.MockSubject, "exists", no_listing)
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "get", no_listing)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "--bulk-metadata"])
+
+    assert main() is None
+    assert _list_outputs(out_dir) == ground_truth_files
+    assert listed == ["xnatDownload"]
+
+
+def test_cli_incremental(monkeypatch, tmp_path):
+    import sys
+    from . import mock_xnat
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+    with open(os.path.join(data_dir, "nonbids.txt"), "r") as gt:
+        ground_truth_nonbids_files = {line.rstrip() for line in gt}
+
+    processed = []
+    original_get_scans = mock_xnat.MockScansCollection.get
+
+    def recording_get_scans(self, *args, **kwargs):
+        processed.append(self.session.label())
+        return original_get_scans(self, *args, **kwargs)
+
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "get", recording_get_scans)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "--incremental"])
+
+    assert main() is None
+    assert sorted(processed) == ["20180101", "20180202", "20180303"]
+    assert _list_outputs(out_dir) - {os.path.join('.xnat_downloader', 'incremental.json')} == \
+        ground_truth_nonbids_files
+
+    # nothing changed on xnat
+    processed.clear()
+    assert main() is None
+    assert processed == []
+
+    # a scan was added to the second session
+    session = mock_xnat.MOCK_DATA["projects"]["xnatDownload"]["subjects"]["21"]["sessions"][1]
+    monkeypatch.setitem(session, "last_modified", "2019-05-01 08:30:00.123")
+    processed.clear()
+    assert main() is None
+    assert processed == ["20180202"]
+
+
+def test_cli_incremental_cache(monkeypatch, tmp_path):
+    import sys
+    from . import mock_xnat
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'bids_test.json')
+
+    listed = []
+    original_serve = mock_xnat.MockInterface._serve
+
+    def recording_serve(self, uri):
+        if uri.startswith('/data/experiments?'):
+            listed.append(uri)
+        return original_serve(self, uri)
+
+    monkeypatch.setattr(mock_xnat.MockInterface, "_serve", recording_serve)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "--incremental", "--cache-ttl", "3600",
+                                      "--cache-dir", str(tmp_path / 'cache')])
+    assert main() is None
+    assert listed == []
+
+    # a session is added after its subject's sessions were cached
+    subject = mock_xnat.MOCK_DATA["projects"]["xnatDownload"]["subjects"]["sub-001"]
+    monkeypatch.setitem(subject, "sessions", subject["sessions"] + [{
+        "original_label": "sub-001_ses-02",
+        "insert_date": "2019-05-01 08:30:00.0",
+        "scans": [{"id": "1", "type": "anat-T1w", "dicom_files": ["T1w_002.dcm"]}],
+    }])
+    assert main() is None
+    assert 'sub-001/ses-02/anat/sub-001_ses-02_T1w.nii.gz' in _list_outputs(out_dir)
+    # only the experiments dated on or after the mark were asked for
+    assert len(listed) == 2
+    assert all('project=xnatDownload' in uri for uri in listed)
+    assert {uri.rpartition('&')[2].partition('-')[0] for uri in listed} == {
+        'insert_date=06/13/2018', 'last_modified=06/13/2018'}
+
+
+def test_cli_plan(monkeypatch, tmp_path):
+    import json
+    import sys
+    from . import mock_xnat
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+    with open(os.path.join(data_dir, "nonbids.txt"), "r") as gt:
+        ground_truth_nonbids_files = {line.rstrip() for line in gt}
+    plan_path = str(tmp_path / 'plan.json')
+
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "--write-plan", plan_path])
+    assert main() is None
+    assert not os.path.exists(os.path.join(out_dir, 'sourcedata', '21', '20180101'))
+
+    with open(plan_path) as plan_file:
+        plan = json.load(plan_file)
+    entries = {entry['scan']: entry for entry in plan['entries']}
+    assert sorted(entries) == ['DTI', 'SAG FSPGR BRAVO', 'fMRI Resting State']
+    dti = entries['DTI']
+    assert dti['dicom_dir'] == os.path.join('sourcedata', '21', '20180202', 'scans', '2-DTI')
+    assert dti['bids_path'] == 'sub-SEH021/ses-post/dwi/sub-SEH021_ses-post_dwi.nii.gz'
+    assert dti['estimated_bytes'] == len(mock_xnat.MOCK_DICOM)
+    assert not dti['downloaded'] and not dti['converted']
+    assert plan['totals'] == {'scans': 3, 'downloads': 3,
+                              'bytes': 3 * len(mock_xnat.MOCK_DICOM), 'conversions': 3}
+    assert {entry['bids_path'] for entry in plan['entries']} <= ground_truth_nonbids_files
+
+    # execute only part of the plan, without listing anything on xnat
+    plan['entries'] = [dti]
+    with open(plan_path, 'w') as plan_file:
+        json.dump(plan, plan_file)
+
+    def no_listing(*args, **kwargs):
+        raise AssertionError("executing a plan should not list xnat")
+
+    monkeypatch.setattr(mock_xnat.MockSubjects, "get", no_listing)
+    monkeypatch.setattr(mock_xnat.MockExperiments, "get", no_listing)
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "get", no_listing)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-c", cred, "--plan", plan_path])
+    assert main() is None
+    assert _list_outputs(out_dir) == {
+        'sourcedata/21/20180202/scans/2-DTI/resources/DICOM/files/post_dti.dcm',
+        'sub-SEH021/ses-post/dwi/sub-SEH021_ses-post_dwi.json',
+        'sub-SEH021/ses-post/dwi/sub-SEH021_ses-post_dwi.nii.gz',
+    }
+
+
+def test_cli_shard(monkeypatch, tmp_path):
+    import sys
+    from . import mock_xnat
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+    with open(os.path.join(data_dir, "nonbids.txt"), "r") as gt:
+        ground_truth_nonbids_files = {line.rstrip() for line in gt}
+
+    requested = []
+    original_download = mock_xnat.MockScansCollection.download
+
+    def recording_download(self, dest_dir, type, name, **kwargs):
+        requested.append(type)
+        return original_download(self, dest_dir, type, name, **kwargs)
+
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "download", recording_download)
+    per_shard = []
+    for shard in ('0/2', '1/2'):
+        requested.clear()
+        monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                          "--manifest", "--shard", shard])
+        assert main() is None
+        per_shard.append(set(requested))
+
+    # the shards split the scans between them
+    assert per_shard[0].isdisjoint(per_shard[1])
+    assert per_shard[0] | per_shard[1] == {"1", "2", "3"}
+    state = os.path.join('.xnat_downloader', 'manifest.shard-{}-of-2.sqlite')
+    assert _list_outputs(out_dir) == ground_truth_nonbids_files | {
+        state.format(0), state.format(1)}
+
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "--merge-manifests"])
+    assert main() is None
+    manifest = os.path.join('.xnat_downloader', 'manifest.sqlite')
+    assert _list_outputs(out_dir) == ground_truth_nonbids_files | {manifest}
+
+    # a run without --shard finds every scan in the merged manifest
+    requested.clear()
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred, "--manifest"])
+    assert main() is None
+    assert requested == []
+
+    # and so do the shards of the next cluster run, which keep their own manifests
+    for shard in ('0/2', '1/2'):
+        monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                          "--manifest", "--shard", shard])
+        assert main() is None
+    assert requested == []
+    assert _list_outputs(out_dir) == ground_truth_nonbids_files | {
+        manifest, state.format(0), state.format(1)}
+
+
+def test_cli_concurrent_shards_keep_their_staging(monkeypatch, tmp_path):
+    import sys
+    import threading
+    from . import mock_xnat
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+    with open(os.path.join(data_dir, "nonbids.txt"), "r") as gt:
+        ground_truth_nonbids_files = {line.rstrip() for line in gt}
+
+    first_extracted = threading.Event()
+    second_done = threading.Event()
+    lock = threading.Lock()
+    original_download = mock_xnat.MockScansCollection.download
+
+    def pausing_download(self, *args, **kwargs):
+        result = original_download(self, *args, **kwargs)
+        with lock:
+            blocking = not first_extracted.is_set()
+            first_extracted.set()
+        if blocking:
+            # the first shard is still busy with its first scan...
+            second_done.wait(10)
+        return result
+
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "download", pausing_download)
+    results = []
+
+    def run_shard(shard):
+        sys.argv = ["xnat_downloader", "-i", spec, "-c", cred, "--shard", shard]
+        results.append(main())
+
+    monkeypatch.setattr(sys, 'argv', list(sys.argv))
+    first = threading.Thread(target=run_shard, args=('0/2',))
+    first.start()
+    try:
+        assert first_extracted.wait(10)
+        # ...when the second one starts on the same destination
+        run_shard('1/2')
+    finally:
+        second_done.set()
+        first.join(10)
+
+    assert results == [None, None]
+    assert _list_outputs(out_dir) == ground_truth_nonbids_files
+
+
+def test_cli_lock(monkeypatch, tmp_path, capsys):
+    import sys
+    from ..locks import ScanLocks
+    from ..manifest import state_path
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+    with open(os.path.join(data_dir, "nonbids.txt"), "r") as gt:
+        ground_truth_nonbids_files = {line.rstrip() for line in gt}
+
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "-j", "3", "--lock", "skip"])
+    # another process is downloading the DTI scan
+    locks = ScanLocks(state_path(out_dir, 'locks'))
+    with locks.hold('21/20180202/2/download') as held:
+        assert held
+        assert main() is None
+
+    assert 'DTI is being downloaded by another process' in capsys.readouterr().out
+    assert _list_outputs(out_dir) == {
+        path for path in ground_truth_nonbids_files if 'dwi' not in path and 'DTI' not in path}
+
+    # once it is released, the scan is picked up
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "--lock", "wait"])
+    assert main() is None
+    assert _list_outputs(out_dir) == ground_truth_nonbids_files
+
+
+def test_cli_conversion_cache(monkeypatch, tmp_path, capsys):
+    import sys
+    from pathlib import Path
+    from ..cli import run
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+
+    converted = []
+
+    def multi_echo_dcm2niix(parts):
+        # dcm2niix names the outputs of every echo itself
+        out = Path(parts[parts.index("-o") + 1])
+        fname = parts[parts.index("-f") + 1]
+        converted.append(fname)
+        for echo in ('e1', 'e2'):
+            (out / '{}_{}.nii.gz'.format(fname, echo)).write_text('mock nifti')
+            (out / '{}_{}.json'.format(fname, echo)).write_text('{}')
+        return 0
+
+    monkeypatch.setattr(run, "call", multi_echo_dcm2niix)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "--conversion-cache"])
+    assert main() is None
+    assert len(converted) == 3
+    outputs = _list_outputs(out_dir)
+    t1w = 'sub-SEH021/ses-pre/anat/sub-SEH021_ses-pre_T1w'
+    assert {t1w + '_e1.nii.gz', t1w + '_e2.json'} <= outputs
+
+    # nothing changed, nothing is converted
+    converted.clear()
+    assert main() is None
+    assert converted == []
+
+    # a missing output is put back without touching the others
+    os.remove(os.path.join(out_dir, t1w + '_e2.nii.gz'))
+    before = os.stat(os.path.join(out_dir, t1w + '_e1.nii.gz')).st_mtime_ns
+    assert main() is None
+    assert converted == ['sub-SEH021_ses-pre_T1w']
+    assert _list_outputs(out_dir) == outputs
+    assert os.stat(os.path.join(out_dir, t1w + '_e1.nii.gz')).st_mtime_ns == before
+    assert '1 output(s) of SAG FSPGR BRAVO are missing' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('installed', [True, False])
+def test_cli_batch_convert(monkeypatch, tmp_path, installed):
+    import json
+    import re
+    import sys
+    from ..cli import run
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'bids_test.json')
+    with open(os.path.join(data_dir, "bids.txt"), "r") as gt:
+        ground_truth_bids_files = {line.rstrip() for line in gt}
+
+    fake_dcm2niix = run.call
+    commands = []
+
+    def fake_call(command):
+        commands.append(os.path.basename(command[0]))
+        if commands[-1] != 'dcm2niibatch':
+            return fake_dcm2niix(command)
+        with open(command[1]) as config:
+            values = [json.loads(value) for value in
+                      re.findall(r'(?:in_dir|out_dir|filename): (.*)', config.read())]
+        # converts every scan but the T1w
+        for dcm_dir, out, fname in zip(values[::3], values[1::3], values[2::3]):
+            if not fname.endswith('T1w'):
+                fake_dcm2niix(['dcm2niix', '-o', out, '-f', fname, dcm_dir])
+        return 1
+
+    monkeypatch.setattr(run, "call", fake_call)
+    monkeypatch.setattr(run, "find_dcm2niibatch",
+                        lambda: '/usr/bin/dcm2niibatch' if installed else None)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "-j", "2", "--batch-convert"])
+
+    assert main() is None
+    assert _list_outputs(out_dir) == ground_truth_bids_files
+    if installed:
+        # one run for the session, dcm2niix for the scan it failed on
+        assert commands == ['dcm2niibatch', 'dcm2niix']
+    else:
+        assert commands == ['dcm2niix', 'dcm2niix']
+
+
+@pytest.mark.parametrize('scratch_size,commands', [
+    ('1', ['dcm2niibatch']),
+    ('0.00000002', ['dcm2niix', 'dcm2niix']),
+])
+def test_cli_batch_convert_packed(monkeypatch, tmp_path, scratch_size, commands):
+    import sys
+    import threading
+    from ..cli import run
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'bids_test.json')
+    with open(os.path.join(data_dir, "bids.txt"), "r") as gt:
+        ground_truth_bids_files = {line.rstrip() for line in gt}
+    scratch = tmp_path / 'scratch'
+
+    fake_dcm2niix = run.call
+    called = []
+
+    def fake_call(command):
+        called.append(os.path.basename(command[0]))
+        assert called[-1] == 'dcm2niix'
+        return fake_dcm2niix(command)
+
+    monkeypatch.setattr(run, "call", fake_call)
+    monkeypatch.setattr(run, "find_dcm2niibatch", lambda: None)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "--pack-dicoms", "--scratch-dir", str(scratch)])
+    assert main() is None
+    assert len(called) == 2
+
+    # the two packed scans of the session (15 bytes each) do not fit in
+    # 20 bytes of scratch together, so they are converted one at a time
+    called.clear()
+    monkeypatch.setattr(run, "find_dcm2niibatch", lambda: '/usr/bin/dcm2niibatch')
+
+    def fake_batch(scans):
+        called.append('dcm2niibatch')
+        for dcm_dir, out, fname in scans:
+            assert dcm_dir.startswith(str(scratch))
+            fake_dcm2niix(['dcm2niix', '-o', out, '-f', fname, dcm_dir])
+        return 0
+
+    monkeypatch.setattr(run, "run_dcm2niibatch", fake_batch)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "--pack-dicoms", "--batch-convert", "--overwrite-nii",
+                                      "--scratch-dir", str(scratch),
+                                      "--scratch-size", scratch_size])
+    runner = threading.Thread(target=main, daemon=True)
+    runner.start()
+    runner.join(30)
+    assert not runner.is_alive()
+    assert called == commands
+    assert os.listdir(str(scratch)) == []
+    assert {path for path in _list_outputs(out_dir) if not path.startswith('sourcedata')} == {
+        path for path in ground_truth_bids_files if not path.startswith('sourcedata')}
+
+
+def test_cli_no_keep_dicoms(monkeypatch, tmp_path):
+    import sys
+    from . import mock_xnat
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+    with open(os.path.join(data_dir, "nonbids.txt"), "r") as gt:
+        ground_truth_nonbids_files = {line.rstrip() for line in gt}
+    scratch = tmp_path / 'scratch'
+
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred, "-j", "3",
+                                      "--no-keep-dicoms", "--scratch-dir", str(scratch),
+                                      "--scratch-size", "0.000001"])
+    assert main() is None
+    assert _list_outputs(out_dir) == {path for path in ground_truth_nonbids_files
+                                      if not path.startswith('sourcedata')}
+    assert os.listdir(str(scratch)) == []
+
+    # converted scans are not downloaded again
+    def no_download(self, *args, **kwargs):
+        raise AssertionError("converted scans should not be downloaded")
+
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "download", no_download)
+    assert main() is None
+
+
+def test_cli_pack_dicoms(monkeypatch, tmp_path):
+    import sys
+    from . import mock_xnat
+    from ..cli import run
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    spec, out_dir = _write_spec(tmp_path, 'non_bids_test.json')
+    with open(os.path.join(data_dir, "nonbids.txt"), "r") as gt:
+        ground_truth_nonbids_files = {line.rstrip() for line in gt}
+    packed = {path.split('/resources/')[0] + '.zip'
+              if path.startswith('sourcedata') else path
+              for path in ground_truth_nonbids_files}
+
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred, "-j", "2",
+                                      "--pack-dicoms", "--scratch-dir",
+                                      str(tmp_path / 'scratch')])
+    assert main() is None
+    assert _list_outputs(out_dir) == packed
+
+    # packed scans are found without downloading them, and converted from scratch
+    def no_download(self, *args, **kwargs):
+        raise AssertionError("packed scans should not be downloaded")
+
+    converted = []
+    fake_dcm2niix = run.call
+
+    def recording_call(command):
+        converted.append(command[-1])
+        assert os.listdir(command[-1]) == ['resources']
+        return fake_dcm2niix(command)
+
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "download", no_download)
+    monkeypatch.setattr(run, "call", recording_call)
+    monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                      "--overwrite-nii", "--verify", "--scratch-dir",
+                                      str(tmp_path / 'scratch')])
+    assert main() is None
+    assert _list_outputs(out_dir) == packed
+    assert len(converted) == 3
+    assert all(path.startswith(str(tmp_path / 'scratch')) for path in converted)
+
+
+def test_cli_store(monkeypatch, tmp_path):
+    import sys
+    from . import mock_xnat
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    cred = os.path.join(data_dir, 'central.cfg')
+    with open(os.path.join(data_dir, "nonbids.txt"), "r") as gt:
+        ground_truth_nonbids_files = {line.rstrip() for line in gt}
+    store = str(tmp_path / 'store')
+
+    downloads = []
+    original_download = mock_xnat.MockScansCollection.download
+
+    def recording_download(self, dest_dir, type, name, **kwargs):
+        downloads.append(type)
+        return original_download(self, dest_dir, type, name, **kwargs)
+
+    monkeypatch.setattr(mock_xnat.MockScansCollection, "download", recording_download)
+    outputs = []
+    # the second destination lists the project with other options
+    for study, options in (('study1', []), ('study2', ['--bulk-metadata'])):
+        (tmp_path / study).mkdir()
+        spec, out_dir = _write_spec(tmp_path / study, 'non_bids_test.json')
+        monkeypatch.setattr(sys, 'argv', ["xnat_downloader", "-i", spec, "-c", cred,
+                                          "-j", "2", "--store", store] + options)
+        assert main() is None
+        assert _list_outputs(out_dir) == ground_truth_nonbids_files
+        outputs.append(out_dir)
+
+    # the second destination was linked from the store
+    assert sorted(downloads) == ['1', '2', '3']
+    for path in ground_truth_nonbids_files:
+        if path.startswith('sourcedata'):
+            assert os.path.samefile(os.path.join(outputs[0], path),
+                                    os.path.join(outputs[1], path))
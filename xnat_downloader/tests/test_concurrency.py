@@ -0,0 +1,99 @@
+"""Testing the adaptive download limiter"""
+import threading
+
+import pytest
+import requests
+
+from ..concurrency import AdaptiveLimiter
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _download(limiter, clock, seconds, nbytes):
+    slot = limiter.acquire()
+    clock.now += seconds
+    slot.nbytes = nbytes
+    limiter.release(slot)
+
+
+def test_limit_grows_to_ceiling():
+    clock = _Clock()
+    limiter = AdaptiveLimiter(4, clock=clock)
+    for _ in range(5):
+        _download(limiter, clock, 1, 1000)
+    assert limiter.limit == 4
+    assert [limit for _, limit in limiter.history] == [1, 2, 3, 4]
+
+
+def test_limit_halves_on_overload():
+    clock = _Clock()
+    limiter = AdaptiveLimiter(8, initial=8, clock=clock)
+    slots = [limiter.acquire() for _ in range(3)]
+    clock.now += 1
+    with pytest.raises(requests.ConnectionError):
+        with limiter.slot():
+            raise requests.ConnectionError('refused')
+    assert limiter.limit == 4
+    # downloads that ran into the same trouble do not cut it again
+    for slot in slots:
+        limiter.release(slot, failed=True)
+    assert limiter.limit == 4
+    assert limiter.in_flight == 0
+    # past the first trouble the limit grows by about a slot per round
+    for _ in range(4):
+        _download(limiter, clock, 1, 1000)
+    assert 4 < limiter.limit < 6
+
+
+def test_permanent_errors_keep_the_limit():
+    limiter = AdaptiveLimiter(4, initial=2)
+    with pytest.raises(ValueError):
+        with limiter.slot():
+            raise ValueError('not a dicom')
+    assert limiter.limit == 2
+    assert limiter.in_flight == 0
+
+
+def test_limit_drops_when_throughput_collapses():
+    clock = _Clock()
+    limiter = AdaptiveLimiter(8, initial=4, clock=clock)
+    _download(limiter, clock, 1, 1000)
+    assert limiter.limit == 5
+    # the average throughput takes a few slow downloads to fall below half
+    for _ in range(2):
+        _download(limiter, clock, 10, 1000)
+    assert limiter.limit == 7
+    _download(limiter, clock, 10, 1000)
+    assert limiter.limit == 3.5
+
+
+def test_acquire_blocks_at_the_limit():
+    limiter = AdaptiveLimiter(2, initial=1)
+    first = limiter.acquire()
+    acquired = threading.Event()
+
+    def second():
+        limiter.release(limiter.acquire())
+        acquired.set()
+
+    thread = threading.Thread(target=second)
+    thread.start()
+    assert not acquired.wait(0.1)
+    limiter.release(first)
+    assert acquired.wait(5)
+    thread.join()
+
+
+def test_report():
+    clock = _Clock()
+    limiter = AdaptiveLimiter(2, clock=clock)
+    clock.now = 10
+    _download(limiter, clock, 0, 1000)
+    clock.now = 30
+    assert limiter.report() == {'final': 2, 'min': 1, 'max': 2, 'mean': 50 / 30}
@@ -0,0 +1,51 @@
+"""Testing the record of conversions"""
+import os
+
+from ..conversions import ConversionCache
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as fh:
+        fh.write(content)
+
+
+def test_input_digest(tmp_path, monkeypatch):
+    from .. import conversions
+
+    dcm_dir = str(tmp_path / 'dicoms')
+    _write(os.path.join(dcm_dir, 'a.dcm'), 'a')
+    _write(os.path.join(dcm_dir, 'b.dcm'), 'b')
+    cache = ConversionCache(str(tmp_path), str(tmp_path / 'conversions.sqlite'))
+    digest = cache.input_digest(dcm_dir)
+
+    read = []
+    monkeypatch.setattr(conversions, 'file_md5', lambda path: read.append(path) or 'x')
+    # unchanged files are not read again
+    assert cache.input_digest(dcm_dir) == digest
+    assert read == []
+
+    _write(os.path.join(dcm_dir, 'b.dcm'), 'changed')
+    assert cache.input_digest(dcm_dir) != digest
+    assert read == [os.path.join(dcm_dir, 'b.dcm')]
+    cache.close()
+
+
+def test_missing(tmp_path):
+    bids_dir = str(tmp_path / 'sub-01' / 'func')
+    fname = 'sub-01_task-rest_bold'
+    _write(os.path.join(bids_dir, fname + '_e1.nii.gz'), 'echo 1')
+    _write(os.path.join(bids_dir, fname + '_e2.nii.gz'), 'echo 2')
+    cache = ConversionCache(str(tmp_path), str(tmp_path / 'conversions.sqlite'))
+
+    assert cache.missing(bids_dir, fname, 'digest', 'v1 -z y') is None
+    cache.record(bids_dir, fname, 'digest', 'v1 -z y',
+                 [fname + '_e1.nii.gz', fname + '_e2.nii.gz'])
+    assert cache.missing(bids_dir, fname, 'digest', 'v1 -z y') == []
+    # new dicoms or settings call for a new conversion
+    assert cache.missing(bids_dir, fname, 'other', 'v1 -z y') is None
+    assert cache.missing(bids_dir, fname, 'digest', 'v2 -z y') is None
+
+    os.remove(os.path.join(bids_dir, fname + '_e2.nii.gz'))
+    assert cache.missing(bids_dir, fname, 'digest', 'v1 -z y') == [fname + '_e2.nii.gz']
+    cache.close()
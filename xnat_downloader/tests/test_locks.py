@@ -0,0 +1,74 @@
+"""Testing the locks shared by processes writing to a destination"""
+import os
+import threading
+import time
+
+from ..locks import LeaseLock, ScanLocks
+
+
+def test_lease_lock_is_exclusive(tmp_path):
+    path = str(tmp_path / 'locks' / 'scan.lock')
+    first = LeaseLock(path)
+    second = LeaseLock(path)
+
+    assert first.acquire()
+    assert not second.acquire(wait=False)
+    first.release()
+    assert second.acquire(wait=False)
+    second.release()
+    # the unique files used to take the lock are gone
+    assert os.listdir(str(tmp_path / 'locks')) == []
+
+
+def test_stale_lease_is_taken_over(tmp_path):
+    path = str(tmp_path / 'scan.lock')
+    crashed = LeaseLock(path, lease=60)
+    assert crashed.acquire()
+    # the holder died without refreshing the lock
+    crashed._released.set()
+    old = time.time() - 120
+    os.utime(path, (old, old))
+
+    taker = LeaseLock(path, lease=60)
+    assert taker.acquire(wait=False)
+    assert os.path.getmtime(path) > old
+    taker.release()
+    # the dead holder does not remove the lock of the new one
+    assert taker.acquire(wait=False)
+    crashed.release()
+    assert os.path.exists(path)
+    taker.release()
+
+
+def test_lease_is_refreshed(tmp_path):
+    path = str(tmp_path / 'scan.lock')
+    lock = LeaseLock(path, lease=0.3)
+    assert lock.acquire()
+    old = time.time() - 60
+    os.utime(path, (old, old))
+    time.sleep(0.3)
+    assert os.path.getmtime(path) > old
+    assert not LeaseLock(path, lease=0.3).acquire(wait=False)
+    lock.release()
+
+
+def test_scan_locks_wait(tmp_path):
+    locks = ScanLocks(str(tmp_path), poll=0.01)
+    released = threading.Event()
+
+    def hold():
+        with locks.hold('sub-01/ses-01/1/download') as held:
+            assert held
+            time.sleep(0.1)
+            released.set()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    time.sleep(0.05)
+    with locks.hold('sub-01/ses-01/1/download') as held:
+        assert held
+        assert released.is_set()
+    holder.join()
+    with locks.hold('sub-01/ses-01/1/download'):
+        with locks.hold('sub-01/ses-01/1/download', wait=False) as held:
+            assert not held
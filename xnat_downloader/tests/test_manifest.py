@@ -0,0 +1,101 @@
+"""Testing the download manifest"""
+import os
+
+from ..manifest import Manifest, merge_shard_manifests, state_path
+
+
+def test_manifest_records_scan(tmp_path):
+    dcm_dir = tmp_path / 'ses' / 'scans' / '1-T1w'
+    (dcm_dir / 'resources' / 'DICOM' / 'files').mkdir(parents=True)
+    (dcm_dir / 'resources' / 'DICOM' / 'files' / 'a.dcm').write_bytes(b'abc')
+    (dcm_dir / 'resources' / 'DICOM' / 'files' / 'b.dcm').write_bytes(b'defg')
+    db = str(tmp_path / 'manifest.sqlite')
+
+    manifest = Manifest(db, 'proj')
+    assert not manifest.is_complete('sub-01', 'ses', '1')
+    manifest.record_download('sub-01', 'ses', '1', 'anat-T1w', str(dcm_dir))
+    manifest.record_conversion('sub-01', 'ses', '1', ['/out/b.nii.gz', '/out/a.json'])
+    manifest.close()
+
+    # the record survives the process that wrote it
+    manifest = Manifest(db, 'proj')
+    record = manifest.get('sub-01', 'ses', '1')
+    assert record['file_count'] == 2
+    assert record['byte_count'] == 7
+    assert record['outputs'] == ['/out/a.json', '/out/b.nii.gz']
+    assert manifest.files('sub-01', 'ses', '1') == [
+        ('resources/DICOM/files/a.dcm', 3, '900150983cd24fb0d6963f7d28e17f72'),
+        ('resources/DICOM/files/b.dcm', 4, '025e4da7edac35ede583f5e8d51aa7ec'),
+    ]
+    # other projects sharing the database do not see the scan
+    assert not Manifest(db, 'other').is_complete('sub-01', 'ses', '1')
+
+    manifest.forget('sub-01', 'ses', '1')
+    assert manifest.get('sub-01', 'ses', '1') is None
+    assert manifest.files('sub-01', 'ses', '1') == []
+
+
+def test_manifest_merge(tmp_path):
+    dcm_dir = tmp_path / 'scan'
+    dcm_dir.mkdir()
+    (dcm_dir / 'a.dcm').write_bytes(b'abc')
+    shards = []
+    for index, scan_id in enumerate(['1', '2']):
+        shard = Manifest(str(tmp_path / 'manifest.shard-{}-of-2.sqlite'.format(index)), 'proj')
+        shard.record_download('sub-01', 'ses', scan_id, 'anat-T1w', str(dcm_dir))
+        shard.close()
+        shards.append(shard.path)
+
+    merged = Manifest(str(tmp_path / 'manifest.sqlite'), 'proj')
+    for path in shards:
+        merged.merge(path)
+    assert merged.is_complete('sub-01', 'ses', '1')
+    assert merged.is_complete('sub-01', 'ses', '2')
+    assert merged.files('sub-01', 'ses', '2') == [('a.dcm', 3, '900150983cd24fb0d6963f7d28e17f72')]
+
+
+def test_manifest_shared(tmp_path):
+    import os
+
+    dcm_dir = tmp_path / 'scan'
+    dcm_dir.mkdir()
+    (dcm_dir / 'a.dcm').write_bytes(b'abc')
+    merged = Manifest(str(tmp_path / 'manifest.sqlite'), 'proj')
+    merged.record_download('sub-01', 'ses', '1', 'anat-T1w', str(dcm_dir))
+    merged.close()
+    before = os.path.getmtime(merged.path)
+
+    shard = Manifest(str(tmp_path / 'manifest.shard-0-of-2.sqlite'), 'proj', shared=merged.path)
+    assert shard.is_complete('sub-01', 'ses', '1')
+    assert not shard.is_complete('sub-01', 'ses', '2')
+    assert shard.files('sub-01', 'ses', '1') == [('a.dcm', 3, '900150983cd24fb0d6963f7d28e17f72')]
+    # what the shard records goes to its own manifest
+    shard.record_conversion('sub-01', 'ses', '1', ['sub-01_T1w.nii.gz'])
+    shard.close()
+    assert os.path.getmtime(merged.path) == before
+    own = Manifest(shard.path, 'proj')
+    assert own.get('sub-01', 'ses', '1')['outputs'] == ['sub-01_T1w.nii.gz']
+    assert own.files('sub-01', 'ses', '1') == [('a.dcm', 3, '900150983cd24fb0d6963f7d28e17f72')]
+    own.close()
+
+
+def test_merge_shard_manifests(tmp_path):
+    dest = str(tmp_path)
+    dcm_dir = tmp_path / 'scan'
+    dcm_dir.mkdir()
+    (dcm_dir / 'a.dcm').write_bytes(b'abc')
+    os.makedirs(state_path(dest))
+    for index, scan_id in enumerate(['1', '2']):
+        shard = Manifest(state_path(dest, 'manifest.shard-{}-of-2.sqlite'.format(index)), 'proj')
+        shard.record_download('sub-01', 'ses', scan_id, 'anat-T1w', str(dcm_dir))
+        shard.close()
+
+    merged = merge_shard_manifests(dest, 'proj')
+
+    assert [os.path.basename(path) for path in merged] == [
+        'manifest.shard-0-of-2.sqlite', 'manifest.shard-1-of-2.sqlite']
+    assert os.listdir(state_path(dest)) == ['manifest.sqlite']
+    manifest = Manifest(state_path(dest, 'manifest.sqlite'), 'proj')
+    assert manifest.is_complete('sub-01', 'ses', '1')
+    assert manifest.is_complete('sub-01', 'ses', '2')
+    assert merge_shard_manifests(dest, 'proj') == []
@@ -0,0 +1,85 @@
+"""Testing the archives scans are packed into"""
+import hashlib
+import os
+
+import pytest
+
+from ..packing import archive_index, archive_path, extract_scan, is_packed, is_stored, \
+    pack_scan, unpack_scan
+
+
+def test_pack_and_unpack(tmp_path):
+    dcm_dir = str(tmp_path / '1-T1w')
+    files = os.path.join(dcm_dir, 'resources', 'DICOM', 'files')
+    os.makedirs(files)
+    for name, content in (('a.dcm', b'first'), ('b.dcm', b'second')):
+        with open(os.path.join(files, name), 'wb') as dcm:
+            dcm.write(content)
+
+    archive = pack_scan(dcm_dir)
+
+    assert archive == archive_path(dcm_dir) == str(tmp_path / '1-T1w.zip')
+    assert is_packed(dcm_dir)
+    assert archive_index(archive) == {
+        'resources/DICOM/files/a.dcm': (5, hashlib.md5(b'first').hexdigest()),
+        'resources/DICOM/files/b.dcm': (6, hashlib.md5(b'second').hexdigest()),
+    }
+    extracted = extract_scan(archive, str(tmp_path / 'scratch'))
+    with open(os.path.join(extracted, 'resources', 'DICOM', 'files', 'b.dcm'), 'rb') as dcm:
+        assert dcm.read() == b'second'
+
+    unpack_scan(dcm_dir)
+    assert not is_packed(dcm_dir)
+    assert sorted(os.listdir(files)) == ['a.dcm', 'b.dcm']
+    assert not os.path.exists(archive)
+
+
+def _scan(tmp_path, names=('a.dcm', 'b.dcm', 'c.dcm')):
+    dcm_dir = str(tmp_path / '1-T1w')
+    files = os.path.join(dcm_dir, 'resources', 'DICOM', 'files')
+    os.makedirs(files)
+    for name in names:
+        with open(os.path.join(files, name), 'wb') as dcm:
+            dcm.write(name.encode())
+    return dcm_dir
+
+
+def test_pack_interrupted_while_removing_directory(monkeypatch, tmp_path):
+    from .. import packing
+
+    dcm_dir = _scan(tmp_path)
+    original_rmtree = packing.shutil.rmtree
+
+    def killed_rmtree(path, *args, **kwargs):
+        # one file is gone when the process is killed
+        os.remove(os.path.join(path, 'resources', 'DICOM', 'files', 'a.dcm'))
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(packing.shutil, 'rmtree', killed_rmtree)
+    with pytest.raises(KeyboardInterrupt):
+        pack_scan(dcm_dir)
+    monkeypatch.setattr(packing.shutil, 'rmtree', original_rmtree)
+
+    assert not os.path.exists(dcm_dir)
+    assert is_packed(dcm_dir) and is_stored(dcm_dir)
+    assert not os.path.exists(dcm_dir + '.packing')
+    assert len(archive_index(archive_path(dcm_dir))) == 3
+
+
+def test_pack_interrupted_before_archive_is_in_place(monkeypatch, tmp_path):
+    from .. import packing
+
+    dcm_dir = _scan(tmp_path)
+
+    def killed_replace(src, dst):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(packing.os, 'replace', killed_replace)
+    with pytest.raises(KeyboardInterrupt):
+        pack_scan(dcm_dir)
+    monkeypatch.undo()
+
+    assert is_stored(dcm_dir) and not is_packed(dcm_dir)
+    assert sorted(os.listdir(os.path.join(dcm_dir, 'resources', 'DICOM', 'files'))) == \
+        ['a.dcm', 'b.dcm', 'c.dcm']
+    assert not os.path.exists(dcm_dir + '.packing')
@@ -0,0 +1,97 @@
+"""Testing the retry policy"""
+from zipfile import BadZipFile
+
+import pytest
+import requests
+from pyxnat.core.errors import DatabaseError
+
+from ..retry import RetryBudgetExhausted, RetryPolicy, is_retryable, retry_after
+
+
+def _http_error(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.HTTPError('{} error'.format(status), response=response)
+
+
+def test_is_retryable():
+    assert is_retryable(requests.ConnectionError('reset'))
+    assert is_retryable(requests.Timeout('read timed out'))
+    assert is_retryable(BadZipFile('truncated'))
+    assert is_retryable(_http_error(503))
+    assert is_retryable(_http_error(429))
+    assert is_retryable(DatabaseError('request failed, status code: 502'))
+    assert not is_retryable(_http_error(404))
+    assert not is_retryable(DatabaseError('request failed, status code: 401'))
+    assert not is_retryable(ValueError('bad spec'))
+    assert not is_retryable(TypeError('unsupported operand'))
+
+
+def test_retry_after():
+    assert retry_after(_http_error(429, {'Retry-After': '30'})) == 30
+    assert retry_after(_http_error(429, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})) == 0
+    assert retry_after(_http_error(503)) is None
+    assert retry_after(RuntimeError()) is None
+
+
+def test_delay_backs_off_with_jitter():
+    policy = RetryPolicy(base_delay=2, max_delay=10, rng=lambda: 0.5)
+    assert [policy.delay(attempt) for attempt in (1, 2, 3, 4)] == [1.5, 3, 6, 7.5]
+    # the server's request wins over a shorter backoff
+    assert policy.delay(1, _http_error(503, {'Retry-After': '20'})) == 20
+
+
+def test_call_retries_until_success():
+    sleeps = []
+    policy = RetryPolicy(max_attempts=3, sleep=sleeps.append, rng=lambda: 0)
+    errors = [requests.ConnectionError('reset'), _http_error(503)]
+
+    def flaky():
+        if errors:
+            raise errors.pop(0)
+        return 'done'
+
+    assert policy.call(flaky) == 'done'
+    assert sleeps == [1, 2]
+    assert policy.retries == 2
+
+
+def test_call_raises_permanent_errors():
+    sleeps = []
+    policy = RetryPolicy(sleep=sleeps.append)
+
+    def missing():
+        raise _http_error(404)
+
+    with pytest.raises(requests.HTTPError):
+        policy.call(missing)
+    assert sleeps == []
+
+
+def test_call_gives_up_after_max_attempts():
+    calls = []
+    policy = RetryPolicy(max_attempts=3, sleep=lambda delay: None)
+
+    def down():
+        calls.append(1)
+        raise requests.ConnectionError('refused')
+
+    with pytest.raises(requests.ConnectionError):
+        policy.call(down)
+    assert len(calls) == 3
+
+
+def test_budget_is_shared_between_calls():
+    policy = RetryPolicy(max_attempts=5, budget=3, sleep=lambda delay: None)
+
+    def down():
+        raise requests.ConnectionError('refused')
+
+    with pytest.raises(RetryBudgetExhausted):
+        policy.call(down)
+    assert policy.retries == 3
+    # nothing left for the next request
+    with pytest.raises(RetryBudgetExhausted):
+        policy.call(down)
+    assert policy.retries == 3
@@ -0,0 +1,69 @@
+"""Testing the scratch space of scans whose dicoms are not kept"""
+import os
+import threading
+import time
+
+from ..scratch import ScratchSpace
+
+
+def test_area_is_removed(tmp_path):
+    scratch = ScratchSpace(str(tmp_path / 'scratch'), 100)
+    with scratch.area(10) as area:
+        open(os.path.join(area, 'a.dcm'), 'w').close()
+        assert scratch.used == 10
+    assert os.listdir(str(tmp_path / 'scratch')) == []
+    assert scratch.used == 0
+
+
+def test_reserve_waits_for_room(tmp_path):
+    scratch = ScratchSpace(str(tmp_path), 100)
+    scratch.reserve(60)
+    entered = threading.Event()
+
+    def second():
+        with scratch.area(60):
+            entered.set()
+
+    waiting = threading.Thread(target=second)
+    waiting.start()
+    time.sleep(0.05)
+    assert not entered.is_set()
+    scratch.release(60)
+    waiting.join(1)
+    assert entered.is_set()
+
+
+def test_reserve_oversized_and_unknown(tmp_path):
+    scratch = ScratchSpace(str(tmp_path), 100)
+    # larger than the capacity, but scratch is empty
+    scratch.reserve(500)
+    scratch.release(500)
+    # an unknown size takes the whole capacity
+    scratch.reserve(None)
+    assert scratch.used == 100
+    scratch.release(None)
+    assert scratch.used == 0
+
+
+def test_unknown_sizes_respect_capacity(tmp_path):
+    scratch = ScratchSpace(str(tmp_path), 100)
+    inside = []
+    most = []
+    lock = threading.Lock()
+
+    def convert():
+        with scratch.area(None):
+            with lock:
+                inside.append(1)
+                most.append(len(inside))
+            time.sleep(0.01)
+            with lock:
+                inside.pop()
+
+    threads = [threading.Thread(target=convert) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert max(most) == 1
+    assert scratch.used == 0
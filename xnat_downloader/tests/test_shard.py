@@ -0,0 +1,36 @@
+"""Testing how scans are split between shards"""
+import argparse
+
+import pytest
+
+from ..shard import assign_shards, parse_shard, shard_of, shard_suffix
+
+
+def test_parse_shard():
+    assert parse_shard('0/4') == (0, 4)
+    assert parse_shard('3/4') == (3, 4)
+    for value in ('4/4', '-1/4', '1/0', '1', 'a/b'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_shard(value)
+    assert shard_suffix((3, 4)) == '.shard-3-of-4'
+    assert shard_suffix(None) == ''
+
+
+def test_shard_of_is_stable():
+    units = [('sub-{:02d}'.format(sub), 'ses-01', 'anat-T1w') for sub in range(200)]
+    shards = [shard_of(*unit, 4) for unit in units]
+    # the same on every call (and every machine: no salted hash())
+    assert shards == [shard_of(*unit, 4) for unit in units]
+    assert shard_of('sub-01', 'ses-01', 'anat-T1w', 4) == 0
+    assert all(shards.count(shard) > 30 for shard in range(4))
+
+
+def test_assign_shards_balances_bytes():
+    sizes = [900, 500, 400, 300, 300, 200, 100, 100]
+    units = [('sub-{}'.format(i), 'ses-01', 'dwi', size) for i, size in enumerate(sizes)]
+    shards = assign_shards(units, 3)
+    loads = [sum(unit[3] for unit in units if shards[unit[:3]] == shard) for shard in range(3)]
+    assert sorted(loads) == [900, 900, 1000]
+    # a missing size falls back to hashing every scan
+    units[0] = units[0][:3] + (None,)
+    assert assign_shards(units, 3) == {unit[:3]: shard_of(*unit[:3], 3) for unit in units}
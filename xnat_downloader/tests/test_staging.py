@@ -0,0 +1,57 @@
+"""Testing the staging of downloads"""
+import os
+
+from ..staging import LOCK_SUFFIX, clean_staging, commit_staged, owned, staging_dir
+
+
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'w').close()
+
+
+def test_commit_staged(tmp_path):
+    dcm_outdir = str(tmp_path / 'sourcedata')
+    stage = staging_dir(dcm_outdir, 'ses-01-T1w')
+    _touch(os.path.join(stage, 'ses-01', 'scans', '1-T1w', 'a.dcm'))
+    _touch(os.path.join(stage, 'ses-01', 'scans', '2-bold', 'b.dcm'))
+    # left behind by a download that extracted in place
+    _touch(os.path.join(dcm_outdir, 'ses-01', 'scans', '1-T1w', 'partial.dcm'))
+
+    scan_dirs = commit_staged(stage, dcm_outdir)
+
+    assert scan_dirs == [os.path.join(dcm_outdir, 'ses-01', 'scans', '1-T1w'),
+                         os.path.join(dcm_outdir, 'ses-01', 'scans', '2-bold')]
+    assert os.listdir(scan_dirs[0]) == ['a.dcm']
+    assert not os.path.exists(stage)
+
+
+def test_clean_staging_keeps_resumable_archives(tmp_path):
+    dest = str(tmp_path)
+    stage = staging_dir(os.path.join(dest, 'sourcedata', 'sub-01'), 'ses-01-T1w')
+    _touch(os.path.join(stage, 'ses-01', 'scans', '1-T1w', 'a.dcm'))
+    _touch(os.path.join(stage, 'T1w.zip.part'))
+    _touch(os.path.join(stage, 'T1w.zip.part.json'))
+    empty = staging_dir(os.path.join(dest, 'sourcedata'), 'ses-02-T1w')
+    _touch(os.path.join(empty, 'T1w.zip'))
+
+    assert sorted(clean_staging(dest)) == sorted([stage, empty])
+    assert sorted(os.listdir(stage)) == ['T1w.zip.part', 'T1w.zip.part.json']
+    assert not os.path.exists(os.path.dirname(empty))
+
+
+def test_clean_staging_leaves_owned_directories(tmp_path):
+    dest = str(tmp_path)
+    sourcedata = os.path.join(dest, 'sourcedata')
+    running = staging_dir(sourcedata, 'ses-01-T1w')
+    crashed = staging_dir(sourcedata, 'ses-01-bold')
+    _touch(os.path.join(crashed, 'ses-01', 'scans', '2-bold', 'b.dcm'))
+    # the lease of a process that was killed is no longer refreshed
+    _touch(crashed + LOCK_SUFFIX)
+    os.utime(crashed + LOCK_SUFFIX, (0, 0))
+
+    with owned(running):
+        _touch(os.path.join(running, 'ses-01', 'scans', '1-T1w', 'a.dcm'))
+        assert clean_staging(dest) == [crashed]
+        assert os.path.exists(os.path.join(running, 'ses-01', 'scans', '1-T1w', 'a.dcm'))
+    assert not os.path.exists(crashed)
+    assert not os.path.exists(crashed + LOCK_SUFFIX)
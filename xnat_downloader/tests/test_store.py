@@ -0,0 +1,45 @@
+"""Testing the store of dicoms shared by destinations"""
+import os
+
+from ..store import ContentStore
+
+
+def _scan(root, files):
+    for name, content in files.items():
+        path = os.path.join(root, 'resources', 'DICOM', 'files', name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as dcm:
+            dcm.write(content)
+    return root
+
+
+def test_add_and_restore(tmp_path):
+    store = ContentStore(str(tmp_path / 'store'))
+    first = _scan(str(tmp_path / 'a' / '1-T1w'), {'1.dcm': b'one', '2.dcm': b'two'})
+    # the same file in another scan
+    second = _scan(str(tmp_path / 'b' / '2-bold'), {'1.dcm': b'one'})
+
+    store.add('https://xnat/data/experiments/E1/scans/1', first)
+    store.add('https://xnat/data/experiments/E1/scans/2', second)
+
+    one = os.path.join('resources', 'DICOM', 'files', '1.dcm')
+    assert os.path.samefile(os.path.join(first, one), os.path.join(second, one))
+    assert store.files('https://xnat/data/experiments/E1/scans/1')[0][:2] == (one, 3)
+    assert store.files('https://xnat/data/experiments/E1/scans/3') is None
+
+    restored = str(tmp_path / 'c' / '1-T1w')
+    assert store.restore('https://xnat/data/experiments/E1/scans/1', restored)
+    assert os.path.samefile(os.path.join(first, one), os.path.join(restored, one))
+    assert sorted(os.listdir(os.path.dirname(os.path.join(restored, one)))) == ['1.dcm', '2.dcm']
+
+
+def test_restore_lost_object(tmp_path):
+    store = ContentStore(str(tmp_path / 'store'))
+    scan = _scan(str(tmp_path / 'a' / '1-T1w'), {'1.dcm': b'one'})
+    store.add('key', scan)
+    for root, _, filenames in os.walk(str(tmp_path / 'store' / 'objects')):
+        for filename in filenames:
+            os.remove(os.path.join(root, filename))
+
+    assert not store.restore('key', str(tmp_path / 'b' / '1-T1w'))
+    assert not os.path.exists(str(tmp_path / 'b'))
@@ -0,0 +1,310 @@
+"""Testing the ways scans are transferred from xnat"""
+import io
+import json
+import os
+import zipfile
+
+import pytest
+import requests
+
+from ..transfer import (ArchiveTransfer, AutoTransfer, FilesTransfer, PyxnatTransfer,
+                        ResumableTransfer, fetch_file, stream_extract)
+from .mock_xnat import MOCK_ARCHIVE, MOCK_DICOM, MockInterface, MockResponse
+
+
+class _Unseekable(io.RawIOBase):
+    """File object zipfile cannot seek in, so it writes data descriptors"""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.data.extend(data)
+        return len(data)
+
+
+def _chunks(data, size=7):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+def _archive(files, compression=zipfile.ZIP_DEFLATED, seekable=True):
+    out = io.BytesIO() if seekable else _Unseekable()
+    with zipfile.ZipFile(out, 'w', compression) as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return bytes(out.getvalue() if seekable else out.data)
+
+
+FILES = {
+    'ses/scans/1-T1w/resources/DICOM/files/a.dcm': b'a' * 5000,
+    'ses/scans/1-T1w/resources/DICOM/files/b.dcm': bytes(range(256)) * 40,
+    'ses/scans/2-bold/resources/DICOM/files/c.dcm': b'',
+}
+
+
+@pytest.mark.parametrize('compression,seekable', [
+    (zipfile.ZIP_DEFLATED, True),
+    (zipfile.ZIP_STORED, True),
+    # what a server building the archive on the fly sends
+    (zipfile.ZIP_DEFLATED, False),
+])
+def test_stream_extract(tmp_path, compression, seekable):
+    data = _archive(FILES, compression, seekable)
+
+    paths = stream_extract(_chunks(data), str(tmp_path))
+
+    assert sorted(paths) == sorted(str(tmp_path / name) for name in FILES)
+    for name, content in FILES.items():
+        assert (tmp_path / name).read_bytes() == content
+
+
+def test_stream_extract_truncated(tmp_path):
+    data = _archive(FILES, seekable=False)
+
+    with pytest.raises(EOFError):
+        stream_extract(_chunks(data[:len(data) // 2]), str(tmp_path))
+    # cut off right between two members, or before the central directory
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    for end in (archive.infolist()[1].header_offset, archive.start_dir):
+        with pytest.raises(EOFError):
+            stream_extract(_chunks(data[:end]), str(tmp_path / str(end)))
+
+
+def test_stream_extract_rejects_escaping_members(tmp_path):
+    data = _archive({'../evil.dcm': b'x'})
+
+    with pytest.raises(zipfile.BadZipFile):
+        stream_extract(_chunks(data), str(tmp_path / 'out'))
+    assert not (tmp_path / 'evil.dcm').exists()
+
+
+SCAN_URI = '/data/projects/xnatDownload/subjects/sub-001/experiments/sub-001_ses-01/scans/1'
+FILE_URI = SCAN_URI + '/resources/DICOM/files/T1w_001.dcm'
+
+
+def _fail_after(monkeypatch, nbytes):
+    """makes the next download break off after nbytes"""
+    original = MockResponse.iter_content
+
+    def broken_iter_content(self, chunk_size=1):
+        monkeypatch.setattr(MockResponse, 'iter_content', original)
+        yield self.content[:nbytes]
+        raise requests.ConnectionError('connection reset')
+
+    monkeypatch.setattr(MockResponse, 'iter_content', broken_iter_content)
+
+
+@pytest.mark.parametrize('accept_ranges,ranges', [(True, ['bytes=5-']), (False, ['bytes=5-'])])
+def test_fetch_file_resumes(monkeypatch, tmp_path, accept_ranges, ranges):
+    intf = MockInterface(server='https://xnat.invalid')
+    intf.accept_ranges = accept_ranges
+    path = str(tmp_path / 'T1w_001.dcm')
+
+    _fail_after(monkeypatch, 5)
+    with pytest.raises(requests.ConnectionError):
+        fetch_file(intf, FILE_URI, path, resume=True)
+    assert (tmp_path / 'T1w_001.dcm.part').read_bytes() == MOCK_DICOM[:5]
+
+    size = fetch_file(intf, FILE_URI, path, resume=True)
+    assert intf.ranges == ranges
+    assert size == len(MOCK_DICOM)
+    assert (tmp_path / 'T1w_001.dcm').read_bytes() == MOCK_DICOM
+    assert sorted(os.listdir(tmp_path)) == ['T1w_001.dcm']
+
+
+def test_fetch_file_restarts_changed_file(monkeypatch, tmp_path):
+    intf = MockInterface(server='https://xnat.invalid')
+    path = str(tmp_path / 'T1w_001.dcm')
+    _fail_after(monkeypatch, 5)
+    with pytest.raises(requests.ConnectionError):
+        fetch_file(intf, FILE_URI, path, resume=True)
+    # the file on xnat no longer matches the ETag of the first attempt
+    (tmp_path / 'T1w_001.dcm.part.json').write_text(
+        json.dumps({'uri': FILE_URI, 'etag': '"old"', 'last_modified': None}))
+
+    fetch_file(intf, FILE_URI, path, resume=True)
+    assert (tmp_path / 'T1w_001.dcm').read_bytes() == MOCK_DICOM
+
+
+def test_fetch_file_without_resume_removes_part(monkeypatch, tmp_path):
+    intf = MockInterface(server='https://xnat.invalid')
+    _fail_after(monkeypatch, 5)
+    with pytest.raises(requests.ConnectionError):
+        fetch_file(intf, FILE_URI, str(tmp_path / 'T1w_001.dcm'))
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize('error,raised', [
+    # what pyxnat raises when it fails to report a dropped connection
+    (TypeError('write() argument must be str, not ConnectionError'), ConnectionError),
+    (TypeError('unsupported operand'), TypeError),
+])
+def test_pyxnat_transfer_errors(monkeypatch, tmp_path, error, raised):
+    from . import mock_xnat
+
+    def failing_download(self, *args, **kwargs):
+        raise error
+
+    monkeypatch.setattr(mock_xnat.MockScansCollection, 'download', failing_download)
+    intf = MockInterface(server='https://xnat.invalid')
+    session = intf.select.project('xnatDownload').subject('sub-001').session('sub-001_ses-01')
+    with pytest.raises(raised):
+        PyxnatTransfer().download(session, '1', 'anat_T1w', str(tmp_path))
+
+
+def test_resumable_transfer(monkeypatch, tmp_path):
+    intf = MockInterface(server='https://xnat.invalid')
+    session = intf.select.project('xnatDownload').subject('sub-001').session('sub-001_ses-01')
+
+    _fail_after(monkeypatch, 40)
+    with pytest.raises(requests.ConnectionError):
+        ResumableTransfer().download(session, '1,2', 'both', str(tmp_path))
+    paths = ResumableTransfer().download(session, '1,2', 'both', str(tmp_path))
+
+    assert intf.ranges == ['bytes=40-']
+    assert len(paths) == 2
+    assert all(open(path, 'rb').read() for path in paths)
+    assert sorted(os.listdir(tmp_path)) == ['sub-001_ses-01']
+
+
+def _archive_session(tmp_path, monkeypatch):
+    """a session of the mock server whose archive is mounted under tmp_path/archive"""
+    from . import mock_xnat
+
+    def no_zip(self, *args, **kwargs):
+        raise AssertionError("the scans should be copied from the archive")
+
+    monkeypatch.setattr(mock_xnat.MockScansCollection, 'download', no_zip)
+    archive = mock_xnat.mount_archive(str(tmp_path / 'archive'))
+    intf = MockInterface(server='https://xnat.invalid')
+    session = intf.select.project('xnatDownload').subject('sub-001').session('sub-001_ses-01')
+    return archive, session
+
+
+@pytest.mark.parametrize('link', [False, True])
+def test_archive_transfer(monkeypatch, tmp_path, link):
+    archive, session = _archive_session(tmp_path, monkeypatch)
+    transfer = ArchiveTransfer(archive, MOCK_ARCHIVE, link=link)
+
+    paths = transfer.download(session, '1,2', 'both', str(tmp_path / 'out'))
+
+    scan = session.scan('1')
+    dst = tmp_path / 'out' / scan.path() / 'T1w_001.dcm'
+    src = os.path.join(archive, os.path.relpath(scan.archive_path('T1w_001.dcm'), MOCK_ARCHIVE))
+    assert len(paths) == 2 and str(dst) in paths
+    assert dst.read_bytes() == MOCK_DICOM
+    assert os.stat(dst).st_mtime_ns == os.stat(src).st_mtime_ns
+    assert os.path.samefile(dst, src) == link
+
+
+def test_archive_transfer_keeps_copied_files(monkeypatch, tmp_path):
+    import shutil
+
+    archive, session = _archive_session(tmp_path, monkeypatch)
+    transfer = ArchiveTransfer(archive, MOCK_ARCHIVE)
+    transfer.download(session, '1', 'anat_T1w', str(tmp_path / 'out'))
+
+    copies = []
+    monkeypatch.setattr(shutil, 'copy2', lambda src, dst: copies.append(src))
+    transfer.download(session, '1', 'anat_T1w', str(tmp_path / 'out'))
+    assert copies == []
+
+
+def test_archive_transfer_falls_back_to_http(monkeypatch, tmp_path):
+    from . import mock_xnat
+
+    archive, session = _archive_session(tmp_path, monkeypatch)
+    # scan 2 is not in the mounted archive (yet)
+    scan_dir = os.path.join(archive, 'xnatDownload', 'arc001', 'sub-001_ses-01', 'SCANS', '2')
+    for name in os.listdir(os.path.join(scan_dir, 'DICOM')):
+        os.remove(os.path.join(scan_dir, 'DICOM', name))
+    over_http = []
+    monkeypatch.setattr(mock_xnat.MockScansCollection, 'download',
+                        lambda self, dest_dir, type, name, **kwargs: over_http.append(type))
+
+    transfer = ArchiveTransfer(archive, MOCK_ARCHIVE)
+    paths = transfer.download(session, '1,2', 'both', str(tmp_path / 'out'))
+
+    assert len(paths) == 1
+    assert over_http == ['2']
+
+
+def _session_with_files(monkeypatch, nfiles):
+    """the first session of the mock server, with nfiles files in scan 1"""
+    import copy
+    from . import mock_xnat
+
+    data = copy.deepcopy(mock_xnat.MOCK_DATA)
+    session_data = data['projects']['xnatDownload']['subjects']['sub-001']['sessions'][0]
+    session_data['scans'][0]['dicom_files'] = ['T1w_{:03d}.dcm'.format(i) for i in range(nfiles)]
+    monkeypatch.setattr(mock_xnat, 'MOCK_DATA', data)
+    intf = MockInterface(server='https://xnat.invalid')
+    return intf, intf.select.project('xnatDownload').subject('sub-001').session('sub-001_ses-01')
+
+
+def test_files_transfer(monkeypatch, tmp_path):
+    import threading
+    import time
+    from . import mock_xnat
+
+    intf, session = _session_with_files(monkeypatch, 12)
+    monkeypatch.setattr(mock_xnat.MockScansCollection, 'download',
+                        lambda self, *args, **kwargs: pytest.fail('no zip archive expected'))
+    lock = threading.Lock()
+    active = []
+    most = []
+    original_get = MockInterface.get
+
+    def slow_get(self, uri, **kwargs):
+        with lock:
+            active.append(uri)
+            most.append(len(active))
+        time.sleep(0.01)
+        try:
+            return original_get(self, uri, **kwargs)
+        finally:
+            with lock:
+                active.remove(uri)
+
+    monkeypatch.setattr(MockInterface, 'get', slow_get)
+
+    paths = FilesTransfer(workers=3).download(session, '1,2', 'both', str(tmp_path))
+
+    assert len(paths) == 13
+    assert all(open(path, 'rb').read() == MOCK_DICOM for path in paths)
+    assert (tmp_path / session.scan('1').path() / 'T1w_011.dcm').exists()
+    assert max(most) == 3
+    assert not any('format=zip' in uri for uri in intf.requests)
+
+    # a second attempt only lists the scans
+    del intf.requests[:]
+    FilesTransfer(workers=3).download(session, '1,2', 'both', str(tmp_path))
+    assert all(uri.endswith('files?format=json') for uri in intf.requests)
+
+
+@pytest.mark.parametrize('min_bytes,per_file', [(None, False), (0, True)])
+def test_auto_transfer(monkeypatch, tmp_path, min_bytes, per_file):
+    from . import mock_xnat
+
+    intf, session = _session_with_files(monkeypatch, 3)
+    archives = []
+    original_download = mock_xnat.MockScansCollection.download
+
+    def recording_download(self, dest_dir, type, name, **kwargs):
+        archives.append(type)
+        return original_download(self, dest_dir, type, name, **kwargs)
+
+    monkeypatch.setattr(mock_xnat.MockScansCollection, 'download', recording_download)
+    if min_bytes is None:
+        # the mock dicoms are far too small to be worth a request each
+        transfer = AutoTransfer()
+    else:
+        transfer = AutoTransfer(min_bytes=min_bytes, min_file_size=0)
+
+    transfer.download(session, '1,2', 'both', str(tmp_path))
+
+    assert archives == ([] if per_file else ['1,2'])
+    assert len(os.listdir(tmp_path / session.scan('1').path())) == 3
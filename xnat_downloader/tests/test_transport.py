@@ -0,0 +1,34 @@
+"""Testing the HTTP transport settings"""
+import requests
+from requests.adapters import HTTPAdapter
+
+from ..transport import configure_transport
+
+
+class _Interface:
+    def __init__(self):
+        self._http = requests.Session()
+
+
+def test_configure_transport(monkeypatch):
+    sent = []
+
+    def fake_send(self, request, **kwargs):
+        sent.append(kwargs['timeout'])
+        response = requests.Response()
+        response.status_code = 200
+        response.request = request
+        return response
+
+    monkeypatch.setattr(HTTPAdapter, 'send', fake_send)
+    intf = _Interface()
+
+    adapter = configure_transport(intf, 9, connect_timeout=5, read_timeout=120)
+
+    assert intf._http.get_adapter('https://xnat.invalid/data') is adapter
+    assert intf._http.get_adapter('http://xnat.invalid/data') is adapter
+    assert adapter._pool_maxsize == 9
+
+    intf._http.get('https://xnat.invalid/data/projects')
+    intf._http.get('https://xnat.invalid/data/projects', timeout=1)
+    assert sent == [(5, 120), 1]
@@ -0,0 +1,40 @@
+"""Testing the comparison of downloaded scans with xnat's file catalog"""
+import hashlib
+
+import pytest
+
+from ..packing import pack_scan
+from ..verify import compare_archive, compare_files
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_compare_files(tmp_path, packed):
+    files = tmp_path / 'resources' / 'DICOM' / 'files'
+    files.mkdir(parents=True)
+    (files / 'good.dcm').write_bytes(b'good')
+    (files / 'short.dcm').write_bytes(b'sho')
+    (files / 'corrupt.dcm').write_bytes(b'xxxx')
+    (files / 'nodigest.dcm').write_bytes(b'xxxx')
+
+    def remote(name, content, digest=True):
+        return {'path': 'resources/DICOM/files/' + name,
+                'size': len(content),
+                'digest': hashlib.md5(content).hexdigest() if digest else None,
+                'uri': '/data/files/' + name}
+
+    remote_files = [remote('good.dcm', b'good'),
+                    remote('short.dcm', b'short'),
+                    remote('corrupt.dcm', b'abcd'),
+                    remote('nodigest.dcm', b'abcd', digest=False),
+                    remote('gone.dcm', b'gone')]
+
+    if packed:
+        scan_dir = str(tmp_path)
+        pack_scan(scan_dir)
+        missing, mismatched = compare_archive(remote_files, scan_dir)
+    else:
+        missing, mismatched = compare_files(remote_files, str(tmp_path))
+
+    assert [entry['path'] for entry in missing] == ['resources/DICOM/files/gone.dcm']
+    assert [entry['path'] for entry in mismatched] == ['resources/DICOM/files/short.dcm',
+                                                       'resources/DICOM/files/corrupt.dcm']
@@ -0,0 +1,123 @@
+"""Testing the stalled download watchdog"""
+import pytest
+import requests
+
+from ..watchdog import TransferStalled, Watchdog
+from .mock_xnat import MockResponse
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class _Response(MockResponse):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def _watched_response(watchdog, session):
+    response = _Response(b"x" * 100)
+    response.url = "https://xnat.invalid/data/projects"
+    for hook in session.hooks["response"]:
+        hook(response)
+    return response
+
+
+def test_watchdog_aborts_stalled_download():
+    clock = _Clock()
+    session = requests.Session()
+    watchdog = Watchdog(floor=10, window=5, clock=clock)
+    watchdog.install(session)
+    watchdog.install(session)
+    assert session.hooks["response"].count(watchdog._track) == 1
+
+    with pytest.raises(TransferStalled):
+        with watchdog.watch() as transfer:
+            response = _watched_response(watchdog, session)
+            chunks = response.iter_content(chunk_size=10)
+            # xnat takes its time to build the archive before the first byte
+            clock.now = 20
+            watchdog.check()
+            next(chunks)
+            clock.now = 21
+            watchdog.check()
+            clock.now = 24
+            watchdog.check()
+            assert not transfer.stalled
+            clock.now = 27
+            watchdog.check()
+            assert response.closed
+    assert transfer.nbytes == 10
+    assert watchdog.stalls == {"xnat.invalid": 1}
+    watchdog.close()
+
+
+def test_watchdog_leaves_steady_download_alone():
+    clock = _Clock()
+    session = requests.Session()
+    watchdog = Watchdog(floor=10, window=5, clock=clock)
+    watchdog.install(session)
+
+    with watchdog.watch() as transfer:
+        response = _watched_response(watchdog, session)
+        for chunk in response.iter_content(chunk_size=20):
+            clock.now += 1
+            watchdog.check()
+    assert transfer.nbytes == 100
+    assert not response.closed
+    assert not watchdog.stalls
+    # responses outside of a watched download are not counted
+    _watched_response(watchdog, session)
+    watchdog.close()
+
+
+def test_watchdog_aborts_download_without_a_first_byte():
+    clock = _Clock()
+    session = requests.Session()
+    watchdog = Watchdog(floor=10, window=5, first_byte=30, clock=clock)
+    watchdog.install(session)
+    assert Watchdog(floor=10, window=5).first_byte == 15
+
+    with pytest.raises(TransferStalled, match='sent nothing for 30 s'):
+        with watchdog.watch() as transfer:
+            # the headers arrived, the body never does
+            response = _watched_response(watchdog, session)
+            assert transfer.waiting == 1
+            for _ in range(5):
+                watchdog.check()
+                clock.now += 5
+            assert not transfer.stalled
+            clock.now = 30
+            watchdog.check()
+            assert response.closed
+    assert transfer.nbytes == 0
+    assert watchdog.stalls == {"xnat.invalid": 1}
+    watchdog.close()
+
+
+def test_watchdog_ignores_time_after_the_last_byte():
+    clock = _Clock()
+    session = requests.Session()
+    watchdog = Watchdog(floor=10, window=5, clock=clock)
+    watchdog.install(session)
+
+    with watchdog.watch() as transfer:
+        response = _watched_response(watchdog, session)
+        chunks = response.iter_content(chunk_size=20)
+        next(chunks)
+        assert (transfer.waiting, transfer.receiving) == (0, 1)
+        assert b''.join(chunks)
+        assert (transfer.waiting, transfer.receiving) == (0, 0)
+        # e.g. extracting the archive that was downloaded
+        for _ in range(10):
+            clock.now += 5
+            watchdog.check()
+    assert not transfer.stalled
+    assert not watchdog.stalls
+    watchdog.close()
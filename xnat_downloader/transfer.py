@@ -0,0 +1,668 @@
+"""Ways of getting the dicoms of xnat scans onto the local disk."""
+import contextvars
+import json
+import logging
+import os
+import re
+import shutil
+import struct
+import uuid
+import zlib
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from zipfile import BadZipFile
+
+# bytes requested from the server / read from the archive at a time
+CHUNK_SIZE = 1024 * 1024
+
+LOCAL_HEADER_SIG = b'PK\x03\x04'
+DATA_DESCRIPTOR_SIG = b'PK\x07\x08'
+# what may follow the last member: the central directory, or the end of
+# central directory records of an archive without members
+END_SIGS = (b'PK\x01\x02', b'PK\x06\x06', b'PK\x05\x06')
+# signature, version, flags, method, time, date, crc, compressed size,
+# uncompressed size, name length, extra field length
+LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+ZIP64_EXTRA_ID = 0x0001
+FLAG_DATA_DESCRIPTOR = 0x08
+STORED = 0
+DEFLATED = 8
+
+
+class ChunkReader:
+    """
+    Reads exact amounts of bytes from an iterable of byte chunks
+    (e.g. requests.Response.iter_content) while holding at most
+    one chunk in memory.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = bytearray()
+
+    def _fill(self, size):
+        while len(self._buf) < size:
+            try:
+                self._buf.extend(next(self._chunks))
+            except StopIteration:
+                return False
+        return True
+
+    def read(self, size):
+        """Returns exactly size bytes, raising EOFError if the stream ends first"""
+        if not self._fill(size):
+            raise EOFError('archive ended unexpectedly')
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+    def read_some(self, size):
+        """Returns between 1 and size bytes (an empty bytes object at the end)"""
+        if not self._buf:
+            self._fill(1)
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+    def peek(self, size):
+        """Returns up to size bytes without consuming them"""
+        self._fill(size)
+        return bytes(self._buf[:size])
+
+    def unread(self, data):
+        """Puts data back at the front of the stream"""
+        self._buf[:0] = data
+
+
+def _safe_path(dest_dir, name):
+    """Joins an archive member name onto dest_dir, refusing to leave dest_dir"""
+    path = os.path.normpath(os.path.join(dest_dir, name))
+    if os.path.isabs(name) or not path.startswith(os.path.normpath(dest_dir) + os.sep):
+        raise BadZipFile('archive member escapes the destination: {}'.format(name))
+    return path
+
+
+def _zip64_sizes(extra, csize, usize):
+    """Reads the 64 bit sizes from the extra field when the header defers to it"""
+    pos = 0
+    while pos + 4 <= len(extra):
+        header_id, length = struct.unpack('<HH', extra[pos:pos + 4])
+        field = extra[pos + 4:pos + 4 + length]
+        if header_id == ZIP64_EXTRA_ID:
+            values = list(struct.unpack('<%dQ' % (len(field) // 8), field[:len(field) // 8 * 8]))
+            if usize == 0xFFFFFFFF and values:
+                usize = values.pop(0)
+            if csize == 0xFFFFFFFF and values:
+                csize = values.pop(0)
+            return csize, usize, True
+        pos += 4 + length
+    return csize, usize, False
+
+
+def _extract_member(reader, out, method, csize, size_unknown, name):
+    """Writes the decompressed data of one member to out, returning its CRC-32"""
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if method == DEFLATED else None
+    crc = 0
+    if size_unknown:
+        # only deflated members get here, their data marks its own end
+        while not decompressor.eof:
+            data = reader.read_some(CHUNK_SIZE)
+            if not data:
+                raise EOFError('archive ended inside {}'.format(name))
+            data = decompressor.decompress(data)
+            crc = zlib.crc32(data, crc)
+            out.write(data)
+        reader.unread(decompressor.unused_data)
+        return crc
+
+    remaining = csize
+    while remaining:
+        data = reader.read_some(min(CHUNK_SIZE, remaining))
+        if not data:
+            raise EOFError('archive ended inside {}'.format(name))
+        remaining -= len(data)
+        if decompressor is not None:
+            data = decompressor.decompress(data)
+        crc = zlib.crc32(data, crc)
+        out.write(data)
+    if decompressor is not None:
+        data = decompressor.flush()
+        crc = zlib.crc32(data, crc)
+        out.write(data)
+    return crc
+
+
+def stream_extract(chunks, dest_dir):
+    """
+    Extracts a zip archive while it is being received
+
+    Members are decompressed chunk by chunk straight into their final
+    location, so the archive itself never touches the disk and memory use
+    does not depend on the size of the archive.
+
+    Parameters
+    ----------
+    chunks: iterable
+        byte strings that make up the zip archive, in order
+    dest_dir: string
+        directory the members of the archive are extracted into
+
+    Returns
+    -------
+    paths: list
+        the files that were extracted
+
+    Raises
+    ------
+    EOFError
+        if the archive ends before its central directory, even between two
+        members (its files are then incomplete)
+    """
+    reader = ChunkReader(chunks)
+    paths = []
+    while reader.peek(4) == LOCAL_HEADER_SIG:
+        (_, _, flags, method, _, _, crc,
+         csize, usize, name_len, extra_len) = LOCAL_HEADER.unpack(reader.read(LOCAL_HEADER.size))
+        name = reader.read(name_len).decode('utf-8')
+        csize, usize, zip64 = _zip64_sizes(reader.read(extra_len), csize, usize)
+        has_descriptor = flags & FLAG_DATA_DESCRIPTOR
+        if method not in (STORED, DEFLATED):
+            raise BadZipFile('unsupported compression method {} for {}'.format(method, name))
+        if method == STORED and has_descriptor and csize == 0:
+            # the end of a stored member can only be found with its size
+            raise BadZipFile('cannot stream stored member without a size: {}'.format(name))
+
+        path = _safe_path(dest_dir, name)
+        if name.endswith('/'):
+            os.makedirs(path, exist_ok=True)
+            out_path = os.devnull
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            out_path = path
+        with open(out_path, 'wb') as out:
+            written_crc = _extract_member(reader, out, method, csize,
+                                          has_descriptor and csize == 0, name)
+
+        if has_descriptor:
+            if reader.peek(4) == DATA_DESCRIPTOR_SIG:
+                reader.read(4)
+            crc = struct.unpack('<I', reader.read(4))[0]
+            reader.read(16 if zip64 else 8)
+        if written_crc != crc:
+            raise BadZipFile('bad CRC-32 for {}'.format(name))
+        if not name.endswith('/'):
+            paths.append(path)
+    tail = reader.peek(4)
+    if len(tail) < 4:
+        raise EOFError('archive ended before its central directory')
+    if tail not in END_SIGS:
+        raise BadZipFile('unexpected data after {} member(s)'.format(len(paths)))
+    return paths
+
+
+def _content_range_start(response):
+    """The first byte of a 206 response (None if it does not say)"""
+    match = re.match(r'bytes (\d+)-', response.headers.get('Content-Range', ''))
+    return int(match.group(1)) if match else None
+
+
+def _load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as checkpoint:
+            return json.load(checkpoint)
+    except ValueError:
+        return None
+
+
+def fetch_file(intf, uri, path, resume=False):
+    """
+    Downloads a single file from xnat, replacing path only once the
+    whole file has arrived
+
+    The file is written to path + '.part'. With resume, a .part left by an
+    earlier attempt is kept and continued with a Range request; the server's
+    ETag (or Last-Modified date) is sent along as If-Range, so a file that
+    changed in the meantime is sent again whole. Servers that ignore Range
+    send the whole file, which then replaces the .part.
+
+    Parameters
+    ----------
+    intf: object
+        the pyxnat Interface (anything with a requests-like get method)
+    uri: string
+        the REST path of the file (e.g. /data/experiments/.../files/a.dcm)
+    path: string
+        where the file is written
+    resume: bool
+        keep the .part of a failed download and continue it next time
+
+    Returns
+    -------
+    size: int
+        the size of the file
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.part'
+    checkpoint_path = tmp_path + '.json'
+    offset = 0
+    headers = {}
+    if resume and os.path.exists(tmp_path):
+        checkpoint = _load_checkpoint(checkpoint_path)
+        if checkpoint is not None and checkpoint.get('uri') == uri:
+            offset = os.path.getsize(tmp_path)
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            validator = checkpoint.get('etag') or checkpoint.get('last_modified')
+            if validator:
+                headers['If-Range'] = validator
+
+    if headers:
+        response = intf.get(uri, stream=True, headers=headers)
+    else:
+        response = intf.get(uri, stream=True)
+    if offset and response.status_code == 416:
+        # the .part does not fit the file on the server, start over
+        response.close()
+        os.remove(tmp_path)
+        return fetch_file(intf, uri, path, resume)
+
+    size = 0
+    try:
+        response.raise_for_status()
+        if offset and response.status_code == 206 and _content_range_start(response) == offset:
+            mode = 'ab'
+        else:
+            offset = 0
+            mode = 'wb'
+            if resume:
+                with open(checkpoint_path, 'w') as checkpoint:
+                    json.dump({'uri': uri,
+                               'etag': response.headers.get('ETag'),
+                               'last_modified': response.headers.get('Last-Modified')},
+                              checkpoint)
+        with open(tmp_path, mode) as out:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                out.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        if not resume and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        response.close()
+    os.replace(tmp_path, path)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return offset + size
+
+
+def list_remote_files(intf, scan_uri):
+    """
+    Lists every file xnat has for a scan in a single request
+
+    Parameters
+    ----------
+    intf: object
+        the pyxnat Interface
+    scan_uri: string
+        REST path of the scan (e.g. /data/experiments/XNAT_E001/scans/1)
+
+    Returns
+    -------
+    remote_files: list
+        dictionaries with the path of the file relative to the scan directory
+        (resources/<resource>/files/<name>), its size, its md5 digest
+        (None if xnat did not record one) and its uri
+    """
+    response = intf.get(scan_uri + '/files?format=json')
+    try:
+        response.raise_for_status()
+        entries = response.json()['ResultSet']['Result']
+    finally:
+        response.close()
+
+    remote_files = []
+    for entry in entries:
+        uri = entry['URI']
+        # everything after /files/ is the path inside the resource
+        name = uri.split('/files/', 1)[1]
+        remote_files.append({
+            'path': os.path.join('resources', entry.get('collection') or 'DICOM', 'files', name),
+            'size': int(entry['Size']) if entry.get('Size') not in (None, '') else None,
+            'digest': entry.get('digest') or None,
+            'uri': uri,
+        })
+    return remote_files
+
+
+class PyxnatTransfer:
+    """
+    Downloads scans through pyxnat, which saves the zip archive built by
+    xnat next to the output and extracts it afterwards.
+    """
+
+    def download(self, scan_par, scan_ids, name, dest_dir):
+        """
+        Downloads and extracts the dicoms of one or more scans
+
+        Parameters
+        ----------
+        scan_par: object
+            pyxnat session object the scans belong to
+        scan_ids: string
+            comma separated scan ids (e.g. "1" or "1,2,400")
+        name: string
+            name of the zip archive
+        dest_dir: string
+            directory the session folder of dicoms is extracted into
+        """
+        try:
+            return scan_par.scans().download(dest_dir=dest_dir,
+                                             type=scan_ids,
+                                             name=name,
+                                             extract=True,
+                                             removeZip=True)
+        except TypeError as err:
+            # pyxnat swallows connection errors by writing the exception to
+            # stderr, which raises TypeError instead
+            if 'write() argument must be str' not in str(err):
+                raise
+            raise ConnectionError('download of scan(s) {} failed: {}'.format(
+                scan_ids, err)) from err
+
+
+class StreamTransfer(PyxnatTransfer):
+    """
+    Downloads scans by extracting the zip archive built by xnat as it
+    arrives, without saving the archive to disk first.
+    """
+
+    def download(self, scan_par, scan_ids, name, dest_dir):
+        scans = scan_par.scans()
+        uri = '{base}/{ids}/files?format=zip'.format(base=scans._cbase, ids=scan_ids)
+        response = scans._intf.get(uri, stream=True)
+        try:
+            response.raise_for_status()
+            return stream_extract(response.iter_content(chunk_size=CHUNK_SIZE), dest_dir)
+        finally:
+            response.close()
+
+
+class ResumableTransfer(PyxnatTransfer):
+    """
+    Downloads the zip archive built by xnat to a .part file that a retry
+    (or a later run) continues where it stopped, then extracts it.
+    """
+
+    def download(self, scan_par, scan_ids, name, dest_dir):
+        scans = scan_par.scans()
+        uri = '{base}/{ids}/files?format=zip'.format(base=scans._cbase, ids=scan_ids)
+        zip_path = os.path.join(dest_dir, name + '.zip')
+        fetch_file(scans._intf, uri, zip_path, resume=True)
+        try:
+            with open(zip_path, 'rb') as archive:
+                return stream_extract(iter(lambda: archive.read(CHUNK_SIZE), b''), dest_dir)
+        finally:
+            # a broken archive (e.g. stitched from two different builds of
+            # the same archive) is downloaded again from the start
+            os.remove(zip_path)
+
+
+def _same_file(src_stat, path):
+    """True if path has the size and modification time of the file src_stat describes"""
+    try:
+        dst_stat = os.stat(path)
+    except OSError:
+        return False
+    return (dst_stat.st_size, dst_stat.st_mtime_ns) == (src_stat.st_size, src_stat.st_mtime_ns)
+
+
+def _scan_dir(scan_par, scan_id, dest_dir):
+    """The directory a scan is extracted into, named like in the zip archives of xnat"""
+    scan_type = re.sub(r'[^\w]', '_', scan_par.scan(scan_id).attrs.get('type'))
+    return os.path.join(dest_dir, scan_par.label(), 'scans', '{}-{}'.format(scan_id, scan_type))
+
+
+class ArchiveTransfer(PyxnatTransfer):
+    """
+    Copies (or hard links) the dicoms of scans straight from the archive of
+    xnat, for machines that mount it (e.g. the xnat host or a cluster next
+    to it), instead of having xnat zip them and send them over http.
+
+    The path of every file in the archive comes from the file catalog of the
+    scan (``files?format=json&locator=absolutePath``). A scan whose files
+    are not all found in the mounted archive with the size the catalog
+    gives (e.g. the archive is mounted elsewhere or a file is being
+    rewritten) is downloaded over http instead. Copies keep the modification
+    time of the archive, so a file already copied with the same size and
+    modification time (e.g. by an attempt that failed halfway) is kept.
+
+    Attributes
+    ----------
+    archive_root: string
+        where the archive of xnat is mounted
+    server_root: string
+        the path of the archive on the xnat server, replaced by archive_root
+        in the paths of the catalog (the same as archive_root by default)
+    link: bool
+        hard link the files instead of copying them (falling back to copies
+        across filesystems), the linked files are then shared with the archive
+    fallback: object
+        the transfer for scans that are not in the mounted archive
+    """
+
+    def __init__(self, archive_root, server_root=None, link=False, fallback=None):
+        self.archive_root = archive_root
+        self.server_root = server_root or archive_root
+        self.link = link
+        self.fallback = fallback if fallback is not None else PyxnatTransfer()
+
+    def _local_path(self, absolute_path):
+        """Where a file at absolute_path in the catalog is mounted (None if outside the archive)"""
+        relpath = os.path.relpath(os.path.normpath(absolute_path),
+                                  os.path.normpath(self.server_root))
+        if relpath == os.curdir or relpath.startswith(os.pardir):
+            return None
+        return os.path.join(self.archive_root, relpath)
+
+    def _archive_files(self, scans, scan_id):
+        """
+        Finds the files of a scan in the mounted archive
+
+        Returns
+        -------
+        files: list | None
+            (path in the archive, its stat, path relative to the scan
+            directory) of every file, None if any of them is not in the
+            archive as the catalog describes it
+        """
+        uri = '{base}/{id}/files?format=json&locator=absolutePath'.format(
+            base=scans._cbase, id=scan_id)
+        response = scans._intf.get(uri)
+        try:
+            response.raise_for_status()
+            entries = response.json()['ResultSet']['Result']
+        finally:
+            response.close()
+        files = []
+        for entry in entries:
+            src = self._local_path(entry['absolutePath']) if entry.get('absolutePath') else None
+            try:
+                src_stat = os.stat(src) if src is not None else None
+            except OSError:
+                src_stat = None
+            if src_stat is None or (entry.get('Size') not in (None, '') and
+                                    src_stat.st_size != int(entry['Size'])):
+                logging.info('%s is not in the mounted archive as xnat lists it',
+                             entry.get('absolutePath') or entry['URI'])
+                return None
+            name = entry['URI'].split('/files/', 1)[1]
+            files.append((src, src_stat, os.path.join(
+                'resources', entry.get('collection') or 'DICOM', 'files', name)))
+        return files
+
+    def _place(self, src, src_stat, dst):
+        """Copies or links src to dst, unless dst already has its size and modification time"""
+        if _same_file(src_stat, dst):
+            return
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(dst, uuid.uuid4().hex)
+        try:
+            if self.link:
+                try:
+                    os.link(src, tmp)
+                except OSError:
+                    shutil.copy2(src, tmp)
+            else:
+                shutil.copy2(src, tmp)
+            if not _same_file(src_stat, tmp):
+                raise OSError('{} changed while it was copied'.format(src))
+            os.replace(tmp, dst)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def download(self, scan_par, scan_ids, name, dest_dir):
+        scans = scan_par.scans()
+        paths = []
+        over_http = []
+        for scan_id in scan_ids.split(','):
+            files = self._archive_files(scans, scan_id)
+            if not files:
+                over_http.append(scan_id)
+                continue
+            scan_dir = _scan_dir(scan_par, scan_id, dest_dir)
+            for src, src_stat, relpath in files:
+                dst = _safe_path(scan_dir, relpath)
+                self._place(src, src_stat, dst)
+                paths.append(dst)
+        if over_http:
+            logging.info('downloading scan(s) %s of %s over http', ','.join(over_http),
+                         scan_par.label())
+            self.fallback.download(scan_par, ','.join(over_http), name, dest_dir)
+        return paths
+
+
+class FilesTransfer(PyxnatTransfer):
+    """
+    Downloads the files of scans one by one, several at a time, instead of
+    waiting for xnat to build a zip archive of them.
+
+    The files are listed from the file catalog of every scan and written
+    straight to resources/<resource>/files in the scan directory. Files
+    already there with the size the catalog gives (e.g. from an attempt
+    that failed halfway) are not downloaded again. The requests share the
+    connections of the Interface, which should keep at least ``workers``
+    of them per download thread (see configure_transport).
+
+    Attributes
+    ----------
+    workers: int
+        files of a download requested at the same time
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+
+    def download(self, scan_par, scan_ids, name, dest_dir):
+        scans = scan_par.scans()
+        listed = [(scan_id, list_remote_files(scans._intf,
+                                              '{}/{}'.format(scans._cbase, scan_id)))
+                  for scan_id in scan_ids.split(',')]
+        return self._fetch(scan_par, listed, dest_dir)
+
+    def _fetch(self, scan_par, listed, dest_dir):
+        """
+        Downloads the listed files
+
+        Parameters
+        ----------
+        listed: list
+            (scan id, its remote files as list_remote_files returns them)
+        """
+        intf = scan_par.scans()._intf
+        paths = []
+        jobs = []
+        for scan_id, remote_files in listed:
+            scan_dir = _scan_dir(scan_par, scan_id, dest_dir)
+            for remote in remote_files:
+                path = _safe_path(scan_dir, remote['path'])
+                paths.append(path)
+                if remote['size'] is None or not os.path.isfile(path) or \
+                        os.path.getsize(path) != remote['size']:
+                    jobs.append((remote['uri'], path))
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as executor:
+            # in the context of the caller, so e.g. the watchdog sees the requests
+            futures = [executor.submit(contextvars.copy_context().run,
+                                       fetch_file, intf, uri, path)
+                       for uri, path in jobs]
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in not_done:
+                future.cancel()
+            for future in done:
+                if future.exception() is not None:
+                    raise future.exception()
+        return paths
+
+
+class AutoTransfer(FilesTransfer):
+    """
+    Downloads scans file by file (see FilesTransfer) or as a zip archive,
+    whichever suits them.
+
+    Large scans of reasonably sized files are downloaded file by file, so
+    the transfer starts at once instead of after xnat built the archive.
+    Small scans, and scans of many tiny files (where a request per file
+    costs more than building the archive), are downloaded as an archive.
+
+    Attributes
+    ----------
+    min_bytes: int
+        least total size of a scan downloaded file by file
+    min_file_size: int
+        least average file size of a scan downloaded file by file
+    archive: object
+        the transfer for the scans downloaded as an archive
+    """
+
+    def __init__(self, workers=4, min_bytes=16 * 1024 * 1024, min_file_size=32 * 1024,
+                 archive=None):
+        super().__init__(workers)
+        self.min_bytes = min_bytes
+        self.min_file_size = min_file_size
+        self.archive = archive if archive is not None else PyxnatTransfer()
+
+    def per_file(self, remote_files):
+        """True if a scan with these files (see list_remote_files) is downloaded file by file"""
+        sizes = [remote['size'] for remote in remote_files]
+        if not sizes or None in sizes:
+            return False
+        return sum(sizes) >= self.min_bytes and sum(sizes) / len(sizes) >= self.min_file_size
+
+    def download(self, scan_par, scan_ids, name, dest_dir):
+        scans = scan_par.scans()
+        listed = []
+        archive_ids = []
+        for scan_id in scan_ids.split(','):
+            remote_files = list_remote_files(scans._intf, '{}/{}'.format(scans._cbase, scan_id))
+            if self.per_file(remote_files):
+                listed.append((scan_id, remote_files))
+            else:
+                archive_ids.append(scan_id)
+        if listed:
+            logging.info('downloading scan(s) %s of %s file by file',
+                         ','.join(scan_id for scan_id, _ in listed), scan_par.label())
+        if archive_ids:
+            self.archive.download(scan_par, ','.join(archive_ids), name, dest_dir)
+        return self._fetch(scan_par, listed, dest_dir)
+
+
+TRANSFERS = {
+    'archive': ArchiveTransfer,
+    'auto': AutoTransfer,
+    'files': FilesTransfer,
+    'pyxnat': PyxnatTransfer,
+    'resume': ResumableTransfer,
+    'stream': StreamTransfer,
+}
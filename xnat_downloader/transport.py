@@ -0,0 +1,57 @@
+"""HTTP connection pooling and timeouts for the pyxnat Interface."""
+from requests.adapters import HTTPAdapter
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    requests adapter that applies a default timeout to every request
+    (pyxnat never passes one, so requests would otherwise wait forever)
+    """
+
+    def __init__(self, timeout=None, **kwargs):
+        """
+        Parameters
+        ----------
+        timeout: tuple | float | None
+            (connect, read) timeout in seconds used when a request has none
+        kwargs: dict
+            passed on to requests.adapters.HTTPAdapter
+        """
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def configure_transport(intf, pool_size, connect_timeout=None, read_timeout=None):
+    """
+    Makes the Interface keep up to pool_size connections to the server
+    alive, so concurrent downloads reuse connections (and their TLS
+    sessions) instead of opening a new one per request
+
+    Parameters
+    ----------
+    intf: object
+        the pyxnat Interface (its requests.Session is in intf._http)
+    pool_size: int
+        number of connections kept open, at least the number of threads
+        making requests at the same time
+    connect_timeout: float | None
+        seconds to wait for a connection to be established
+    read_timeout: float | None
+        seconds to wait for the server to send data
+
+    Returns
+    -------
+    adapter: TimeoutHTTPAdapter
+        the adapter mounted for http and https
+    """
+    adapter = TimeoutHTTPAdapter(timeout=(connect_timeout, read_timeout),
+                                 pool_connections=1,
+                                 pool_maxsize=pool_size)
+    for prefix in ('https://', 'http://'):
+        intf._http.mount(prefix, adapter)
+    return adapter
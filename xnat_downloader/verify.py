@@ -0,0 +1,101 @@
+"""Checking downloaded scans against the file catalog xnat keeps for them."""
+import os
+
+from xnat_downloader.manifest import file_md5
+from xnat_downloader.packing import archive_index, archive_path, is_packed, pack_scan, unpack_scan
+from xnat_downloader.transfer import fetch_file, list_remote_files
+
+
+def compare_files(remote_files, dcm_dir):
+    """
+    Finds the remote files that are missing or differ on disk
+
+    Returns
+    -------
+    missing: list
+        remote files with no local copy
+    mismatched: list
+        remote files whose local copy has the wrong size or digest
+    """
+    missing = []
+    mismatched = []
+    for remote in remote_files:
+        path = os.path.join(dcm_dir, remote['path'])
+        if not os.path.isfile(path):
+            missing.append(remote)
+        elif remote['size'] is not None and os.path.getsize(path) != remote['size']:
+            mismatched.append(remote)
+        elif remote['digest'] is not None and file_md5(path) != remote['digest']:
+            mismatched.append(remote)
+    return missing, mismatched
+
+
+def compare_archive(remote_files, dcm_dir):
+    """
+    Finds the remote files that are missing or differ in a packed scan,
+    from the index of its archive (see compare_files)
+    """
+    index = archive_index(archive_path(dcm_dir))
+    missing = []
+    mismatched = []
+    for remote in remote_files:
+        size, md5 = index.get(remote['path'], (None, None))
+        if remote['path'] not in index:
+            missing.append(remote)
+        elif remote['size'] is not None and size != remote['size']:
+            mismatched.append(remote)
+        elif remote['digest'] is not None and md5 is not None and md5 != remote['digest']:
+            mismatched.append(remote)
+    return missing, mismatched
+
+
+def verify_scan(intf, scan_uri, dcm_dir, refetch=True):
+    """
+    Makes sure the files of a scan on disk match the ones on xnat
+
+    Parameters
+    ----------
+    intf: object
+        the pyxnat Interface
+    scan_uri: string
+        REST path of the scan
+    dcm_dir: string
+        local directory of the scan (<session>/scans/<id>-<type>), a packed
+        scan is checked against the index of its archive and only unpacked
+        (and packed again) when files need downloading
+    refetch: bool
+        download the missing and mismatched files again
+
+    Returns
+    -------
+    result: dict
+        the number of remote files ('total') and the missing, mismatched and
+        refetched files (lists of paths relative to dcm_dir)
+    """
+    remote_files = list_remote_files(intf, scan_uri)
+    packed = is_packed(dcm_dir)
+    if packed:
+        missing, mismatched = compare_archive(remote_files, dcm_dir)
+    else:
+        missing, mismatched = compare_files(remote_files, dcm_dir)
+    refetched = []
+    if refetch:
+        if packed and (missing or mismatched):
+            unpack_scan(dcm_dir)
+        for remote in missing + mismatched:
+            fetch_file(intf, remote['uri'], os.path.join(dcm_dir, remote['path']))
+            refetched.append(remote)
+        still_missing, still_mismatched = compare_files(refetched, dcm_dir)
+        if still_missing or still_mismatched:
+            raise RuntimeError('{n} file(s) of {scan} still differ from xnat after '
+                               're-downloading them'.format(
+                                   n=len(still_missing) + len(still_mismatched),
+                                   scan=scan_uri))
+        if packed and refetched:
+            pack_scan(dcm_dir)
+    return {
+        'total': len(remote_files),
+        'missing': [remote['path'] for remote in missing],
+        'mismatched': [remote['path'] for remote in mismatched],
+        'refetched': [remote['path'] for remote in refetched],
+    }
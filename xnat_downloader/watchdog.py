@@ -0,0 +1,259 @@
+"""Aborting downloads that stopped making progress."""
+import logging
+import socket
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import urlparse
+
+
+class TransferStalled(ConnectionError):
+    """
+    Raised when a download was aborted for being too slow
+    (a ConnectionError, so the retry policy tries it again)
+    """
+
+
+def _interrupt(response):
+    """Wakes up a thread blocked reading the response and closes it"""
+    connection = getattr(getattr(response, 'raw', None), '_connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    try:
+        response.close()
+    except Exception:
+        logging.debug('closing a stalled response failed', exc_info=True)
+
+
+class Transfer:
+    """
+    The responses of one download and the bytes they delivered
+
+    Attributes
+    ----------
+    nbytes: int
+        bytes received so far
+    waiting: int
+        responses between their headers and their first byte
+    receiving: int
+        responses between their first byte and their end (or close)
+    host: string | None
+        the server the responses came from
+    stalled: string | bool
+        the phase ('waiting' or 'receiving') the download stalled in once
+        the watchdog aborted it, False before
+    """
+
+    def __init__(self):
+        self.nbytes = 0
+        self.waiting = 0
+        self.receiving = 0
+        self.host = None
+        self.stalled = False
+        self.responses = []
+        # (time, bytes received) measured by the watchdog while receiving
+        self.samples = []
+        # when the watchdog first saw the transfer waiting for a first byte
+        self.waiting_since = None
+        self._lock = threading.Lock()
+
+    def add(self, response):
+        """Counts the bytes the response delivers through iter_content"""
+        iter_content = response.iter_content
+        close = response.close
+        # waiting from the headers until the first byte, receiving from
+        # there until the body ends or is closed
+        state = {'phase': 'waiting'}
+
+        def enter(phase):
+            with self._lock:
+                if state['phase'] == phase:
+                    return
+                if state['phase'] is not None:
+                    setattr(self, state['phase'], getattr(self, state['phase']) - 1)
+                if phase is not None:
+                    setattr(self, phase, getattr(self, phase) + 1)
+                state['phase'] = phase
+
+        def counting_iter_content(*args, **kwargs):
+            try:
+                for chunk in iter_content(*args, **kwargs):
+                    enter('receiving')
+                    self.nbytes += len(chunk)
+                    yield chunk
+            finally:
+                enter(None)
+
+        def counting_close():
+            enter(None)
+            close()
+
+        response.close = counting_close
+
+        response.iter_content = counting_iter_content
+        with self._lock:
+            self.waiting += 1
+            if self.host is None and getattr(response, 'url', None):
+                self.host = urlparse(response.url).netloc
+            stalled = self.stalled
+            if not stalled:
+                self.responses.append(response)
+        if stalled:
+            _interrupt(response)
+
+    def abort(self, phase='receiving'):
+        """Closes the responses, with stalled set to the phase they stalled in"""
+        with self._lock:
+            self.stalled = phase
+            responses = list(self.responses)
+        for response in responses:
+            _interrupt(response)
+
+
+class Watchdog:
+    """
+    Aborts downloads whose throughput stays below ``floor`` bytes per
+    second for ``window`` seconds, or that wait ``first_byte`` seconds for
+    the first byte of a response
+
+    Throughput is only measured while a response of the download is
+    being received, from its first byte to its end: the time xnat takes to
+    build an archive before sending it (up to ``first_byte``), and the time
+    spent extracting it afterwards, do not count. Work that does not go
+    through a response (e.g. copying from a mounted archive) is not watched.
+
+    Responses of the requests session are tied to the download running in
+    the context (thread) that made the request, so transfers that do not
+    expose their responses (e.g. pyxnat's) are watched too; workers a
+    transfer starts are watched along with it when they run in a copy of
+    its context (contextvars.copy_context). A background thread
+    checks the downloads in progress every ``interval`` seconds.
+
+    Attributes
+    ----------
+    floor: float
+        least acceptable throughput in bytes per second
+    window: float
+        seconds the throughput may stay below the floor
+    first_byte: float
+        seconds a response may take to send its first byte after its
+        headers (three times the window by default)
+    stalls: Counter
+        number of aborted downloads per host
+    """
+
+    def __init__(self, floor, window, first_byte=None, interval=None, clock=time.monotonic):
+        self.floor = floor
+        self.window = window
+        self.first_byte = first_byte if first_byte is not None else 3 * window
+        self.interval = interval if interval is not None else min(window / 4, 1)
+        self.stalls = Counter()
+        self._clock = clock
+        self._current = ContextVar('watchdog_transfer', default=None)
+        self._active = set()
+        self._lock = threading.Lock()
+        self._monitor = None
+        self._closed = threading.Event()
+
+    def install(self, session):
+        """Lets the watchdog see the responses of a requests session"""
+        hooks = session.hooks.setdefault('response', [])
+        if self._track not in hooks:
+            hooks.append(self._track)
+
+    def _track(self, response, *args, **kwargs):
+        transfer = self._current.get()
+        if transfer is not None:
+            transfer.add(response)
+        return response
+
+    @contextmanager
+    def watch(self):
+        """
+        Watches the download made in the body of a with block
+
+        Raises
+        ------
+        TransferStalled
+            if the download was aborted (even when it ended without an
+            error, since its output is then incomplete)
+        """
+        transfer = Transfer()
+        token = self._current.set(transfer)
+        with self._lock:
+            self._active.add(transfer)
+            if self._monitor is None:
+                self._monitor = threading.Thread(target=self._run, daemon=True,
+                                                 name='xnat-watchdog')
+                self._monitor.start()
+        try:
+            yield transfer
+        except Exception as err:
+            if transfer.stalled:
+                raise TransferStalled(self._message(transfer)) from err
+            raise
+        finally:
+            self._current.reset(token)
+            with self._lock:
+                self._active.discard(transfer)
+        if transfer.stalled:
+            raise TransferStalled(self._message(transfer))
+
+    def _message(self, transfer):
+        if transfer.stalled == 'waiting':
+            return 'download from {host} sent nothing for {first_byte:g} s'.format(
+                host=transfer.host or 'xnat', first_byte=self.first_byte)
+        return 'download from {host} stalled below {floor:g} bytes/s for {window:g} s'.format(
+            host=transfer.host or 'xnat', floor=self.floor, window=self.window)
+
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            self.check()
+
+    def close(self):
+        """Stops the background thread"""
+        self._closed.set()
+
+    def check(self):
+        """Aborts the downloads that were too slow over the last window"""
+        now = self._clock()
+        with self._lock:
+            active = list(self._active)
+        for transfer in active:
+            if transfer.stalled:
+                continue
+            if not transfer.receiving:
+                # the window starts again with the next byte
+                del transfer.samples[:]
+                if not transfer.waiting:
+                    transfer.waiting_since = None
+                elif transfer.waiting_since is None:
+                    transfer.waiting_since = now
+                elif now - transfer.waiting_since >= self.first_byte:
+                    self._stall(transfer, 'waiting')
+                continue
+            transfer.waiting_since = None
+            samples = transfer.samples
+            samples.append((now, transfer.nbytes))
+            # keep the last sample at least a window old as the baseline
+            while len(samples) > 2 and samples[1][0] <= now - self.window:
+                samples.pop(0)
+            start, nbytes = samples[0]
+            elapsed = now - start
+            if elapsed >= self.window and transfer.nbytes - nbytes < self.floor * elapsed:
+                self._stall(transfer, 'receiving')
+
+    def _stall(self, transfer, phase):
+        host = transfer.host or 'unknown host'
+        with self._lock:
+            self.stalls[host] += 1
+            count = self.stalls[host]
+        transfer.abort(phase)
+        logging.warning('%s, aborting (%d stalled download(s) from %s so far)',
+                        self._message(transfer), count, host)